@@ -0,0 +1,46 @@
+import os
+import torch
+
+from model.model.triplet_model import TripletNetModel
+from experiment.triplet_utils.get_backbone import get_backbone
+from utils.checkpoint_helper import atomic_save, save_split_checkpoint, load_checkpoint
+
+from benchmarks.bench_utils import register_benchmark, make_temp_folder
+
+
+@register_benchmark("checkpoint.load")
+def setup_checkpoint_load(quick=False):
+    """load_checkpoint + load_state_dict of a training checkpoint in .pt and split (.ckpt) format"""
+    backbone_name = "Resnet18" if quick else "Resnet50"
+    model = TripletNetModel(get_backbone({"backbone_name": backbone_name, "pretrained": False, "embedding_dim": 128}))
+    optimizer = torch.optim.Adam(model.parameters())
+
+    # one step, so the optimizer has its state
+    model(torch.randn(2, 3, 64, 64)).sum().backward()
+    optimizer.step()
+
+    state = {
+        'epoch': 1,
+        'embedding_dimension': 128,
+        'batch_size_training': 2,
+        'model_state_dict': model.state_dict(),
+        'model_architecture': backbone_name,
+        'optimizer_model_state_dict': optimizer.state_dict()
+    }
+    folder = make_temp_folder()
+    pt_path = os.path.join(folder, "benchmark_epoch_1.pt")
+    split_path = os.path.join(folder, "benchmark_epoch_1.ckpt")
+    atomic_save(state, pt_path)
+    save_split_checkpoint(state, split_path)
+
+    def load(path, **kwargs):
+        # the split weights are mmap-ed, they are only read when copied into the model.
+        # the files are in the page cache after the warmup, so this is the warm load time
+        checkpoint = load_checkpoint(path, **kwargs)
+        model.load_state_dict(checkpoint['model_state_dict'])
+
+    return {
+        "{}_pt".format(backbone_name): (lambda: load(pt_path), 1),
+        "{}_split".format(backbone_name): (lambda: load(split_path), 1),
+        "{}_split_weights_only".format(backbone_name): (lambda: load(split_path, weights_only=True), 1),
+    }
@@ -0,0 +1,80 @@
+from dataloader.mnist.dataloader_mnist import MNIST
+from dataloader.arch_dataset.dataloader_arch_dataset import ArchDatset
+from dataloader.synthetic.dataloader_synthetic import SyntheticDataset
+from dataloader.sampler.triplet_sampler import TripletSampler
+from experiment.triplet_utils.get_dataloader import get_transform
+
+from benchmarks.bench_utils import register_benchmark, make_synthetic_dataset
+
+# dataset name: (dataset class, image size of the synthetic data)
+DATASETS = {
+    "MNIST": (MNIST, 28),
+    "Arch_Dataset": (ArchDatset, 64),
+}
+
+
+def _build_datasets(quick):
+    """synthetic datasets with the default transform of each dataset"""
+    num_sample = 256 if quick else 2048
+    datasets = {}
+    for name, (dataset_class, image_size) in DATASETS.items():
+        synthetic_class = make_synthetic_dataset(dataset_class, num_sample=num_sample, num_class=10, image_size=image_size)
+        datasets[name] = synthetic_class(transform=get_transform(name, image_size))
+    return datasets
+
+
+@register_benchmark("dataset.get_instance")
+def setup_get_instance(quick=False):
+    """get_instance by index of MNIST and ArchDatset (PIL conversion + transform)"""
+    num_items = 64 if quick else 512
+    cases = {}
+    for name, dataset in _build_datasets(quick).items():
+        def run(dataset=dataset):
+            for index in range(num_items):
+                dataset.get_instance(index=index)
+        cases[name] = (run, num_items)
+    return cases
+
+
+@register_benchmark("sampler.triplet_item")
+def setup_triplet_item(quick=False):
+    """TripletSampler.__getitem__, random (get_triplet_tuple) and precomputed schedule"""
+    num_items = 32 if quick else 256
+    cases = {}
+    for name, dataset in _build_datasets(quick).items():
+        for mode, precompute in (("random", False), ("schedule", True)):
+            sampler = TripletSampler(dataset, precompute=precompute)
+
+            def run(sampler=sampler):
+                for index in range(num_items):
+                    sampler[index]
+            cases["{}_{}".format(name, mode)] = (run, num_items)
+    return cases
+
+
+@register_benchmark("sampler.generate_schedule")
+def setup_generate_schedule(quick=False):
+    """TripletSampler.generate_schedule of a whole epoch"""
+    dataset = _build_datasets(quick)["Arch_Dataset"]
+    sampler = TripletSampler(dataset, precompute=True)
+    return {"Arch_Dataset": (lambda: sampler.generate_schedule(0), len(sampler))}
+
+
+@register_benchmark("synthetic.large_scale")
+def setup_synthetic_large_scale(quick=False):
+    """SyntheticDataset with thousands of skewed classes: get_instance by class and a whole epoch schedule"""
+    num_samples = 100000 if quick else 1000000
+    num_classes = 1000 if quick else 5000
+    num_items = 64 if quick else 512
+    dataset = SyntheticDataset(num_samples=num_samples, num_classes=num_classes, image_size=64, class_skew=1.0,
+                               transform=get_transform("Synthetic", 64))
+    sampler = TripletSampler(dataset, precompute=True)
+
+    def run_get_instance():
+        for cls in range(num_items):
+            dataset.get_instance(cls=cls % num_classes)
+
+    return {
+        "get_instance_C{}".format(num_classes): (run_get_instance, num_items),
+        "generate_schedule_N{}_C{}".format(num_samples, num_classes): (lambda: sampler.generate_schedule(0), num_samples),
+    }
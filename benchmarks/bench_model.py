@@ -0,0 +1,104 @@
+import copy
+import functools
+import torch
+
+from model.model.triplet_model import TripletNetModel
+from model.loss.triplet_loss import TripletLoss
+from model.loss.xbm_loss import XBMTripletLoss
+from experiment.triplet_utils.get_backbone import get_backbone
+from experiment.triplet_utils.cpu_optimize_model import convert_channels_last, fuse_model_inference
+
+from benchmarks.bench_utils import register_benchmark
+
+BACKBONES = ["Alexnet", "VGG11", "Resnet18", "Resnet50"]
+IMAGE_SIZES = [64, 224]
+CPU_OPTIMIZE_IMAGE_SIZES = [28, 64, 224]
+# the feature map of Alexnet/VGG11 is empty for smaller images (e.g. 28px)
+SMALLEST_IMAGE_SIZE = {"Alexnet": 64, "VGG11": 32}
+
+
+@register_benchmark("model.forward_triplet")
+def setup_forward_triplet(quick=False):
+    """TripletNetModel.forward_triplet (eval, inference mode) for each backbone and image size"""
+    backbones = ["Resnet18"] if quick else BACKBONES
+    image_sizes = [64] if quick else IMAGE_SIZES
+    batch_size = 4 if quick else 8
+
+    cases = {}
+    for backbone_name in backbones:
+        model = TripletNetModel(get_backbone({"backbone_name": backbone_name, "pretrained": False, "embedding_dim": 128})).eval()
+        for image_size in image_sizes:
+            imgs = [torch.randn(batch_size, 3, image_size, image_size) for _ in range(3)]
+
+            def run(model=model, imgs=imgs):
+                with torch.inference_mode():
+                    model.forward_triplet(*imgs)
+            cases["{}_{}px_B{}".format(backbone_name, image_size, batch_size)] = (run, batch_size)
+    return cases
+
+
+def setup_cpu_optimize(backbone_name, quick=False):
+    """backbone inference: eager NCHW, channels_last, fx conv+bn fused and jit (oneDNN) fused, per image size"""
+    # quick only runs Resnet18
+    if quick and backbone_name != "Resnet18":
+        return {}
+    image_sizes = [28, 64] if quick else CPU_OPTIMIZE_IMAGE_SIZES
+    batch_size = 4 if quick else 8
+
+    cases = {}
+    model = TripletNetModel(get_backbone({"backbone_name": backbone_name, "pretrained": False, "embedding_dim": 128})).eval()
+    # only the traced jit model depends on the image size, share the others (VGG11 is ~0.5GB per copy)
+    channels_last_model = convert_channels_last(copy.deepcopy(model))
+    fx_model = fuse_model_inference(model, backend="fx", channels_last=True)
+    for image_size in image_sizes:
+        if image_size < SMALLEST_IMAGE_SIZE.get(backbone_name, 0):
+            continue
+        imgs = torch.randn(batch_size, 3, image_size, image_size)
+        imgs_channels_last = imgs.contiguous(memory_format=torch.channels_last)
+        modes = {
+            "eager": (model, imgs),
+            "channels_last": (channels_last_model, imgs_channels_last),
+            "fx_fused": (fx_model, imgs_channels_last),
+            "jit_fused": (fuse_model_inference(model, imgs, backend="jit", channels_last=True), imgs_channels_last),
+        }
+        for mode, (mode_model, mode_imgs) in modes.items():
+            def run(model=mode_model, imgs=mode_imgs):
+                with torch.inference_mode():
+                    model(imgs)
+            cases["{}px_B{}_{}".format(image_size, batch_size, mode)] = (run, batch_size)
+    return cases
+
+
+# one benchmark per backbone, so only the model copies of one backbone are in memory at once
+for _backbone_name in BACKBONES:
+    register_benchmark("model.cpu_optimize.{}".format(_backbone_name))(
+        functools.update_wrapper(functools.partial(setup_cpu_optimize, _backbone_name), setup_cpu_optimize))
+
+
+@register_benchmark("loss.triplet")
+def setup_triplet_loss(quick=False):
+    """TripletLoss (and XBMTripletLoss with a full memory) forward + backward"""
+    batch_size = 64 if quick else 256
+    dim = 128
+    anchor = torch.randn(batch_size, dim, requires_grad=True)
+    positive = torch.randn(batch_size, dim, requires_grad=True)
+    negative = torch.randn(batch_size, dim, requires_grad=True)
+    anchor_cls = torch.randint(0, 100, (batch_size,))
+    neg_cls = (anchor_cls + 1) % 100
+
+    triplet_loss = TripletLoss(margin=1.0)
+    xbm_loss = XBMTripletLoss(margin=1.0, memory_size=1024 if quick else 4096, warmup_iters=0)
+    # fill the memory before timing
+    for _ in range(xbm_loss.memory.size // (2 * batch_size) + 1):
+        xbm_loss.memory.enqueue(torch.cat([anchor, negative]), torch.cat([anchor_cls, neg_cls]))
+
+    def run_triplet():
+        triplet_loss(anchor, positive, negative).backward()
+
+    def run_xbm():
+        xbm_loss(anchor, positive, negative, anchor_cls=anchor_cls, neg_cls=neg_cls).backward()
+
+    return {
+        "triplet_B{}_D{}".format(batch_size, dim): (run_triplet, batch_size),
+        "triplet_xbm_B{}_D{}_M{}".format(batch_size, dim, xbm_loss.memory.size): (run_xbm, batch_size),
+    }
@@ -0,0 +1,60 @@
+import random
+import torch
+
+from experiment.test_utils.metric import AP_N, retrieval_metrics
+from experiment.test import evaluate_one, evaluate_all_map
+
+from benchmarks.bench_utils import register_benchmark
+
+
+def _random_embeddings(num_sample, dim=128, num_class=50, seed=0):
+    """random clustered embeddings and classes"""
+    generator = torch.Generator().manual_seed(seed)
+    classes = torch.randint(0, num_class, (num_sample,), generator=generator)
+    centers = torch.randn(num_class, dim, generator=generator)
+    features = centers[classes] + torch.randn(num_sample, dim, generator=generator)
+    return features, classes
+
+
+def _sample_list(features, classes):
+    """embeddings in the sample protocal of test.py"""
+    return [{"cls": classes[i], "feature": features[i], "other": {"index": torch.tensor(i)}} for i in range(features.size(0))]
+
+
+@register_benchmark("metric.AP_N")
+def setup_ap_n(quick=False):
+    """AP_N of ranked label lists"""
+    num_lists = 100 if quick else 1000
+    rng = random.Random(0)
+    label_lists = [[rng.randint(0, 1) for _ in range(500)] for _ in range(num_lists)]
+
+    def run(N):
+        for label_list in label_lists:
+            AP_N(label_list, N)
+    return {"N{}".format(N): (lambda N=N: run(N), num_lists) for N in (10, 100, 500)}
+
+
+@register_benchmark("retrieval.evaluate_one")
+def setup_evaluate_one(quick=False):
+    """evaluate_one of test.py, one query against the whole database"""
+    num_sample = 500 if quick else 2000
+    sample_list = _sample_list(*_random_embeddings(num_sample))
+    return {"N{}".format(num_sample): (lambda: evaluate_one(sample_list[0], sample_list), 1)}
+
+
+@register_benchmark("retrieval.evaluate_all_map")
+def setup_evaluate_all_map(quick=False):
+    """evaluate_all_map of test.py (mAP@100 of sampled queries)"""
+    num_sample = 500 if quick else 2000
+    sample_number = 5 if quick else 20
+    sample_list = _sample_list(*_random_embeddings(num_sample))
+    return {"N{}_Q{}".format(num_sample, sample_number):
+            (lambda: evaluate_all_map(sample_list, sample_number=sample_number, N=100), sample_number)}
+
+
+@register_benchmark("retrieval.blocked_metrics")
+def setup_blocked_metrics(quick=False):
+    """retrieval_metrics (blocked vectorized mAP@K/recall@K of all queries)"""
+    num_sample = 2000 if quick else 10000
+    features, classes = _random_embeddings(num_sample)
+    return {"N{}".format(num_sample): (lambda: retrieval_metrics(features, classes, ks=(10, 100)), num_sample)}
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import atexit
+import shutil
+import platform
+import tempfile
+import statistics
+import torch
+
+from utils.log_helper import init_log
+
+logger = init_log("global")
+
+# benchmark name: setup function, filled by 'register_benchmark'
+BENCHMARK_DICT = {}
+
+
+def register_benchmark(name):
+    """Register a benchmark setup function in BENCHMARK_DICT.
+
+    The setup function is called with 'quick' (bool, use smaller inputs) and
+    return a dict of {case name: (function to time, items per call)}. The items
+    is used to compute the throughput (e.g. samples per second). The result
+    name of a case is "benchmark name/case name".
+
+    Usage:
+        @register_benchmark("loss.triplet")
+        def setup_triplet_loss(quick=False):
+            ...
+            return {"B256_D128": (run, 256)}
+    """
+    def wrapper(setup):
+        BENCHMARK_DICT[name] = setup
+        return setup
+    return wrapper
+
+
+def time_function(fn, repeat=5, warmup=1):
+    """Call fn() warmup times, then time it repeat times.
+
+    Return:
+        list of seconds of each call.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def summarize_times(times, items):
+    """Summary of the times of a case, the median is used for comparison."""
+    median = statistics.median(times)
+    return {
+        "median": median,
+        "mean": statistics.mean(times),
+        "min": min(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "repeat": len(times),
+        "items": items,
+        "throughput": items / median if median > 0 else float("inf"),
+    }
+
+
+def cpu_model_name():
+    """cpu model name from /proc/cpuinfo (linux), platform.processor() otherwise"""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def environment_info():
+    """Information of the machine, saved with the results (results are only comparable on the same machine)."""
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "processor": cpu_model_name(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "cpu_count": os.cpu_count(),
+        "cuda": torch.cuda.is_available(),
+    }
+
+
+def run_benchmarks(names, quick=False, repeat=5, warmup=1):
+    """Run the registered benchmarks.
+
+    Args:
+        names: benchmark names in BENCHMARK_DICT.
+        quick: use smaller inputs.
+        repeat: number of timed calls of each case.
+        warmup: number of untimed calls of each case.
+
+    Return:
+        {"environment": ..., "results": {"benchmark/case": summary, ...}}
+    """
+    results = {}
+    for name in names:
+        logger.info("\n------------------------- Benchmark {} -------------------------\n".format(name))
+        cases = BENCHMARK_DICT[name](quick=quick)
+        for case_name, (fn, items) in cases.items():
+            summary = summarize_times(time_function(fn, repeat=repeat, warmup=warmup), items)
+            results["{}/{}".format(name, case_name)] = summary
+            logger.info("\n{}/{}: median {:.6f}s | throughput {:.2f} items/s\n".format(name, case_name, summary["median"], summary["throughput"]))
+        # release the models of this benchmark before the next one is set up
+        del cases
+    return {"environment": environment_info(), "results": results}
+
+
+def save_results(results, path):
+    """save the results to a json file"""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    """load the results saved by 'save_results'"""
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare_results(current, baseline, tolerance=0.1):
+    """Compare the median time of each case with the baseline.
+
+    Args:
+        current: results of 'run_benchmarks'.
+        baseline: results of 'run_benchmarks' (loaded from json).
+        tolerance: relative change of the median time that is not counted,
+            e.g. 0.1 means slower than 1.1x baseline is a regression.
+
+    Return:
+        list of dict {"name", "baseline", "current", "ratio", "status"}, status is
+        one of "regression", "improvement", "ok", "new", "missing".
+    """
+    current_results = current["results"]
+    baseline_results = baseline["results"]
+    rows = []
+    for name in sorted(set(current_results) | set(baseline_results)):
+        base = baseline_results.get(name, {}).get("median")
+        cur = current_results.get(name, {}).get("median")
+        if base is None:
+            rows.append({"name": name, "baseline": None, "current": cur, "ratio": None, "status": "new"})
+            continue
+        if cur is None:
+            rows.append({"name": name, "baseline": base, "current": None, "ratio": None, "status": "missing"})
+            continue
+        ratio = cur / base if base > 0 else float("inf")
+        if ratio > 1 + tolerance:
+            status = "regression"
+        elif ratio < 1 - tolerance:
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append({"name": name, "baseline": base, "current": cur, "ratio": ratio, "status": status})
+    return rows
+
+
+def format_report(rows, tolerance=0.1):
+    """Format the comparison as a text table, regressions are listed at the end."""
+    def fmt(value, pattern):
+        return pattern.format(value) if value is not None else "-"
+
+    width = max([len(row["name"]) for row in rows] + [4])
+    lines = ["{:<{w}}  {:>12}  {:>12}  {:>8}  {}".format("case", "baseline(s)", "current(s)", "ratio", "status", w=width)]
+    for row in rows:
+        lines.append("{:<{w}}  {:>12}  {:>12}  {:>8}  {}".format(
+            row["name"], fmt(row["baseline"], "{:.6f}"), fmt(row["current"], "{:.6f}"),
+            fmt(row["ratio"], "{:.3f}x"), row["status"], w=width))
+
+    regressions = [row for row in rows if row["status"] == "regression"]
+    if regressions:
+        lines.append("\n{} regression(s) (slower than {:.2f}x baseline):".format(len(regressions), 1 + tolerance))
+        for row in regressions:
+            lines.append("  {}: {:.3f}x".format(row["name"], row["ratio"]))
+    else:
+        lines.append("\nNo regression (tolerance {:.0%}).".format(tolerance))
+    return "\n".join(lines)
+
+
+def make_temp_folder():
+    """temporary folder of the synthetic files, removed at exit"""
+    folder = tempfile.mkdtemp(prefix="triplet_benchmark_")
+    atexit.register(shutil.rmtree, folder, True)
+    return folder
+
+
+def make_synthetic_dataset(dataset_class, num_sample=512, num_class=10, image_size=64, seed=0):
+    """Create a subclass of MNIST or ArchDatset that load random data from a temporary folder.
+
+    The files are written in the same format as the processed dataset files, so
+    the real loading code (torch.load, class index, get_instance) is measured.
+
+    Args:
+        dataset_class: MNIST or ArchDatset (or their subclass).
+        num_sample: number of samples of train and test split.
+        num_class: number of classes.
+        image_size: image size of ArchDatset (MNIST is always 28).
+        seed: random seed of the data.
+
+    Return:
+        the dataset subclass, init it like the original class.
+    """
+    from dataloader.arch_dataset.dataloader_arch_dataset import ArchDatset
+
+    generator = torch.Generator().manual_seed(seed)
+    folder = make_temp_folder()
+    targets = torch.randint(0, num_class, (num_sample,), generator=generator)
+
+    if issubclass(dataset_class, ArchDatset):
+        # normalized image in [-1, 1], class name contains the class index
+        data = torch.rand(num_sample, 3, image_size, image_size, generator=generator) * 2 - 1
+        content = (data, targets, ["{} - synthetic".format(i) for i in range(num_class)])
+    else:
+        num_class = min(num_class, len(dataset_class.classes))
+        targets = targets % num_class
+        content = (torch.randint(0, 256, (num_sample, 28, 28), dtype=torch.uint8, generator=generator), targets)
+
+    for file_name in (dataset_class.training_file, dataset_class.test_file):
+        torch.save(content, os.path.join(folder, file_name))
+
+    return type("Synthetic" + dataset_class.__name__, (dataset_class,), {"processed_folder": folder})
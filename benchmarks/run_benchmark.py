@@ -0,0 +1,71 @@
+import sys
+import argparse
+import torch
+
+from benchmarks.bench_utils import BENCHMARK_DICT, run_benchmarks, save_results, load_results, compare_results, format_report
+
+# import the benchmark modules to register them
+import benchmarks.bench_data
+import benchmarks.bench_model
+import benchmarks.bench_retrieval
+import benchmarks.bench_checkpoint
+
+
+if __name__ == "__main__":
+    """
+    Run the benchmarks, save the result json and compare it with a baseline:
+        python benchmarks/run_benchmark.py --output benchmarks/results/current.json --baseline benchmarks/results/baseline.json
+
+    Save a new baseline (e.g. before a performance change):
+        python benchmarks/run_benchmark.py --output benchmarks/results/baseline.json
+
+    The exit code is 1 if any case is slower than (1 + tolerance) x baseline.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the data, model, loss and retrieval hot paths')
+    parser.add_argument('--output', default='benchmarks/results/current.json', type=str,
+                        help='json file to save the result')
+    parser.add_argument('--baseline', default='', type=str,
+                        help='json file of the baseline result to compare with')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative slow down that count as a regression')
+    parser.add_argument('--filter', default=[], type=str, nargs='+',
+                        help='only run the benchmarks whose name contains one of the strings')
+    parser.add_argument('--quick', action='store_true',
+                        help='use smaller inputs')
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='number of timed calls of each case')
+    parser.add_argument('--warmup', default=1, type=int,
+                        help='number of untimed calls of each case')
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help='torch threads, 0 for default')
+    parser.add_argument('--list', action='store_true',
+                        help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, setup in BENCHMARK_DICT.items():
+            print("{:<28} {}".format(name, setup.__doc__))
+        sys.exit(0)
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+
+    names = [name for name in BENCHMARK_DICT if not args.filter or any(f in name for f in args.filter)]
+    if not names:
+        raise NotImplementedError("Please specific a valid benchmark filter")
+
+    results = run_benchmarks(names, quick=args.quick, repeat=args.repeat, warmup=args.warmup)
+    results["config"] = {"quick": args.quick, "repeat": args.repeat, "warmup": args.warmup}
+    save_results(results, args.output)
+    print("\nResult saved in {}".format(args.output))
+
+    if args.baseline:
+        baseline = load_results(args.baseline)
+        if baseline.get("config", {}).get("quick") != args.quick:
+            print("WARNING: the baseline is run with quick={}, the result is not comparable.".format(baseline.get("config", {}).get("quick")))
+        rows = compare_results(results, baseline, tolerance=args.tolerance)
+        print("\nCompare with baseline {} ({}):\n".format(args.baseline, baseline["environment"]["time"]))
+        print(format_report(rows, tolerance=args.tolerance))
+        if any(row["status"] == "regression" for row in rows):
+            sys.exit(1)
@@ -0,0 +1,115 @@
+import torch
+import numpy as np
+
+from utils.log_helper import init_log
+
+logger = init_log("global")
+
+
+class ClassCentroidCache(object):
+    """Running per-class centroid of the training embedding.
+
+    The centroid matrix [C, D] is updated by exponential moving average from
+    the embeddings of each training batch (one index_add per batch, on the
+    device of the embedding, no device sync). At the end of an epoch, 'refresh'
+    compute the [C, C] class-to-class similarity and turn it into the
+    probability of choosing each class as the negative class of an anchor
+    class, similar classes are chosen more often.
+
+    Usage:
+        cache = ClassCentroidCache(class_values, momentum=0.9, temperature=0.1)
+        cache.update(output["anchor_map"], anchor_cls)      # every batch
+        probs = cache.refresh()                             # every epoch
+        train_dataset.set_negative_class_probs(probs)
+
+    Args:
+        class_values: (array) sorted class label of the dataset, the row i of
+            the centroid matrix is the centroid of class_values[i].
+        momentum: centroid = centroid * momentum + batch mean * (1 - momentum).
+        temperature: softmax temperature of the similarity, lower is harder.
+    """
+    def __init__(self, class_values, momentum=0.9, temperature=0.1):
+        self.class_values = torch.as_tensor(np.asarray(class_values), dtype=torch.long)
+        self.num_classes = len(self.class_values)
+        self.momentum = momentum
+        self.temperature = temperature
+
+        # allocated on the first update, when the embedding dimension and device are known
+        self.centroids = None
+        self.initialized = None
+
+    def update(self, embeddings, classes):
+        """Update the centroids of the classes in the batch.
+
+        Args:
+            embeddings: (Tensor) [B, D] embedding of the batch.
+            classes: (Tensor) [B] class label of the batch.
+        """
+        embeddings = embeddings.detach().float()
+        device = embeddings.device
+
+        if self.centroids is None:
+            self.centroids = torch.zeros(self.num_classes, embeddings.size(1), device=device)
+            self.initialized = torch.zeros(self.num_classes, dtype=torch.bool, device=device)
+            self.class_values = self.class_values.to(device)
+
+        # label to row of the centroid matrix
+        rows = torch.searchsorted(self.class_values, classes.to(device).long())
+
+        batch_sum = torch.zeros_like(self.centroids).index_add_(0, rows, embeddings)
+        batch_count = torch.zeros(self.num_classes, device=device).index_add_(0, rows, torch.ones_like(rows, dtype=torch.float))
+        present = batch_count > 0
+        batch_mean = batch_sum / batch_count.clamp(min=1).unsqueeze(1)
+
+        # the first batch of a class set the centroid directly
+        momentum = torch.where(self.initialized, torch.full_like(batch_count, self.momentum), torch.zeros_like(batch_count))
+        momentum = torch.where(present, momentum, torch.ones_like(batch_count)).unsqueeze(1)
+        self.centroids.mul_(momentum).add_(batch_mean * (1 - momentum))
+        self.initialized |= present
+
+    def similarity(self):
+        """[C, C] cosine similarity between the class centroids (on cpu)."""
+        centroids = torch.nn.functional.normalize(self.centroids.cpu(), dim=1)
+        return centroids @ centroids.t()
+
+    def refresh(self):
+        """Compute the probability of choosing each negative class.
+
+        Return:
+            (np.ndarray) [C, C] probability, row c is the distribution of the
+            negative class for anchor class c (the diagonal is 0). Classes
+            without centroid use uniform distribution. None if never updated.
+        """
+        if self.centroids is None:
+            return None
+
+        similarity = self.similarity()
+        initialized = self.initialized.cpu()
+
+        logits = similarity / self.temperature
+        # uninitialized classes are treated as neutral
+        logits[~initialized, :] = 0
+        logits[:, ~initialized] = 0
+        logits.fill_diagonal_(float("-inf"))
+
+        probs = torch.softmax(logits.double(), dim=1).numpy()
+        logger.info("\nRefresh class centroid similarity: {} / {} classes have centroid.\n".format(int(initialized.sum()), self.num_classes))
+        return probs
+
+
+if __name__ == "__main__":
+    """
+    Check that the closest class get the highest probability.
+    """
+    class_values = np.array([0, 3, 5, 9])
+    cache = ClassCentroidCache(class_values, momentum=0.5, temperature=0.1)
+
+    # class 0 and 3 are close
+    centers = torch.tensor([[1.0, 0.0], [0.9, 0.1], [0.0, 1.0], [-1.0, 0.0]])
+    for _ in range(10):
+        rows = torch.randint(0, 4, (32,))
+        cache.update(centers[rows] + torch.randn(32, 2) * 0.01, torch.as_tensor(class_values)[rows])
+
+    probs = cache.refresh()
+    print(np.round(probs, 3))
+    assert probs[0].argmax() == 1 and probs[1].argmax() == 0, "closest class should have the highest probability"
@@ -0,0 +1,193 @@
+import copy
+import queue
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from utils.log_helper import init_log
+
+logger = init_log("global")
+
+
+def mine_hard_triplets(features, classes, top_m=10, block_size=1024):
+    """Build the nearest-neighbour table of each sample by blocked matmul top-k.
+
+    The features are l2-normalized, so the closest sample has the largest
+    inner product. The similarity is computed block by block ([block_size, N]
+    at once), so the memory is O(block_size * N) instead of O(N * N).
+
+    For each sample:
+        hard negative: the top_m closest samples of other classes.
+        hard positive: the top_m farthest samples of the same class (the
+            sample itself is used only if the class has no other sample).
+
+    Args:
+        features: (Tensor) [N, D] embedding of all samples.
+        classes: (Tensor) [N] class label of all samples.
+        top_m: (int) number of candidates of each sample.
+        block_size: (int) number of rows computed at once.
+
+    Return:
+        pos_table: (np.ndarray) [N, top_m] index of hard positive.
+        neg_table: (np.ndarray) [N, top_m] index of hard negative.
+    """
+    features = torch.nn.functional.normalize(features.float(), dim=1)
+    classes = classes.long()
+    num_sample = features.size(0)
+    top_m = min(top_m, num_sample)
+
+    pos_table = torch.empty(num_sample, top_m, dtype=torch.long)
+    neg_table = torch.empty(num_sample, top_m, dtype=torch.long)
+
+    for start in range(0, num_sample, block_size):
+        end = min(start + block_size, num_sample)
+        similarity = features[start:end] @ features.t()
+        same_class = classes[start:end].unsqueeze(1) == classes.unsqueeze(0)
+
+        # closest samples of other class
+        neg_similarity = similarity.masked_fill(same_class, float("-inf"))
+        neg_value, neg_index = neg_similarity.topk(top_m, dim=1, largest=True)
+        # fewer candidates than top_m, fill with the closest one
+        neg_index = torch.where(torch.isinf(neg_value), neg_index[:, :1], neg_index)
+
+        # farthest samples of same class, the sample itself is the last choice
+        pos_similarity = similarity.masked_fill(~same_class, float("inf"))
+        rows = torch.arange(end - start)
+        pos_similarity[rows, rows + start] = 1e4
+        pos_value, pos_index = pos_similarity.topk(top_m, dim=1, largest=False)
+        pos_index = torch.where(torch.isinf(pos_value), pos_index[:, :1], pos_index)
+
+        pos_table[start:end] = pos_index
+        neg_table[start:end] = neg_index
+
+    return pos_table.numpy(), neg_table.numpy()
+
+
+def _mining_worker(model, dataset, batch_size, top_m, block_size, num_threads, result_queue):
+    """Background process: embed the dataset with the model copy and mine the tables."""
+    from experiment.test_utils.extract import extract_embeddings
+
+    torch.set_num_threads(num_threads)
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=0)
+    features, classes, indexes = extract_embeddings(model, dataloader, torch.device("cpu"), log_interval=10 ** 9)
+
+    # the dataloader is sequential, but keep the table in dataset order anyway
+    order = torch.argsort(indexes)
+    pos_table, neg_table = mine_hard_triplets(features[order], classes[order], top_m, block_size)
+    result_queue.put((pos_table, neg_table))
+
+
+class HardNegativeMiner(object):
+    """Mine hard triplets in a background process.
+
+    'start' copy the current model to cpu and spawn a process, which embeds
+    the whole (non-triplet) training dataset with 'extract_embeddings' (the
+    same routine used by 'test_model'), then build the hard positive/negative
+    tables by 'mine_hard_triplets'. The training keeps running meanwhile,
+    'poll' return the tables once they are ready.
+
+    Usage:
+        miner = HardNegativeMiner(top_m=10)
+        miner.start(model, train_dataset.inner_dataset)
+        ...
+        tables = miner.poll()
+        if tables is not None:
+            train_dataset.set_hard_tables(*tables)
+
+    Args:
+        top_m: number of candidates of each sample.
+        batch_size: batch size of embedding.
+        block_size: number of rows of the blocked similarity matmul.
+        num_threads: torch threads of the background process.
+    """
+    def __init__(self, top_m=10, batch_size=64, block_size=1024, num_threads=2):
+        self.top_m = top_m
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.num_threads = num_threads
+
+        self._context = mp.get_context("spawn")
+        self._queue = self._context.Queue(maxsize=1)
+        self._process = None
+
+    @property
+    def running(self):
+        """wether a mining process is running"""
+        return self._process is not None
+
+    def start(self, model, dataset):
+        """Start mining with a cpu copy of the model, do nothing if one is running.
+
+        Args:
+            model: the (unwrapped) TripletNetModel.
+            dataset: non-triplet dataset, sample protocal is {"img", "cls", "other": {"index"}}.
+        """
+        if self.running:
+            return
+        model_copy = copy.deepcopy(model).to("cpu").eval()
+        self._process = self._context.Process(target=_mining_worker,
+                                              args=(model_copy, dataset, self.batch_size, self.top_m,
+                                                    self.block_size, self.num_threads, self._queue),
+                                              daemon=True)
+        self._process.start()
+        logger.info("\nStart hard negative mining in background process (pid {}).\n".format(self._process.pid))
+
+    def poll(self, block=False, check_interval=5.0):
+        """Get the mining result.
+
+        Args:
+            block: wait until the result is ready, raise RuntimeError if the
+                mining process exit without result (e.g. out of memory).
+            check_interval: seconds between the liveness checks when block.
+
+        Return:
+            (pos_table, neg_table) if ready, else None.
+        """
+        if not self.running:
+            return None
+        while True:
+            try:
+                result = self._queue.get(block=block, timeout=check_interval if block else None)
+                break
+            except queue.Empty:
+                if self._process.is_alive():
+                    if block:
+                        continue
+                    return None
+                exitcode = self._process.exitcode
+                self._process = None
+                if block:
+                    raise RuntimeError("Hard negative mining process exit with code {} without result.".format(exitcode))
+                logger.warning("\nWARNING: hard negative mining process exit with code {}.\n".format(exitcode))
+                return None
+
+        self._process.join()
+        self._process = None
+        return result
+
+    def close(self):
+        """stop the mining process"""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+
+if __name__ == "__main__":
+    """
+    Check the mined table on random features.
+    """
+    import time
+
+    num_sample, dim, num_class = 5000, 128, 50
+    classes = torch.randint(0, num_class, (num_sample,))
+    features = torch.randn(num_sample, dim) + torch.randn(num_class, dim)[classes] * 2
+
+    start_time = time.time()
+    pos_table, neg_table = mine_hard_triplets(features, classes, top_m=10, block_size=1024)
+    print("mine {} samples in {:.3f}s".format(num_sample, time.time() - start_time))
+
+    classes = classes.numpy()
+    assert (classes[pos_table] == classes[:, None]).all(), "positive should be the same class"
+    assert (classes[neg_table] != classes[:, None]).all(), "negative should be other class"
+    print("check passed.")
@@ -3,6 +3,7 @@ import os.path
 import torch
 from torch.utils.data import Dataset
 import random
+import numpy as np
 
 
 class TripletSampler(Dataset):
@@ -34,19 +35,48 @@ class TripletSampler(Dataset):
 
     The default work is discrieb in self.__item__;
 
+    If 'precompute' is True, the anchor/positive/negative index of the whole
+    epoch are drawn at once by NumPy (see 'generate_schedule'), and stored as
+    a [N, 3] shared memory tensor, __getitem__ only read the index from it.
+    Call 'set_epoch(epoch)' at the start of each epoch to draw a new schedule,
+    the schedule of each epoch is reproducible by 'seed'. (the tensor is 
+    updated in place, so the persistent workers see the new schedule.)
+
     Args:
         dataset: input dataset, which need to include a get_instance method, 
-            else will raise error
+            else will raise error. To precompute the schedule, the dataset 
+            also need a 'targets' attribute (class of each sample).
+        precompute: wether draw the triplet index of an epoch at once.
+        seed: random seed of the schedule, the seed of each epoch is seed + epoch.
+
+    With a precomputed schedule, hard triplets can be mixed in by 
+    'set_hard_tables' (see dataloader/sampler/hard_negative_miner.py), then
+    'hard_ratio' of the anchors take the positive/negative from the tables.
+
+    The negative class can also be drawn by a [C, C] probability table set by
+    'set_negative_class_probs' (see dataloader/sampler/class_centroid_cache.py),
+    instead of uniformly from the other classes.
 
     Atrribute:
+        schedule: [N, 3] (anchor, positive, negative) index tensor, None if not precompute.
+        hard_pos_table, hard_neg_table: [N, M] hard positive/negative candidates, None if not mined.
+        class_values: sorted class label, the class position i is class_values[i], None if not precompute.
+        neg_class_probs: [C, C] negative class probability of each anchor class, None if uniform.
     
     """
-    def __init__(self, dataset):
+    def __init__(self, dataset, precompute=False, seed=0):
         """
         Init process:
             load dataset, If dataset dose not have get_instance method, raise error.
         """
         self.inner_dataset = dataset
+        self.seed = seed
+        self.schedule = None
+        self.hard_pos_table = None
+        self.hard_neg_table = None
+        self.hard_ratio = 0.0
+        self.class_values = None
+        self.neg_class_probs = None
 
         # check format
         _test = getattr(self.inner_dataset, "class_to_idx", None)
@@ -62,6 +92,124 @@ class TripletSampler(Dataset):
         assert "img" in _test, "get_instance() should return a dic with {'img': ...}"
         assert "cls" in _test, "get_instance() should return a dic with {'cls': ...}"
 
+        if precompute:
+            self._build_class_array()
+            # shared memory, so the workers see the update of set_epoch
+            self.schedule = torch.from_numpy(self.generate_schedule(self.seed)).share_memory_()
+
+    def _build_class_array(self):
+        """
+        Group the sample index by class for vectorized sampling:
+
+            sorted_index: sample index sorted by class.
+            class_start, class_count: start position and sample number of each class in sorted_index.
+            sample_class_id: class position (0 ~ C-1) of each sample.
+        """
+        targets = np.asarray(self.inner_dataset.targets).astype(np.int64)
+        classes, sample_class_id, class_count = np.unique(targets, return_inverse=True, return_counts=True)
+        assert len(classes) > 1, "Triplet sampling need at least 2 classes."
+
+        self.sorted_index = np.argsort(sample_class_id, kind="stable")
+        self.class_start = np.concatenate([[0], np.cumsum(class_count)[:-1]])
+        self.class_count = class_count
+        self.sample_class_id = sample_class_id
+        self.class_values = classes
+
+    def generate_schedule(self, seed):
+        """Draw the triplet index of a whole epoch with NumPy.
+
+        Each sample of the dataset is used as anchor once, the positive is a
+        random sample of the same class, the negative is a random sample of a
+        random other class (same distribution as 'get_triplet_tuple'), or of a
+        class drawn from 'neg_class_probs' if it is set.
+
+        Args:
+            seed: random seed of the schedule.
+
+        return:
+            [N, 3] int64 array of (anchor index, positive index, negative index).
+        """
+        rng = np.random.default_rng(seed)
+        num_sample = len(self.sample_class_id)
+        num_class = len(self.class_count)
+
+        anchor = np.arange(num_sample)
+        anchor_class = self.sample_class_id
+
+        # positive: random sample in the anchor class
+        pos_offset = (rng.random(num_sample) * self.class_count[anchor_class]).astype(np.int64)
+        pos = self.sorted_index[self.class_start[anchor_class] + pos_offset]
+
+        # negative: random class except the anchor class, then random sample in it
+        if self.neg_class_probs is None:
+            neg_class = rng.integers(0, num_class - 1, num_sample)
+            neg_class += neg_class >= anchor_class
+        else:
+            # one draw per anchor class, O(C) python loop
+            neg_class = np.empty(num_sample, dtype=np.int64)
+            for class_id in range(num_class):
+                class_sample = self.sorted_index[self.class_start[class_id]:self.class_start[class_id] + self.class_count[class_id]]
+                neg_class[class_sample] = rng.choice(num_class, size=len(class_sample), p=self.neg_class_probs[class_id])
+        neg_offset = (rng.random(num_sample) * self.class_count[neg_class]).astype(np.int64)
+        neg = self.sorted_index[self.class_start[neg_class] + neg_offset]
+
+        # replace part of the triplets by the mined hard positive/negative
+        if self.hard_neg_table is not None:
+            use_hard = rng.random(num_sample) < self.hard_ratio
+            hard_column = rng.integers(0, self.hard_neg_table.shape[1], num_sample)
+            pos = np.where(use_hard, self.hard_pos_table[anchor, hard_column], pos)
+            neg = np.where(use_hard, self.hard_neg_table[anchor, hard_column], neg)
+
+        return np.stack([anchor, pos, neg], axis=1)
+
+    def set_hard_tables(self, pos_table, neg_table, hard_ratio=0.5):
+        """Set the mined hard triplet tables, used from the next 'set_epoch'.
+
+        Args:
+            pos_table: [N, M] index of hard positive of each anchor.
+            neg_table: [N, M] index of hard negative of each anchor.
+            hard_ratio: ratio of anchors that use the hard positive/negative.
+        """
+        assert self.schedule is not None, "Hard triplet need a precomputed schedule."
+        assert len(pos_table) == len(neg_table) == len(self), "The tables should have a row for each sample."
+        self.hard_pos_table = np.asarray(pos_table)
+        self.hard_neg_table = np.asarray(neg_table)
+        self.hard_ratio = hard_ratio
+
+    def set_negative_class_probs(self, probs):
+        """Set the probability of choosing each negative class, used from the next 'set_epoch'.
+
+        Args:
+            probs: [C, C] probability, row c is the distribution of the negative
+                class for anchor class c (the diagonal should be 0), the order
+                of the classes is 'class_values'. None to go back to uniform.
+        """
+        assert self.schedule is not None, "Negative class probability need a precomputed schedule."
+        if probs is None:
+            self.neg_class_probs = None
+            return
+        probs = np.asarray(probs, dtype=np.float64)
+        num_class = len(self.class_count)
+        assert probs.shape == (num_class, num_class), "The probability table should be [C, C]."
+        # normalize again, rng.choice is strict about the sum
+        self.neg_class_probs = probs / probs.sum(axis=1, keepdims=True)
+
+    def set_epoch(self, epoch):
+        """draw the schedule of the epoch (seed + epoch), do nothing if not precompute"""
+        if self.schedule is not None:
+            self.schedule.copy_(torch.from_numpy(self.generate_schedule(self.seed + epoch)))
+
+    def save_schedule(self, path):
+        """save the current schedule to a '.npy' file"""
+        np.save(path, self.schedule.numpy())
+
+    def load_schedule(self, path):
+        """load a schedule saved by 'save_schedule' to replay it"""
+        schedule = torch.from_numpy(np.load(path))
+        assert self.schedule is not None and schedule.shape == self.schedule.shape, \
+            "The schedule should be precomputed with the same dataset."
+        self.schedule.copy_(schedule)
+
     def __getitem__(self, index):
         """
         Get a triplet tuple, refer 'get_triplet_tuple' method for detail
@@ -85,6 +233,8 @@ class TripletSampler(Dataset):
                         }
             }
         """
+        if self.schedule is not None:
+            return self.get_scheduled_tuple(index)
         return self.get_triplet_tuple(index=index)
 
     def __len__(self):
@@ -148,6 +298,37 @@ class TripletSampler(Dataset):
         }
 
 
+    def get_scheduled_tuple(self, index):
+        """Get the triplet tuple of the precomputed schedule
+
+        Args:
+            index: row of the schedule.
+
+        return:
+            same as 'get_triplet_tuple'
+        """
+        anchor_index, pos_index, neg_index = self.schedule[index].tolist()
+
+        anchor_sample = self.inner_dataset.get_instance(index=anchor_index)
+        pos_sample = self.inner_dataset.get_instance(index=pos_index)
+        neg_sample = self.inner_dataset.get_instance(index=neg_index)
+
+        other = {
+            "anchor_index": anchor_index,
+            "neg_index": neg_index,
+            "pos_index": pos_index,
+        }
+
+        return {
+            "anchor_img": anchor_sample["img"],
+            "neg_img": neg_sample["img"],
+            "pos_img": pos_sample["img"],
+            "anchor_cls": anchor_sample["cls"],
+            "pos_cls": pos_sample["cls"],
+            "neg_cls": neg_sample["cls"],
+            "other": other,
+        }
+
     @property
     def class_to_idx(self):
         return self.inner_dataset.class_to_idx
@@ -0,0 +1,340 @@
+import os
+import os.path
+import torch
+import random
+import tempfile
+import numpy as np
+from PIL import Image
+from torchvision.datasets.vision import VisionDataset
+
+
+"""
+The SyntheticDataset generate deterministic random images, for performance
+testing of data loading and retrieval without the real dataset.
+"""
+class SyntheticDataset(VisionDataset):
+    """Synthetic image dataset with the same protocal as MNIST/ArchDatset.
+
+    Each class has a random low resolution color pattern (prototype), the image
+    of a sample is its class prototype upsampled to image_size plus random noise.
+    Everything is seeded by (seed, split, index), so the same sample always has
+    the same image, on any process and any machine, and no file is needed.
+
+    The class size follow a power law: the weight of class c is (c + 1) ** -class_skew,
+    0 means balanced classes, larger means more skewed (each class has at least
+    one sample, so num_samples should not be less than num_classes).
+
+    The noise is a counter based hash of (seed, split, index, pixel), so a block
+    of consecutive samples is generated at once by numpy, and the result is the
+    same as generating the samples one by one.
+
+    With storage="mmap", the images are generated once (block by block) into a
+    uint8 file [N, image_size, image_size, 3] in 'root' (named by the parameters,
+    reused if exist), and read by np.memmap, so the cost of generation is not counted.
+
+    Args:
+        root (string): folder of the mmap files.
+        train (bool, optional): train split or test split (different seed).
+        transform (callable, optional): transform of the PIL image.
+        target_transform (callable, optional): transform of the target.
+        num_samples (int): number of samples of the train split.
+        num_test_samples (int): number of samples of the test split, default is num_samples // 5.
+        num_classes (int): number of classes.
+        image_size (int): height and width of the image.
+        class_skew (float): power of the class size distribution.
+        seed (int): random seed of the dataset.
+        storage (str): "on_the_fly" or "mmap".
+
+    Atrribute:
+        targets: [N] class of each sample.
+        classes: 保存按照index编码的cls信息注释
+        sorted_index, class_start, class_count: sample index grouped by class,
+            used to get a random sample of a class in O(1).
+
+        property:
+            class_to_idx: 返回一个对应class的注释dict
+
+        get_instance: 获取一个数据样本的基本方法, 分别包括随机, 指定index, 指定cls三种
+        get_raw_image: 根据指定的index, 获取一个未处理的图, 在test中会被用到.
+    """
+
+    processed_folder = './dataset/synthetic/'
+    # low resolution of the class prototype
+    prototype_size = 4
+    # number of pixels generated at once when writing the mmap file
+    block_pixels = 2 ** 21
+
+    def __init__(self, root=None, train=True, transform=None, target_transform=None,
+                 num_samples=10000, num_test_samples=None, num_classes=100, image_size=64,
+                 class_skew=0.0, seed=0, storage="on_the_fly"):
+        """
+        Init process:
+            generate the class of each sample, images are generated on the fly
+            (or into the mmap file).
+        """
+        if root is None:
+            root = self.processed_folder
+
+        super(SyntheticDataset, self).__init__(root, transform=transform,
+                                               target_transform=target_transform)
+        if storage not in ("on_the_fly", "mmap"):
+            raise NotImplementedError("Please specific a valid synthetic storage")
+
+        self.train = train  # training set or test set
+        if not train:
+            num_samples = num_test_samples if num_test_samples is not None else max(num_classes, num_samples // 5)
+        assert num_samples >= num_classes, \
+            "num_samples ({}) of the {} split should not be less than num_classes ({}), every class needs a sample.".format(
+                num_samples, "train" if train else "test", num_classes)
+        self.num_samples = num_samples
+        self.num_classes = num_classes
+        self.image_size = image_size
+        self.class_skew = class_skew
+        self.seed = seed
+        self.split_id = 0 if train else 1
+        self.storage = storage
+
+        self.classes = ["{} - synthetic".format(i) for i in range(num_classes)]
+        self.targets = self._generate_targets()
+
+        # group the index by class
+        self.sorted_index = torch.argsort(self.targets, stable=True)
+        self.class_count = torch.bincount(self.targets, minlength=num_classes)
+        self.class_start = torch.cumsum(self.class_count, 0) - self.class_count
+
+        self._images = None
+        self._prototypes = None
+        if storage == "mmap":
+            self._generate_mmap()
+
+    def _generate_targets(self):
+        """class of each sample, the class size follow the power law of class_skew"""
+        weight = (np.arange(self.num_classes) + 1.0) ** -self.class_skew
+        weight = weight / weight.sum()
+
+        # one sample per class, the rest by largest remainder
+        rest = self.num_samples - self.num_classes
+        count = np.floor(weight * rest).astype(np.int64)
+        remainder = weight * rest - count
+        count[np.argsort(-remainder, kind="stable")[:rest - count.sum()]] += 1
+        count += 1
+
+        rng = np.random.default_rng([self.seed, self.split_id])
+        targets = rng.permutation(np.repeat(np.arange(self.num_classes), count))
+        return torch.from_numpy(targets)
+
+    @property
+    def prototypes(self):
+        """[C, prototype_size, prototype_size, 3] low resolution pattern of all classes, generated once"""
+        if self._prototypes is None:
+            rng = np.random.default_rng([self.seed, 2])
+            self._prototypes = (rng.random((self.num_classes, self.prototype_size, self.prototype_size, 3)) * 255).astype(np.float32)
+        return self._prototypes
+
+    @staticmethod
+    def _hash_noise(keys):
+        """uint8 noise of uint64 keys (splitmix64 finalizer), element-wise"""
+        with np.errstate(over="ignore"):
+            z = keys + np.uint64(0x9E3779B97F4A7C15)
+            z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            z = z ^ (z >> np.uint64(31))
+        return (z >> np.uint64(56)).astype(np.uint8)
+
+    def generate_block(self, start, end):
+        """[end - start, image_size, image_size, 3] uint8 images of the samples [start, end), deterministic by (seed, split, index)"""
+        num_pixels = self.image_size * self.image_size * 3
+        # a different key range of each (seed, split), 2 ** 48 keys is enough for 10M images of 1024px
+        offset = np.uint64((self.seed * 2 + self.split_id) << 48)
+        keys = offset + np.arange(start * num_pixels, end * num_pixels, dtype=np.uint64)
+        noise = self._hash_noise(keys).reshape(end - start, self.image_size, self.image_size, 3)
+
+        # upsample the prototypes of the classes by nearest neighbour
+        grid = np.arange(self.image_size) * self.prototype_size // self.image_size
+        prototype = self.prototypes[self.targets[start:end].numpy()][:, grid][:, :, grid]
+        img = prototype * 0.7 + noise.astype(np.float32) * 0.3
+        return img.astype(np.uint8)
+
+    def generate_image(self, index):
+        """[image_size, image_size, 3] uint8 image of the sample, deterministic by (seed, split, index)"""
+        return self.generate_block(index, index + 1)[0]
+
+    @property
+    def mmap_file(self):
+        """path of the mmap file, named by all the parameters"""
+        return os.path.join(self.root, "synthetic_v2_{}_n{}_c{}_s{}_skew{}_seed{}.u8".format(
+            "train" if self.train else "test", self.num_samples, self.num_classes,
+            self.image_size, self.class_skew, self.seed))
+
+    def _generate_mmap(self):
+        """write all images to the mmap file, skipped if the file exists"""
+        if os.path.exists(self.mmap_file):
+            return
+        os.makedirs(self.root, exist_ok=True)
+        # unique temporary file per process, several processes (e.g. torchrun) may generate the same file at once
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(self.mmap_file) + ".", suffix=".tmp", dir=self.root)
+        os.close(fd)
+        images = np.memmap(tmp_file, dtype=np.uint8, mode="w+",
+                           shape=(self.num_samples, self.image_size, self.image_size, 3))
+        block_size = max(1, self.block_pixels // (self.image_size * self.image_size * 3))
+        for start in range(0, self.num_samples, block_size):
+            end = min(start + block_size, self.num_samples)
+            images[start:end] = self.generate_block(start, end)
+        images.flush()
+        del images
+        try:
+            os.replace(tmp_file, self.mmap_file)
+        except OSError:
+            # the same images, fine if another process has finished the file
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            if not os.path.exists(self.mmap_file):
+                raise
+
+    def _get_image(self, index):
+        """uint8 image array of the sample, from the mmap file (opened on each process) or generated"""
+        if self.storage == "on_the_fly":
+            return self.generate_image(index)
+        if self._images is None:
+            self._images = np.memmap(self.mmap_file, dtype=np.uint8, mode="r",
+                                     shape=(self.num_samples, self.image_size, self.image_size, 3))
+        return np.asarray(self._images[index])
+
+    def __getstate__(self):
+        """do not pickle the memmap to the workers, they open it again"""
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __getitem__(self, index):
+        """
+        Defaulet use as torch dataset
+
+        Return according to index.
+
+        Args:
+            index (int): Index
+
+        Returns:
+            dictionary:
+                {
+                    "img": target image,
+                    "cls": target class,
+                    "other": other information,
+                        {
+                            "index" : index,
+                        }
+                }
+        """
+        return self.get_instance(index=index)
+
+    def get_instance(self, index=None, cls=None):
+        """
+        Get one instance from dataset, acccording to the specification
+
+        The default performance of function is return a random sample,
+        If the index is specified, then return index sample, else if cls
+        is specified, then get target class sample.
+
+        Args:
+            index (int): Index num
+            cls (int):   Class num
+
+        Returns:
+            dictionary:
+                {
+                    "img": target image,
+                    "cls": target class,
+                    "other": other information,
+                        {
+                            "index" : index,
+                        }
+                }
+        """
+        rdic = {}
+        other = {}
+
+        if index is not None:
+            index = int(index)
+        elif cls is not None:
+            index = int(self.sorted_index[self.class_start[cls] + random.randrange(int(self.class_count[cls]))])
+        else:
+            index = random.randrange(len(self))
+
+        img = Image.fromarray(self._get_image(index), mode="RGB")
+        target = int(self.targets[index])
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        other["index"] = index
+
+        rdic["img"] = img
+        rdic["cls"] = target
+        rdic["other"] = other
+
+        return rdic
+
+    def get_raw_image(self, index=None):
+        """
+            Get one instance from dataset, acccording to the specification index
+
+            The default performance of function is return a random PIL.Image,
+            If the index is specified, then return index Image
+
+            Args:
+                index (int): Index num
+
+            Returns:
+                A PIL.Image.
+        """
+        if index is None:
+            index = random.randrange(len(self))
+        return Image.fromarray(self._get_image(int(index)), mode="RGB")
+
+    def __len__(self):
+        return self.num_samples
+
+    @property
+    def class_to_idx(self):
+        return {_class: i for i, _class in enumerate(self.classes)}
+
+
+if __name__ == "__main__":
+    """
+    Check the determinism and the class size distribution.
+    """
+    import multiprocessing
+
+    dataset = SyntheticDataset(num_samples=2000, num_classes=50, image_size=32, class_skew=1.0)
+    print("class count (skew 1.0):", dataset.class_count[:10].tolist(), "...", dataset.class_count[-5:].tolist())
+    assert int(dataset.class_count.sum()) == 2000 and int(dataset.class_count.min()) >= 1
+
+    again = SyntheticDataset(num_samples=2000, num_classes=50, image_size=32, class_skew=1.0)
+    assert np.array_equal(dataset.generate_image(123), again.generate_image(123)), "image should be deterministic"
+
+    block = dataset.generate_block(100, 110)
+    assert all(np.array_equal(block[i], dataset.generate_image(100 + i)) for i in range(10)), "block should match one by one"
+
+    sample = dataset.get_instance(cls=7)
+    assert sample["cls"] == 7
+
+    mmap_dataset = SyntheticDataset(root=tempfile.mkdtemp(), num_samples=200, num_classes=10, image_size=32, storage="mmap")
+    on_the_fly = SyntheticDataset(num_samples=200, num_classes=10, image_size=32)
+    assert np.array_equal(np.asarray(mmap_dataset.get_raw_image(5)), np.asarray(on_the_fly.get_raw_image(5)))
+
+    # several processes generate the same mmap file at once
+    root = tempfile.mkdtemp()
+    processes = [multiprocessing.Process(target=SyntheticDataset, kwargs=dict(root=root, num_samples=200, num_classes=10,
+                                                                               image_size=32, storage="mmap"))
+                 for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert all(p.exitcode == 0 for p in processes), "concurrent mmap generation failed"
+    assert os.listdir(root) == [os.path.basename(mmap_dataset.mmap_file)], "temporary files should be removed"
+    print("check passed.")
@@ -0,0 +1,341 @@
+import os
+import sys
+import json
+import importlib.util
+import torch
+import logging
+
+# utility
+from utils.loadConfig import load_cfg
+from utils.log_helper import init_log, add_file_handler
+
+# load model (more eazy way to get model.)
+from experiment.triplet_utils.load_model import load_model_test_yeild
+from experiment.triplet_utils.load_export import EXPORT_META_NAME, ONNX_INPUT_NAME, ONNX_OUTPUT_NAME, OnnxRuntimeModel
+
+# init logger
+logger = init_log("global")
+
+"""
+This file is implement for exporting the trained model to an inference artifact.
+"""
+
+def export_torchscript(model, export_path, image_size, meta=None, optimize=True, atol=1e-4):
+    """Export a TripletNetModel to a frozen TorchScript file.
+
+    The model is traced in eval mode, so the BatchNorm layers use the running
+    statistics and the final l2-normalization in the backbone's forward is
+    baked in the graph. Then the graph is frozen (parameters are inlined as
+    constants) and optimized for inference (conv-bn folding etc.).
+
+    Args:
+        model: (nn.Module)
+            loaded model, in most case is a TripletNetModel.
+        export_path: (str)
+            the '.pt' file path to save the exported model.
+        image_size: (int)
+            input image size used for tracing.
+        meta: (dict)
+            metadata to store with the model, can be read by 'load_torchscript_model'.
+        optimize: (bool)
+            wether run 'torch.jit.optimize_for_inference' on the frozen graph.
+            If the optimized graph can not run the example (e.g. the adaptive
+            pooling of Alexnet/VGG when the feature map is not divisible by the
+            pooling output), only the frozen graph is exported.
+        atol: (float)
+            max absolute difference allowed between the eager and exported output,
+            raise AssertionError if it is larger (the file is not saved).
+
+    Return:
+        The exported ScriptModule.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(export_path)), exist_ok=True)
+    model.eval()
+    device = next(model.parameters()).device
+    example_input = torch.randn(2, 3, image_size, image_size, device=device)
+
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_input)
+        frozen_model = torch.jit.freeze(traced_model)
+        if optimize:
+            try:
+                frozen_model = torch.jit.optimize_for_inference(frozen_model)
+                frozen_model(example_input)
+            except RuntimeError as e:
+                # e.g. the oneDNN adaptive pooling need the input size divisible by the output size,
+                # optimize_for_inference change the module in place, so freeze it again
+                logger.warning("\nWARNING: optimize_for_inference failed ({}), only freeze the model.\n".format(str(e).splitlines()[-1]))
+                frozen_model = torch.jit.freeze(traced_model)
+
+        # check the exported model have the same output with eager model
+        eager_output = model(example_input)
+        export_output = frozen_model(example_input)
+        max_diff = (eager_output - export_output).abs().max().item()
+        logger.info("\nExported model max output difference: {:.6f}\n".format(max_diff))
+    assert max_diff <= atol, "TorchScript output mismatch, max difference {:.6f} > {}".format(max_diff, atol)
+
+    extra_files = {EXPORT_META_NAME: json.dumps(meta if meta is not None else {})}
+    torch.jit.save(frozen_model, export_path, _extra_files=extra_files)
+
+    return frozen_model
+
+
+def export_onnx(model, export_path, image_size, meta=None, opset_version=13, atol=1e-4):
+    """Export a TripletNetModel to an ONNX file with dynamic batch axes.
+
+    The model is exported in eval mode, the final l2-normalization is included
+    in the graph. The input name is 'images' and the output name is 'embedding',
+    the batch dimention of both is dynamic. If onnxruntime is installed, the
+    exported file is checked by 'check_onnx_parity'.
+
+    Args:
+        model: (nn.Module)
+            loaded model, in most case is a TripletNetModel.
+        export_path: (str)
+            the '.onnx' file path to save the exported model.
+        image_size: (int)
+            input image size used for exporting.
+        meta: (dict)
+            metadata to store in the onnx model's metadata_props, can be read
+            by 'load_onnx_model'.
+        opset_version: (int)
+            onnx opset version.
+        atol: (float)
+            max absolute difference allowed by the parity check, raise
+            AssertionError if it is larger.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(export_path)), exist_ok=True)
+    model.eval()
+    device = next(model.parameters()).device
+    example_input = torch.randn(2, 3, image_size, image_size, device=device)
+
+    with torch.no_grad():
+        torch.onnx.export(model, example_input, export_path,
+                          input_names=[ONNX_INPUT_NAME],
+                          output_names=[ONNX_OUTPUT_NAME],
+                          dynamic_axes={ONNX_INPUT_NAME: {0: "batch"}, ONNX_OUTPUT_NAME: {0: "batch"}},
+                          opset_version=opset_version,
+                          do_constant_folding=True)
+
+    # store metadata, need the onnx package.
+    if meta is not None:
+        try:
+            import onnx
+            onnx_model = onnx.load(export_path)
+            entry = onnx_model.metadata_props.add()
+            entry.key = EXPORT_META_NAME
+            entry.value = json.dumps(meta)
+            onnx.save(onnx_model, export_path)
+        except ImportError:
+            logger.warning("\nWARNING: onnx is not installed, metadata is not saved in {}.\n".format(export_path))
+
+    # check the exported model have the same output with eager model, need the onnxruntime package.
+    if importlib.util.find_spec("onnxruntime") is None:
+        logger.warning("\nWARNING: onnxruntime is not installed, parity of {} is not checked.\n".format(export_path))
+        return
+    max_diff = check_onnx_parity(model, export_path, image_size, atol=atol)
+    logger.info("\nExported ONNX model max output difference: {:.6f}\n".format(max_diff))
+
+
+def check_onnx_parity(model, onnx_path, image_size, batch_sizes=(1, 3), atol=1e-4):
+    """Check the embeddings of onnxruntime match the eager model.
+
+    Different batch size is used to make sure the dynamic batch axes works.
+
+    Args:
+        model: (nn.Module)
+            the eager model that exported.
+        onnx_path: (str)
+            the exported '.onnx' file path.
+        image_size: (int)
+            input image size.
+        batch_sizes: (tuple of int)
+            batch sizes to check.
+        atol: (float)
+            max absolute difference allowed.
+
+    Return:
+        Max absolute difference of all the checks, raise AssertionError if it
+        is larger than atol.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    ort_model = OnnxRuntimeModel(onnx_path)
+
+    max_diff = 0
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            imgs = torch.randn(batch_size, 3, image_size, image_size, device=device)
+            eager_output = model(imgs)
+            ort_output = ort_model(imgs)
+            assert eager_output.shape == ort_output.shape, \
+                "Output shape mismatch: {} vs {}".format(tuple(eager_output.shape), tuple(ort_output.shape))
+            max_diff = max(max_diff, (eager_output - ort_output).abs().max().item())
+
+    assert max_diff <= atol, "ONNX Runtime output mismatch, max difference {:.6f} > {}".format(max_diff, atol)
+    return max_diff
+
+
+def _check_backbone_parity(backbone_name, tmp_folder, image_size, embedding_dim, atol, check_onnx):
+    """Export one backbone and check the parity, run in a new process by 'test_export_parity_all_backbones'."""
+    from model.model.triplet_model import TripletNetModel
+    from experiment.triplet_utils.get_backbone import get_backbone
+
+    cfg = {"backbone_name": backbone_name, "pretrained": False, "embedding_dim": embedding_dim}
+    model = TripletNetModel(get_backbone(cfg))
+    result = {"torchscript": "failed", "onnx": "skipped"}
+
+    # both exporters raise AssertionError if the output is different, check the others after a failure
+    try:
+        export_torchscript(model, os.path.join(tmp_folder, "{}_traced.pt".format(backbone_name)), image_size, atol=atol)
+        result["torchscript"] = "passed"
+    except Exception as e:
+        logger.error("\nERROR: {} TorchScript export failed: {}\n".format(backbone_name, e))
+    if check_onnx:
+        try:
+            export_onnx(model, os.path.join(tmp_folder, "{}.onnx".format(backbone_name)), image_size, atol=atol)
+            result["onnx"] = "passed"
+        except Exception as e:
+            result["onnx"] = "failed"
+            logger.error("\nERROR: {} ONNX export failed: {}\n".format(backbone_name, e))
+
+    # the exported files are not needed any more, keep the temp folder small
+    for file_name in os.listdir(tmp_folder):
+        os.remove(os.path.join(tmp_folder, file_name))
+    return result
+
+
+def test_export_parity_all_backbones(image_size=64, embedding_dim=128, atol=1e-4):
+    """Export every backbone in 'get_backbone' to TorchScript and ONNX and check the parity.
+
+    The backbones are random initialized (not pretrained), so this test can be
+    run offline. 64px is the smallest image size that all the backbones
+    support, it keeps the test fast (the graph is the same for any image size). Each
+    backbone is checked in a new process to keep the memory bounded.
+    Alexnet/VGG are only frozen at 64px (optimize_for_inference does not support
+    their adaptive pooling at this size). The ONNX part is skipped (and reported
+    as skipped, not passed) if onnx/onnxruntime is not installed
+    (pip install -r requirements-optional.txt).
+
+    Args:
+        image_size: (int) input image size.
+        embedding_dim: (int) output feature dimention.
+        atol: (float) max absolute difference allowed.
+
+    Return:
+        dict of {backbone name: {"torchscript": status, "onnx": status}}, the
+        status is "passed", "failed" or "skipped".
+    """
+    import tempfile
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    backbone_names = ["Alexnet",
+                      "VGG11", "VGG13", "VGG16", "VGG19",
+                      "Resnet18", "Resnet34", "Resnet50", "Resnet101", "Resnet152"]
+
+    check_onnx = importlib.util.find_spec("onnx") is not None and importlib.util.find_spec("onnxruntime") is not None
+    if not check_onnx:
+        logger.warning("\nWARNING: onnx or onnxruntime is not installed, the ONNX parity is SKIPPED "
+                       "(pip install -r requirements-optional.txt).\n")
+
+    # each backbone is checked in a new process, the memory of the big ones (VGG) is not given back after the export
+    results = {}
+    spawn_context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_folder, \
+            ProcessPoolExecutor(max_workers=1, mp_context=spawn_context, max_tasks_per_child=1) as executor:
+        for backbone_name in backbone_names:
+            try:
+                result = executor.submit(_check_backbone_parity, backbone_name, tmp_folder, image_size,
+                                         embedding_dim, atol, check_onnx).result()
+            except Exception as e:
+                result = {"torchscript": "failed", "onnx": "failed" if check_onnx else "skipped"}
+                logger.error("\nERROR: {} parity check crashed: {}\n".format(backbone_name, e))
+            results[backbone_name] = result
+            logger.info("\n{} export parity: TorchScript {}, ONNX {}.\n".format(backbone_name, result["torchscript"], result["onnx"]))
+
+    return results
+
+
+if __name__ == "__main__":
+    """
+    单独Export模型使用, 使用test的config文件
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export triplet network')
+
+    # config file name
+    parser.add_argument('--config_name', default='Arch_Dataset/Arch_Dataset_Resnet18_triplet_test.yml', type=str,
+                        help='name of config file')
+    parser.add_argument('--format', default='torchscript', choices=['torchscript', 'onnx', 'all'],
+                        help='format of the exported model')
+    parser.add_argument('--no_optimize', action='store_true',
+                        help='do not run optimize_for_inference on the frozen model')
+    parser.add_argument('--parity_test', action='store_true',
+                        help='only run the TorchScript & ONNX parity test of all backbones')
+
+    args = parser.parse_args()
+
+    # exit code 0 if all passed, 1 if any failed, 2 if nothing failed but some are skipped
+    if args.parity_test:
+        parity_results = test_export_parity_all_backbones()
+        statuses = [status for result in parity_results.values() for status in result.values()]
+        print("\n{:<12} {:<12} {}".format("backbone", "torchscript", "onnx"))
+        for backbone_name, result in parity_results.items():
+            print("{:<12} {:<12} {}".format(backbone_name, result["torchscript"], result["onnx"]))
+        if "failed" in statuses:
+            print("\nExport parity test FAILED.")
+            sys.exit(1)
+        if "skipped" in statuses:
+            print("\nExport parity test SKIPPED {} check(s), install onnx and onnxruntime (requirements-optional.txt).".format(statuses.count("skipped")))
+            sys.exit(2)
+        print("\nExport parity test passed.")
+        sys.exit(0)
+
+    # get config file name.
+    config_name = args.config_name
+
+    # get config folder
+    curernt_file_path = os.path.dirname(os.path.abspath(__file__))
+    experiment_config_folder = os.path.join(curernt_file_path, "config")
+
+    # get cfg file
+    cfg = load_cfg(experiment_config_folder, config_name)
+
+    # 要从cfg里加载的东西
+    experiment_name = cfg["experiment_name"]
+    backbone_name = cfg["backbone_name"]
+    embedding_dim = cfg["embedding_dim"]
+    image_size = cfg["image_size"]
+
+    # Create experiment folder structure
+    experiment_folder = os.path.join(curernt_file_path, "all_experiment", experiment_name)
+    experiment_export_folder = os.path.join(experiment_folder, "export")
+    os.makedirs(experiment_export_folder, exist_ok=True)
+
+    # get log
+    add_file_handler("global", os.path.join(experiment_folder, 'export.log'), level=logging.INFO)
+
+    # export on cpu, the exported model can be loaded to any device.
+    for model, start_epoch in load_model_test_yeild(cfg, False):
+        meta = {
+            "backbone_name": backbone_name,
+            "embedding_dim": embedding_dim,
+            "image_size": image_size,
+            "epoch": start_epoch,
+        }
+
+        if args.format in ["torchscript", "all"]:
+            export_name = "{}_epoch_{}_traced.pt".format(experiment_name, start_epoch)
+            export_path = os.path.join(experiment_export_folder, export_name)
+            export_torchscript(model, export_path, image_size, meta=meta, optimize=not args.no_optimize)
+            logger.info("\nExported TorchScript model to {}\n".format(export_path))
+
+        if args.format in ["onnx", "all"]:
+            export_name = "{}_epoch_{}.onnx".format(experiment_name, start_epoch)
+            export_path = os.path.join(experiment_export_folder, export_name)
+            export_onnx(model, export_path, image_size, meta=meta)
+            logger.info("\nExported ONNX model to {}\n".format(export_path))
+
+    logger.info("\nLoad the exported model by 'load_torchscript_model' or 'load_onnx_model' in experiment/triplet_utils/load_export.py\n")
@@ -8,8 +8,6 @@ import torch
 import logging
 import numpy as np
 import torch.nn.functional as F
-from torch.utils.tensorboard import SummaryWriter
-from utils.average_meter_helper import AverageMeter
 
 from PIL import Image
 from io import BytesIO
@@ -17,9 +15,11 @@ from torchvision.transforms import ToTensor
 
 # metric
 from experiment.test_utils.metric import AP_N
+from experiment.test_utils.extract import extract_embeddings
 
 from utils.loadConfig import load_cfg
-from utils.log_helper import init_log, add_file_handler, print_speed
+from utils.log_helper import init_log, add_file_handler
+from utils.board_helper import BufferedSummaryWriter
 
 # get method
 from experiment.triplet_utils.get_loss import get_loss
@@ -29,6 +29,10 @@ from experiment.triplet_utils.get_dataloader import get_train_dataloader
 
 # load model (more eazy way to get model.)
 from experiment.triplet_utils.load_model import load_model_test, load_model_test_yeild
+from experiment.triplet_utils.load_export import load_onnx_model
+from experiment.export import export_onnx
+from experiment.triplet_utils.quantize_model import quantize_model_ptq, get_model_size
+from experiment.triplet_utils.cpu_optimize_model import set_thread_number, fuse_model_inference, convert_channels_last
 
 # plt
 import matplotlib.pyplot as plt
@@ -40,12 +44,13 @@ logger = init_log("global")
 This file is implement for calculating the MAP@5/10/50/100 for the dataset from model.
 """
 
-def test_model(model, test_dataloader, log_interval, device):
+def test_model(model, test_dataloader, log_interval, device, channels_last=False, autocast_bf16=False):
     """Test and Return the feature vector of all sample in dataset with its index.
 
+    The embedding is extracted by 'extract_embeddings' (inference mode, the
+    final partial batch is included), then packed into the sample protocal.
+
     Args:
-        cfg: (dict) 
-            config file of the test precedure.
         model: (nn.module)
             loaded model
         test_dataloader: (torch.Dataloader)
@@ -59,8 +64,13 @@ def test_model(model, test_dataloader, log_interval, device):
                             "index" : index,
                         }
                 }
-        writer: (tensorboard writer)
+        log_interval: (int)
+            How many batch will the logger log once.
         device: cuda or cpu
+        channels_last: (bool)
+            use channels_last memory format for the forward.
+        autocast_bf16: (bool)
+            use bfloat16 autocast for the forward.
 
     Return:
         a list of dict:[
@@ -83,60 +93,23 @@ def test_model(model, test_dataloader, log_interval, device):
             }] 
     """
     logger.info("\n------------------------- Start Forwarding Dataset -------------------------\n")
-    
-    # epoch average meter
-    avg_test = AverageMeter()
 
-    # get test batch count
-    current_test_batch = 0
-    total_test_batch = len(test_dataloader)
+    features, classes, indexes = extract_embeddings(model, test_dataloader, device, log_interval=log_interval,
+                                                    channels_last=channels_last, autocast_bf16=autocast_bf16)
 
     # to return list
     out_sample_list = []
-    for batch_idx, batch_sample in enumerate(test_dataloader):
-        # Skip last iteration to avoid the problem of having different number of tensors while calculating
-        # averages (sizes of tensors must be the same for pairwise distance calculation)
-        if batch_idx + 1 == len(test_dataloader):
-            continue
-        batch_size = test_dataloader.batch_size
-
-        # switch to evaluation mode.
-        for param in model.parameters():
-            param.requires_grad = False
-        model.eval()
-
-        # start time counting
-        batch_start_time_test = time.time()
-
-        # Forward pass - compute embeddings
-        imgs = batch_sample["img"]
-        cls = batch_sample["cls"]
-        indexs = batch_sample["other"]["index"]
-
-        imgs = imgs.to(device)
-
-        out_put = model(imgs)
-
-        out_put.to("cpu")
-
-        for i in range(batch_size):
-            out_dict = {
-                "cls": cls[i],
-                "feature": out_put[i],
-                "other": {
-                    "index" : indexs[i]
-                    },
-            }
-            out_sample_list.append(out_dict)
-        
-        # batch time & batch count
-        current_test_batch += 1
-        batch_time = time.time() - batch_start_time_test
+    for i in range(features.size(0)):
+        out_dict = {
+            "cls": classes[i],
+            "feature": features[i],
+            "other": {
+                "index" : indexes[i]
+                },
+        }
+        out_sample_list.append(out_dict)
 
-        if current_test_batch % log_interval == 0:            
-                print_speed(current_test_batch, batch_time, total_test_batch, "global")
-    else:
-        logger.info("\n------------------------- End Forwarding Dataset -------------------------\n")
+    logger.info("\n------------------------- End Forwarding Dataset -------------------------\n")
 
     return out_sample_list
 
@@ -506,10 +479,28 @@ if __name__ == "__main__":
     dont_use_cuda = cfg["dont_use_cuda"]
     # log的设置
     log_interval = cfg["log_interval"]
+    # 推理后端的设置
+    inference_backend = cfg.get("inference_backend", "torch")
+    reuse_model = cfg.get("reuse_model", False)
+    prefetch_checkpoint = cfg.get("prefetch_checkpoint", False)
+    # 提取特征的设置
+    extract_cfg = cfg.get("extract", {})
+    extract_channels_last = extract_cfg.get("channels_last", False)
+    extract_bf16 = extract_cfg.get("bf16", False)
+    # 量化的设置
+    quantize_cfg = cfg.get("quantize", {"enable": False})
+    # conv+bn融合 & 线程数的设置
+    cpu_optimize_cfg = cfg.get("cpu_optimize", {})
+    fuse_conv_bn = cpu_optimize_cfg.get("fuse_conv_bn", False)
+    fuse_backend = cpu_optimize_cfg.get("fuse_backend", "jit")
 
     # set cuda
     cuda = not dont_use_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if cuda else "cpu")
+    if not cuda:
+        intra_op_threads, inter_op_threads = set_thread_number(cpu_optimize_cfg.get("intra_op_threads", 0),
+                                                               cpu_optimize_cfg.get("inter_op_threads", 0))
+        logger.info("\nUsing {} intra-op threads, {} inter-op threads.\n".format(intra_op_threads, inter_op_threads))
 
     # set seed 
     torch.manual_seed(experiment_seed)
@@ -522,13 +513,15 @@ if __name__ == "__main__":
     experiment_folder = os.path.join(curernt_file_path, "all_experiment", experiment_name)
     experiment_snap_folder = os.path.join(experiment_folder, "snap")
     experiment_board_folder = os.path.join(experiment_folder, "board_test")
+    experiment_export_folder = os.path.join(experiment_folder, "export")
     os.makedirs(experiment_folder, exist_ok=True)
     os.makedirs(experiment_snap_folder, exist_ok=True)
     os.makedirs(experiment_board_folder, exist_ok=True)
+    os.makedirs(experiment_export_folder, exist_ok=True)
 
 
     # init board writer
-    writer = SummaryWriter(experiment_board_folder)
+    writer = BufferedSummaryWriter(experiment_board_folder)
 
     # get log
     add_file_handler("global", os.path.join(experiment_folder, 'test.log'), level=logging.INFO)
@@ -550,10 +543,44 @@ if __name__ == "__main__":
     mAP_10s = []
 
 
+    # example batch to trace the jit fused model, fetched once (a new iterator resets the persistent workers)
+    example_inputs = None
+    if fuse_conv_bn and inference_backend == "torch" and fuse_backend == "jit":
+        example_inputs = next(iter(train_dataloader))["img"]
+
     # Test all models, and store the result in the lists
-    for model, start_epoch in load_model_test_yeild(cfg, cuda):
+    for model, start_epoch in load_model_test_yeild(cfg, cuda, reuse_model=reuse_model, prefetch=prefetch_checkpoint):
+        # use onnxruntime to extract the embedding
+        if inference_backend == "onnxruntime":
+            onnx_path = os.path.join(experiment_export_folder, "{}_epoch_{}.onnx".format(experiment_name, start_epoch))
+            onnx_meta = {
+                "backbone_name": cfg["backbone_name"],
+                "embedding_dim": cfg["embedding_dim"],
+                "image_size": cfg["image_size"],
+                "epoch": start_epoch,
+            }
+            # export once per checkpoint, reuse the file (e.g. exported by export.py) if the metadata match
+            onnx_model, exported_meta = load_onnx_model(onnx_path) if os.path.exists(onnx_path) else (None, None)
+            if exported_meta != onnx_meta:
+                export_onnx(model, onnx_path, cfg["image_size"], meta=onnx_meta)
+                onnx_model, _ = load_onnx_model(onnx_path)
+            model = onnx_model
+            logger.info("\nUsing onnxruntime backend: {}\n".format(onnx_path))
+
+        # fold the conv+bn for inference, the unfused model is kept for the quantization
+        inference_model = model
+        if fuse_conv_bn and inference_backend == "torch":
+            inference_model = fuse_model_inference(model, example_inputs, backend=fuse_backend,
+                                                   channels_last=extract_channels_last)
+        elif extract_channels_last and inference_backend == "torch":
+            # in place, no-op for the reused model after the first checkpoint
+            inference_model = convert_channels_last(model)
+
         # start validte model
-        output_sample_list = test_model(model, train_dataloader, log_interval, device)
+        forward_start_time = time.time()
+        output_sample_list = test_model(inference_model, train_dataloader, log_interval, device,
+                                        channels_last=extract_channels_last, autocast_bf16=extract_bf16)
+        forward_time = time.time() - forward_start_time
         """
         {
             "cls": class label of the sample,
@@ -582,6 +609,37 @@ if __name__ == "__main__":
         logger.info("MAP@500: {}".format(mAP_500))
         writer.add_scalar("MAP@500", mAP_500, start_epoch)
 
+        # post-training int8 quantization, compare with the float model
+        if quantize_cfg["enable"] and inference_backend == "torch":
+            logger.info("\n------------------------- Quantizing model -------------------------\n")
+            quantized_model = quantize_model_ptq(model, train_dataloader,
+                                                 calib_number=quantize_cfg.get("calib_number", 256),
+                                                 backend=quantize_cfg.get("backend", "x86"))
+
+            # quantized model only run on cpu
+            quantized_start_time = time.time()
+            quantized_sample_list = test_model(quantized_model, train_dataloader, log_interval, torch.device("cpu"))
+            quantized_time = time.time() - quantized_start_time
+
+            quantized_mAP_10 = evaluate_all_map(quantized_sample_list, sample_number=50, N=10, random_seed=experiment_seed)
+            quantized_mAP_100 = evaluate_all_map(quantized_sample_list, sample_number=50, N=100, random_seed=experiment_seed)
+
+            float_throughput = len(output_sample_list) / forward_time
+            quantized_throughput = len(quantized_sample_list) / quantized_time
+            float_size = get_model_size(model) / 1024 / 1024
+            quantized_size = get_model_size(quantized_model) / 1024 / 1024
+
+            logger.info("\n quantization result:\n throughput: {0:.2f} -> {1:.2f} img/s ({2}) -> (cpu) | model size: {3:.2f} -> {4:.2f} MB\n MAP@10: {5:.5f} -> {6:.5f} (delta {7:+.5f}) | MAP@100: {8:.5f} -> {9:.5f} (delta {10:+.5f})\n".format(
+                float_throughput, quantized_throughput, device.type, float_size, quantized_size,
+                mAP_10, quantized_mAP_10, quantized_mAP_10 - mAP_10,
+                mAP_100, quantized_mAP_100, quantized_mAP_100 - mAP_100))
+            writer.add_scalar("Quantize/MAP@10", quantized_mAP_10, start_epoch)
+            writer.add_scalar("Quantize/MAP@100", quantized_mAP_100, start_epoch)
+            writer.add_scalar("Quantize/MAP@10_delta", quantized_mAP_10 - mAP_10, start_epoch)
+            writer.add_scalar("Quantize/MAP@100_delta", quantized_mAP_100 - mAP_100, start_epoch)
+            writer.add_scalars("Quantize/throughput", {"float": float_throughput, "int8": quantized_throughput}, start_epoch)
+            writer.add_scalars("Quantize/model_size_MB", {"float": float_size, "int8": quantized_size}, start_epoch)
+
         # add one epoch to all list
         output_sample_lists.append(output_sample_list)
         mAP_500s.append(mAP_500)
@@ -615,3 +673,6 @@ if __name__ == "__main__":
     logger.info("best epoch mAP@100: {}".format(best_epoch_mAp_100))
     logger.info("best epoch mAP@500: {}".format(best_epoch_mAp_500))
 
+    # write the buffered board value
+    writer.close()
+
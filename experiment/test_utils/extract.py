@@ -0,0 +1,91 @@
+import time
+import torch
+
+from utils.log_helper import init_log, print_speed
+
+logger = init_log("global")
+
+
+def extract_embeddings(model, dataloader, device, log_interval=100, channels_last=False, autocast_bf16=False):
+    """Extract the embedding of all sample in a non-triplet dataloader.
+
+    The model is switched to eval mode once before the loop (and switched back
+    after), and the forward runs under torch.inference_mode, so no autograd
+    graph is recorded. The output of each batch is copied into a preallocated
+    cpu buffer, the final partial batch is also included.
+
+    Args:
+        model: (nn.Module)
+            loaded model, can be a TripletNetModel or any model that map
+            [B, 3, H, W] images to [B, D] embedding.
+        dataloader: (torch.Dataloader)
+            A non-triplet dataloader, it's sample protocal is:
+                {
+                    "img": target image,
+                    "cls": target class,
+                    "other": other information,
+                        {
+                            "index" : index,
+                        }
+                }
+        device: (torch.device)
+            device that model compute on.
+        log_interval: (int)
+            How many batch will the logger log once.
+        channels_last: (bool)
+            use channels_last memory format for the input. The model is not
+            copied or changed here, convert it once before (e.g. by
+            convert_channels_last), a warning is logged if its conv weights are
+            not channels_last.
+        autocast_bf16: (bool)
+            run the forward under bfloat16 autocast, the output is stored as float32.
+
+    Return:
+        features: (Tensor) [N, D] float32 embedding on cpu.
+        classes: (Tensor) [N] class label of each sample.
+        indexes: (Tensor) [N] index of each sample in the dataset.
+    """
+    was_training = model.training
+    model.eval()
+    if channels_last and any(p.dim() == 4 and not p.is_contiguous(memory_format=torch.channels_last) for p in model.parameters()):
+        logger.warning("\nWARNING: the model is not channels_last, only the input is converted.\n")
+
+    total_sample = len(dataloader.dataset)
+    total_batch = len(dataloader)
+
+    # buffer is allocated after the first batch, when the embedding dimention is known.
+    features = None
+    classes = torch.empty(total_sample, dtype=torch.long)
+    indexes = torch.empty(total_sample, dtype=torch.long)
+    offset = 0
+
+    with torch.inference_mode():
+        for batch_idx, batch_sample in enumerate(dataloader):
+            batch_start_time = time.time()
+
+            imgs = batch_sample["img"].to(device, non_blocking=True)
+            if channels_last:
+                imgs = imgs.contiguous(memory_format=torch.channels_last)
+
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=autocast_bf16):
+                out_put = model(imgs)
+
+            batch_size = out_put.size(0)
+            if features is None:
+                features = torch.empty(total_sample, out_put.size(1), dtype=torch.float32)
+
+            features[offset:offset + batch_size].copy_(out_put)
+            classes[offset:offset + batch_size].copy_(torch.as_tensor(batch_sample["cls"]))
+            indexes[offset:offset + batch_size].copy_(torch.as_tensor(batch_sample["other"]["index"]))
+            offset += batch_size
+
+            if (batch_idx + 1) % log_interval == 0:
+                print_speed(batch_idx + 1, time.time() - batch_start_time, total_batch, "global")
+
+    model.train(was_training)
+
+    if features is None:
+        features = torch.empty(0, 0, dtype=torch.float32)
+
+    # the sampler may not go through the whole dataset.
+    return features[:offset], classes[:offset], indexes[:offset]
@@ -1,3 +1,6 @@
+import torch
+
+
 
 def P_N(label_result: list, N):
     """
@@ -43,7 +46,64 @@ def AP_N(label_result: list, N):
     if len(true_idx) != 0:
         result = result / len(true_idx)
     return result
-    
+
+
+def retrieval_metrics(features, classes, ks=(10, 100), block_size=1024):
+    """
+    Calculate the mAP@K and recall@K of all sample by blocked vectorized ranking.
+
+    Every sample is used as query once, the database is all the other samples
+    (the query itself is excluded, same as 'evaluate_one' in test.py). The
+    distance of [block_size, N] query-database pairs is computed at once, so
+    the memory is O(block_size * N) instead of O(N * N).
+
+    The AP@K of a query is the same as 'AP_N' of its ranked label list, the
+    recall@K is 1 if at least one of the top K result has the query's class.
+
+    Args:
+        features: (Tensor) [N, D] embedding of all samples.
+        classes: (Tensor) [N] class label of all samples.
+        ks: (list of int) the K to evaluate, must smaller than N.
+        block_size: (int) number of queries ranked at once.
+
+    Return:
+        dict of {"mAP@K": value, "recall@K": value} for each K.
+    """
+    features = features.float()
+    classes = classes.long()
+    num_sample = features.size(0)
+    max_k = max(ks)
+    assert max_k < num_sample, "K must smaller than sample number!"
+
+    ap_sum = {k: 0.0 for k in ks}
+    recall_sum = {k: 0.0 for k in ks}
+    rank = torch.arange(1, max_k + 1, dtype=torch.float, device=features.device)
+
+    for start in range(0, num_sample, block_size):
+        end = min(start + block_size, num_sample)
+
+        # exclude the query itself
+        dist = torch.cdist(features[start:end], features)
+        rows = torch.arange(end - start, device=features.device)
+        dist[rows, rows + start] = float("inf")
+
+        _, top_index = dist.topk(max_k, dim=1, largest=False)
+        label = (classes[top_index] == classes[start:end].unsqueeze(1)).float()
+
+        for k in ks:
+            label_k = label[:, :k]
+            precision = label_k.cumsum(dim=1) / rank[:k]
+            num_true = label_k.sum(dim=1)
+            ap = (precision * label_k).sum(dim=1) / num_true.clamp(min=1)
+            ap_sum[k] += ap.sum().item()
+            recall_sum[k] += (num_true > 0).float().sum().item()
+
+    result = {}
+    for k in ks:
+        result["mAP@{}".format(k)] = ap_sum[k] / num_sample
+        result["recall@{}".format(k)] = recall_sum[k] / num_sample
+    return result
+
 
 if __name__ == "__main__":
     # test 
@@ -56,4 +116,15 @@ if __name__ == "__main__":
     # 0.52
     print(test_result_2)
 
-
+    # blocked metric is the same as AP_N on each ranked list
+    features = torch.randn(300, 16)
+    classes = torch.randint(0, 5, (300,))
+    result = retrieval_metrics(features, classes, ks=(10, 50), block_size=64)
+    ap = []
+    for i in range(300):
+        dist = torch.cdist(features[i:i + 1], features)[0]
+        dist[i] = float("inf")
+        order = dist.argsort()[:-1]
+        ap.append(AP_N((classes[order] == classes[i]).int().tolist(), 10))
+    print(result, sum(ap) / len(ap))
+    assert abs(result["mAP@10"] - sum(ap) / len(ap)) < 1e-6
@@ -1,39 +1,65 @@
 import os
+import copy
 import torch
 import time
+import contextlib
 import logging
 import argparse
 import torch.nn as nn
-from torch.utils.tensorboard import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel
 
 # get method & model validation
-from experiment.validate import validation
+from experiment.validate import validation, retrieval_validation, BackgroundValidator
 from model.model.triplet_model import TripletNetModel
 from experiment.triplet_utils.get_loss import get_loss
+from model.loss.xbm_loss import XBMTripletLoss
 from experiment.triplet_utils.get_backbone import get_backbone
 from experiment.triplet_utils.get_optimizer import get_optimizer
-from experiment.triplet_utils.get_dataloader import get_train_dataloader
+from experiment.triplet_utils.get_dataloader import get_train_dataloader, build_dataloader
+from experiment.triplet_utils.get_mixed_precision import get_mixed_precision
+from experiment.triplet_utils.cpu_optimize_model import set_thread_number, convert_channels_last
 
 # utility
 from omegaconf import OmegaConf
 from utils.loadConfig import load_cfg
-from utils.average_meter_helper import AverageMeter
+from utils.average_meter_helper import TensorAverageMeter
 from utils.log_helper import init_log, add_file_handler, print_speed
+from utils.board_helper import BufferedSummaryWriter
+from utils.checkpoint_helper import AsyncCheckpointWriter, load_checkpoint
+from utils.early_stop_helper import MetricTracker
+from utils.profile_helper import PhaseTimer, get_profiler
+from utils.dataloader_helper import InstrumentedDataLoader
+from dataloader.sampler.hard_negative_miner import HardNegativeMiner
+from dataloader.sampler.class_centroid_cache import ClassCentroidCache
+from utils.distributed_helper import init_distributed, is_main_process, set_cpu_threads, cleanup_distributed, broadcast_flag, broadcast_object
 
 
-def set_model_gpu_mode(model, cuda):
+def set_model_gpu_mode(model, cuda, distributed=False, local_rank=0):
     """decide wether train on multi GPU
 
     If train on multi GPU, the model need to be warrped by dataparallel.
+    If train with multi process (torch.distributed), the model is warrped by
+    DistributedDataParallel, on cpu (gloo) or on the local_rank's GPU.
     
     Args:
         model: input model, is a nn.Moudle
         cuda: bool, wether use cuda.
+        distributed: bool, wether use DistributedDataParallel.
+        local_rank: the process index on this machine.
     """
     flag_train_gpu = torch.cuda.is_available() & cuda
     flag_train_multi_gpu = False
 
-    if flag_train_gpu and torch.cuda.device_count() > 1:
+    if distributed:
+        if flag_train_gpu:
+            model.cuda(local_rank)
+            model = DistributedDataParallel(model, device_ids=[local_rank])
+        else:
+            model = DistributedDataParallel(model)
+        flag_train_multi_gpu = True
+        logger.info('\nUsing distributed training on {}.\n'.format("gpu" if flag_train_gpu else "cpu"))
+
+    elif flag_train_gpu and torch.cuda.device_count() > 1:
         model = nn.DataParallel(model)
         model.cuda()
         flag_train_multi_gpu = True
@@ -49,6 +75,178 @@ def set_model_gpu_mode(model, cuda):
     return model, flag_train_multi_gpu
 
 
+def forward_backward_triplet(model, loss, anc_imgs, pos_imgs, neg_imgs, autocast, scaler,
+                             micro_batch_size=0, loss_scale=1.0, sync_gradient=True, timer=None, output_hook=None,
+                             loss_inputs=None):
+    """Forward and backward one triplet batch, split into micro-batches.
+
+    Each micro-batch is forwarded and backwarded immediately, so only the
+    activations of one micro-batch ([3 x micro_batch_size, ...]) are stored at
+    once. The gradient is accumulated in the parameters, the optimizer step is
+    done by the caller.
+
+    With "mean" reduction, the loss of each micro-batch is weighted by its size,
+    so the gradient is the same as forwarding the whole batch (except the
+    BatchNorm statistics is computed on each micro-batch).
+
+    Args:
+        model: the (wrapped) TripletNetModel.
+        loss: loss function.
+        anc_imgs, pos_imgs, neg_imgs: triplet images of the batch.
+        autocast: function that return the autocast context.
+        scaler: GradScaler for the loss.
+        micro_batch_size: size of micro-batch, 0 for not split.
+        loss_scale: extra scale of the loss, e.g. 1/(number of batches in the accumulation group).
+        sync_gradient: wether all-reduce the gradient after this batch (for 
+            DistributedDataParallel), set False when accumulating.
+        timer: PhaseTimer to record the "forward" and "backward" time.
+        output_hook: function called with (output, start, end) of each
+            micro-batch, e.g. to update the class centroid cache.
+        loss_inputs: dict of extra per-sample tensors of the loss (e.g. anchor_cls,
+            neg_cls for the cross-batch memory loss), sliced by micro-batch.
+
+    Return:
+        detached loss, pos_dists, neg_dists averaged over the batch.
+    """
+    batch_size = anc_imgs.size(0)
+    if micro_batch_size <= 0:
+        micro_batch_size = batch_size
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    if loss_inputs is None:
+        loss_inputs = {}
+
+    loss_value_sum = 0
+    pos_dists_sum = 0
+    neg_dists_sum = 0
+
+    for start in range(0, batch_size, micro_batch_size):
+        end = min(start + micro_batch_size, batch_size)
+        is_last_micro_batch = end == batch_size
+
+        # skip the gradient all-reduce until the last micro-batch of the step
+        if isinstance(model, DistributedDataParallel) and not (sync_gradient and is_last_micro_batch):
+            sync_context = model.no_sync()
+        else:
+            sync_context = contextlib.nullcontext()
+
+        with sync_context:
+            # forward & loss compute, under autocast if use mixed precision
+            with timer.phase("forward"), autocast():
+                output = model(anc_imgs[start:end], pos_imgs[start:end], neg_imgs[start:end])
+                loss_value = loss(output['anchor_map'], output['pos_map'], output['neg_map'],
+                                  **{k: v[start:end] for k, v in loss_inputs.items()})
+
+            micro_weight = (end - start) / batch_size if loss.reduction == "mean" else 1.0
+            with timer.phase("backward"):
+                scaler.scale(loss_value * micro_weight * loss_scale).backward()
+
+        if output_hook is not None:
+            output_hook(output, start, end)
+
+        loss_value_sum += loss_value.detach() * micro_weight
+        pos_dists_sum += output['dist_pos'].detach().sum()
+        neg_dists_sum += output['dist_neg'].detach().sum()
+
+    return loss_value_sum, pos_dists_sum / batch_size, neg_dists_sum / batch_size
+
+
+def make_centroid_hook(centroid_cache, pos_cls, neg_cls):
+    """Build the output hook of 'forward_backward_triplet' that update the class centroids.
+
+    Args:
+        centroid_cache: ClassCentroidCache to update.
+        pos_cls: [B] class of the anchor (and positive) of the batch.
+        neg_cls: [B] class of the negative of the batch.
+
+    Return:
+        output_hook(output, start, end), update the centroids by the anchor and
+        negative embeddings of the micro-batch [start, end).
+    """
+    def output_hook(output, start, end):
+        centroid_cache.update(torch.cat([output['anchor_map'], output['neg_map']]),
+                              torch.cat([pos_cls[start:end], neg_cls[start:end]]))
+    return output_hook
+
+
+def set_background_validation_metric(checkpoint_writer, results, retrieval_select_metric=None):
+    """Set the metric of the checkpoints validated by BackgroundValidator.
+
+    Args:
+        checkpoint_writer: AsyncCheckpointWriter that saved the checkpoints.
+        results: list of (epoch, checkpoint_path, val_triplet_loss, retrieval_result).
+        retrieval_select_metric: name of the retrieval metric to select the best
+            checkpoint, None to use the validation loss.
+
+    Return:
+        list of (epoch, checkpoint_path, metric).
+    """
+    metrics = []
+    for epoch, checkpoint_path, val_triplet_loss, retrieval_result in results:
+        if retrieval_select_metric is not None and retrieval_result is not None:
+            metric = retrieval_result[retrieval_select_metric]
+        else:
+            metric = val_triplet_loss
+        logger.info("\nBackground validation of epoch {} finished, metric: {}\n".format(epoch + 1, metric))
+        # also release the pending checkpoint when the metric is None
+        checkpoint_writer.set_metric(checkpoint_path, metric)
+        metrics.append((epoch, checkpoint_path, metric))
+    return metrics
+
+
+def update_metric_tracker(tracker, epoch, metric, metric_name):
+    """Update the metric tracker with the validation metric of an epoch.
+
+    Args:
+        tracker: MetricTracker of the validation metric.
+        epoch: epoch of the checkpoint.
+        metric: validation metric of the checkpoint, None if not validated.
+        metric_name: name of the metric, used in the log.
+
+    Return:
+        True if the metric is the new best.
+    """
+    if tracker.update(metric, epoch):
+        return True
+    if metric is not None:
+        logger.info("\nNo improvement of {} for {} validations (best {:.5f} at epoch {}).\n".format(
+            metric_name, tracker.num_bad_updates, tracker.best, tracker.best_epoch + 1))
+    return False
+
+
+def link_best_checkpoint(checkpoint_writer, epoch, checkpoint_path, metric, metric_name):
+    """Link the checkpoint as best.pt (best.ckpt), after it is written.
+
+    The link is queued in the checkpoint writer after the checkpoint's save, so
+    the training does not wait for the write.
+
+    Args:
+        checkpoint_writer: AsyncCheckpointWriter that saved the checkpoint.
+        epoch: epoch of the checkpoint.
+        checkpoint_path: path of the checkpoint.
+        metric: validation metric of the checkpoint.
+        metric_name: name of the metric, written in best.json.
+    """
+    checkpoint_writer.link_best(checkpoint_path, {"epoch": epoch + 1, "metric_name": metric_name, "metric": metric})
+    logger.info("\nNew best {}: {:.5f} at epoch {}, link {} as best\n".format(metric_name, metric, epoch + 1, checkpoint_path))
+
+
+def track_best_checkpoint(tracker, checkpoint_writer, epoch, checkpoint_path, metric, metric_name, save_best=True):
+    """Update the metric tracker, link the checkpoint as best.pt if it is the new best.
+
+    Args:
+        tracker: MetricTracker of the validation metric.
+        checkpoint_writer: AsyncCheckpointWriter that saved the checkpoint.
+        epoch: epoch of the checkpoint.
+        checkpoint_path: path of the checkpoint.
+        metric: validation metric of the checkpoint, None if not validated.
+        metric_name: name of the metric, written in best.json.
+        save_best: wether link the best checkpoint as best.pt.
+    """
+    if update_metric_tracker(tracker, epoch, metric, metric_name) and save_best:
+        link_best_checkpoint(checkpoint_writer, epoch, checkpoint_path, metric, metric_name)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Train triplet network')
 
@@ -79,9 +277,31 @@ if __name__ == "__main__":
     resume_name = cfg["resume_name"]         
     experiment_seed = cfg["experiment_seed"]
     dont_use_cuda = cfg["dont_use_cuda"]
+    mixed_precision = cfg.get("mixed_precision", False)
+    # channels_last & 线程数的设置
+    cpu_optimize_cfg = cfg.get("cpu_optimize", {})
+    channels_last = cpu_optimize_cfg.get("channels_last", False)
+    # 分布式训练的设置
+    distributed = cfg.get("distributed", False)
+    dist_backend = cfg.get("dist_backend", "gloo")
+    # 梯度累积的设置
+    accumulation_steps = cfg.get("accumulation_steps", 1)
+    micro_batch_size = cfg.get("micro_batch_size", 0)
+    # checkpoint的设置
+    checkpoint_format = cfg.get("checkpoint_format", "pt")
+    # triplet schedule的设置
+    save_triplet_schedule = cfg.get("save_triplet_schedule", False)
+    replay_triplet_schedule = cfg.get("replay_triplet_schedule", False)
     # validation的设置
     validate_model = cfg["validate_model"]
     val_interval = cfg["val_interval"]
+    retrieval_cfg = cfg.get("retrieval_validation", {})
+    retrieval_validate = retrieval_cfg.get("enable", False)
+    retrieval_ks = list(retrieval_cfg.get("ks", [10, 100]))
+    retrieval_select_metric = retrieval_cfg.get("select_metric", "mAP@{}".format(retrieval_ks[0]))
+    # best checkpoint & 提前停止的设置
+    early_stopping_cfg = cfg.get("early_stopping", {})
+    save_best = early_stopping_cfg.get("save_best", True)
     # log的设置
     log_interval = cfg["log_interval"]
     # 用来保存模型一些信息
@@ -93,13 +313,24 @@ if __name__ == "__main__":
     experiment_folder = os.path.join(curernt_file_path, "all_experiment", experiment_name)
     experiment_snap_folder = os.path.join(experiment_folder, "snap")
     experiment_board_folder = os.path.join(experiment_folder, "board_train")
+    experiment_schedule_folder = os.path.join(experiment_folder, "schedule")
     os.makedirs(experiment_folder, exist_ok=True)
     os.makedirs(experiment_snap_folder, exist_ok=True)
     os.makedirs(experiment_board_folder, exist_ok=True)
+    os.makedirs(experiment_schedule_folder, exist_ok=True)
 
-    # get log
+    # init distributed training, the process is launched by torchrun.
+    rank, world_size, local_rank = 0, 1, 0
+    if distributed:
+        rank, world_size, local_rank = init_distributed(dist_backend, cfg.get("dist_timeout_minutes", 30))
+    is_main = is_main_process()
+
+    # get log, only the main process write log file.
     logger = init_log("global")
-    add_file_handler("global", os.path.join(experiment_folder, 'train.log'), level=logging.INFO)
+    if is_main:
+        add_file_handler("global", os.path.join(experiment_folder, 'train.log'), level=logging.INFO)
+    else:
+        logger.setLevel(logging.WARNING)
 
     # 将加载的cfg打印出来
     logger.info("\n Config file name {}.\n Config parameter: \n{}\n".format(config_name, OmegaConf.to_yaml(cfg)))
@@ -107,14 +338,44 @@ if __name__ == "__main__":
     # set cuda
     cuda = not dont_use_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if cuda else "cpu")
-
-    # set seed 
-    torch.manual_seed(experiment_seed)
+    if distributed and cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+    if distributed and not cuda:
+        num_threads = set_cpu_threads()
+        logger.info("\nDistributed training with {} processes, {} threads per process.\n".format(world_size, num_threads))
+    if not cuda:
+        intra_op_threads, inter_op_threads = set_thread_number(cpu_optimize_cfg.get("intra_op_threads", 0),
+                                                               cpu_optimize_cfg.get("inter_op_threads", 0))
+        logger.info("\nUsing {} intra-op threads, {} inter-op threads.\n".format(intra_op_threads, inter_op_threads))
+
+    # set seed, each process use a different seed to sample different triplets.
+    # (the model parameters are broadcasted from rank 0 by DistributedDataParallel)
+    torch.manual_seed(experiment_seed + rank)
     if cuda:
-        torch.cuda.manual_seed(experiment_seed)
-
-    # init board writer
-    writer = SummaryWriter(experiment_board_folder)
+        torch.cuda.manual_seed(experiment_seed + rank)
+
+    # init board writer, only on main process (the writer does nothing on other process).
+    writer = BufferedSummaryWriter(experiment_board_folder,
+                                   flush_steps=cfg.get("board_flush_steps", 50),
+                                   flush_secs=cfg.get("board_flush_secs", 10),
+                                   aggregate=cfg.get("board_aggregate", False),
+                                   enabled=is_main)
+
+    # init checkpoint writer, the checkpoint is written in a background thread.
+    # the best checkpoint is selected by the retrieval metric (higher is better) or the validation loss.
+    checkpoint_writer = AsyncCheckpointWriter(keep_last=cfg.get("checkpoint_keep_last", 0),
+                                              keep_best=cfg.get("checkpoint_keep_best", 1),
+                                              mode="max" if retrieval_validate else "min",
+                                              async_write=cfg.get("checkpoint_async", True),
+                                              checkpoint_format=checkpoint_format)
+    checkpoint_extension = ".ckpt" if checkpoint_format == "split" else ".pt"
+
+    # track the best validation metric, stop when it does not improve for 'patience' validations.
+    metric_name = retrieval_select_metric if retrieval_validate else "val_triplet_loss"
+    tracker = MetricTracker(mode="max" if retrieval_validate else "min",
+                            patience=early_stopping_cfg.get("patience", 10) if early_stopping_cfg.get("enable", False) else 0,
+                            min_delta=early_stopping_cfg.get("min_delta", 0.0))
 
     """
     Load dataset, model, optimizer, loss, load into gpu.
@@ -124,15 +385,30 @@ if __name__ == "__main__":
     dataset_pre_processing = []
     train_dataloader, test_dataloader = get_train_dataloader(cfg=cfg,
                                                             use_cuda=cuda, 
-                                                            pre_process_transform=dataset_pre_processing)
+                                                            pre_process_transform=dataset_pre_processing,
+                                                            distributed=distributed)
+
+    # non-triplet dataloader of the test split for retrieval validation, the workers are kept between epochs.
+    retrieval_dataloader = None
+    if retrieval_validate and is_main and test_dataloader is not None:
+        test_dataset = test_dataloader.dataset
+        retrieval_dataloader = build_dataloader(getattr(test_dataset, "inner_dataset", test_dataset), cfg, cuda)
 
     # Instantiate model
     model = get_backbone(cfg=cfg)
 
     model = TripletNetModel(model)
 
+    # NHWC memory format, the input images are also converted in the training loop
+    if channels_last:
+        model = convert_channels_last(model)
+        logger.info("\nUsing channels_last memory format.\n")
+
     # Load model to GPU or multiple GPUs if available
-    model, flag_train_multi_gpu = set_model_gpu_mode(model, cuda)
+    model, flag_train_multi_gpu = set_model_gpu_mode(model, cuda, distributed, local_rank)
+
+    # model without DataParallel/DistributedDataParallel wrapper
+    model_without_wrapper = model.module if flag_train_multi_gpu else model
 
     # Set optimizer
     optimizer_model = get_optimizer(cfg=cfg,
@@ -141,6 +417,21 @@ if __name__ == "__main__":
     # Set loss function
     loss = get_loss(cfg=cfg)
 
+    # Set mixed precision
+    autocast, scaler = get_mixed_precision(cfg=cfg, device=device)
+
+    # validate in a background process, the training continue immediately after each epoch
+    background_cfg = cfg.get("background_validation", {})
+    validator = None
+    if background_cfg.get("enable", False) and is_main and test_dataloader is not None:
+        # the cfg from load_cfg is a plain dict, send a copy to the process
+        validator = BackgroundValidator(copy.deepcopy(cfg), model_without_wrapper,
+                                        test_dataloader.dataset if validate_model else None,
+                                        retrieval_dataloader.dataset if retrieval_dataloader is not None else None,
+                                        os.path.join(experiment_folder, "board_validate_background"),
+                                        queue_size=background_cfg.get("queue_size", 1),
+                                        num_threads=background_cfg.get("num_threads", 2))
+
     """
     Resume model, optimizer, epoch from pretrained snap.
     """
@@ -149,19 +440,28 @@ if __name__ == "__main__":
     start_epoch = 0
     resume_path = os.path.join(experiment_snap_folder, resume_name)
     if resume_name:
-        if os.path.isfile(resume_path):
+        if os.path.exists(resume_path):
             logger.info("\nLoading checkpoint {} in {} ...\n".format(resume_name, experiment_folder))
 
-        checkpoint = torch.load(resume_path)
+        checkpoint = load_checkpoint(resume_path, map_location=device)
         start_epoch = checkpoint['epoch']
 
         optimizer_model.load_state_dict(checkpoint['optimizer_model_state_dict'])
 
+        if 'scaler_state_dict' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
+
+        if 'metric_tracker_state_dict' in checkpoint:
+            tracker.load_state_dict(checkpoint['metric_tracker_state_dict'])
+
+        # state of the loss (e.g. the optimizer step count of triplet_xbm)
+        if 'loss_state_dict' in checkpoint:
+            loss.load_state_dict(checkpoint['loss_state_dict'])
+        if isinstance(loss, XBMTripletLoss):
+            logger.info("\nResume triplet_xbm loss at iteration {}, the cross-batch memory is empty and will be filled again.\n".format(int(loss.iters)))
+
         # In order to load state dict for optimizers correctly, model has to be loaded to gpu first
-        if flag_train_multi_gpu:
-            model.module.load_state_dict(checkpoint['model_state_dict'])
-        else:
-            model.load_state_dict(checkpoint['model_state_dict'])
+        model_without_wrapper.load_state_dict(checkpoint['model_state_dict'])
 
         logger.info("\nCheckpoint loaded: start epoch from checkpoint epoch = {}\n".format(start_epoch))
     else:
@@ -180,24 +480,111 @@ if __name__ == "__main__":
     current_batch = 0
     batch_time = 0
 
+    # optimizer step count (a step is made every accumulation_steps batches)
+    current_step = 0
+
+    logger.info("\nEffective batch size: {} (batch size {} x accumulation steps {} x processes {}), micro batch size: {}\n".format(
+        batch_size * accumulation_steps * world_size, batch_size, accumulation_steps, world_size, micro_batch_size if micro_batch_size > 0 else batch_size))
+
+    # phase timing & torch.profiler, the trace is saved in the experiment folder
+    profile_cfg = cfg.get("profile", {})
+    profiler = get_profiler(profile_cfg, os.path.join(experiment_folder, "profile")) if is_main else None
+    timer = PhaseTimer(enabled=profile_cfg.get("enable", False),
+                       sync_cuda=profile_cfg.get("sync_cuda", False),
+                       record_function=profiler is not None)
+    if profiler is not None:
+        profiler.start()
+
+    # offline hard negative mining in a background process, only on the main process
+    # (the tables are broadcasted to the other process)
+    mining_cfg = cfg.get("hard_negative_mining", {})
+    mining_enable = mining_cfg.get("enable", False)
+    miner = None
+    if mining_enable and is_main:
+        miner = HardNegativeMiner(top_m=mining_cfg.get("top_m", 10),
+                                  batch_size=mining_cfg.get("batch_size", batch_size),
+                                  block_size=mining_cfg.get("block_size", 1024),
+                                  num_threads=mining_cfg.get("num_threads", 2))
+
+    # running class centroid, the negative class is drawn by the centroid similarity
+    # (each process keep the centroid of its own batches)
+    centroid_cfg = cfg.get("centroid_negative", {})
+    centroid_cache = None
+    if centroid_cfg.get("enable", False):
+        centroid_cache = ClassCentroidCache(train_dataloader.dataset.class_values,
+                                            momentum=centroid_cfg.get("momentum", 0.9),
+                                            temperature=centroid_cfg.get("temperature", 0.1))
+
     for epoch in range(start_epoch, end_epoch):
-        # init avg meter
+        # early stopping is decided on the main process, and broadcasted to the others
+        # (only the main process validate, the tracker of the other process is empty)
+        if broadcast_flag(tracker.should_stop, device):
+            if is_main:
+                logger.info("\nEarly stopping at epoch {}: {} does not improve for {} validations, best {:.5f} at epoch {}.\n".format(
+                    epoch + 1, metric_name, tracker.num_bad_updates, tracker.best, tracker.best_epoch + 1))
+            else:
+                logger.info("\nEarly stopping at epoch {}.\n".format(epoch + 1))
+            break
+
+        timer.reset()
+        epoch_start_time = time.time()
+
+        # init avg meter, the loss is accumulated on device and only read on log_interval
         # avg.update(time=1.1, accuracy=.99)
-        avg = AverageMeter()
+        avg = TensorAverageMeter(window=log_interval)
 
         # start training epoch
         logger.info("\n------------------------- Start Training {} Epoch -------------------------\n".format(epoch + 1))
+        # switch to train mode
+        model.train()
+
+        # shuffle the distributed sampler differently on each epoch
+        if distributed:
+            train_dataloader.sampler.set_epoch(epoch)
+
+        train_dataset = train_dataloader.dataset
+
+        # apply the hard triplet tables mined in background, and start a new mining every interval epochs.
+        # (rank 0 does not wait for the mining, it broadcasts the tables or None if they are not ready,
+        # so that all process switch to the same tables at the same epoch and keep the previous ones until then)
+        if mining_enable:
+            hard_tables = miner.poll() if miner is not None else None
+            hard_tables = broadcast_object(hard_tables)
+            if hard_tables is not None:
+                train_dataset.set_hard_tables(*hard_tables, hard_ratio=mining_cfg.get("hard_ratio", 0.5))
+                logger.info("\nUsing mined hard triplets from epoch {}.\n".format(epoch + 1))
+            if miner is not None and epoch > start_epoch and (epoch - start_epoch) % mining_cfg.get("interval", 2) == 0:
+                miner.start(model_without_wrapper, train_dataset.inner_dataset)
+
+        # O(C^2) refresh of the negative class probability by the centroids of last epoch
+        if centroid_cache is not None:
+            neg_class_probs = centroid_cache.refresh()
+            if neg_class_probs is not None:
+                train_dataset.set_negative_class_probs(neg_class_probs)
+
+        # draw the triplet schedule of this epoch (same seed on all process), or replay a saved one
+        if getattr(train_dataset, "schedule", None) is not None:
+            schedule_path = os.path.join(experiment_schedule_folder, "epoch_{}.npy".format(epoch + 1))
+            if replay_triplet_schedule and os.path.isfile(schedule_path):
+                train_dataset.load_schedule(schedule_path)
+                logger.info("\nReplay triplet schedule {}\n".format(schedule_path))
+            else:
+                train_dataset.set_epoch(epoch)
+            if save_triplet_schedule and is_main:
+                train_dataset.save_schedule(schedule_path)
+
+        # clear the gradient before the first accumulation step
+        optimizer_model.zero_grad()
+
+        data_start_time = time.perf_counter()
         for batch_idx, batch_sample in enumerate(train_dataloader):
             # Skip last iteration to avoid the problem of having different number of tensors while calculating
             # averages (sizes of tensors must be the same for pairwise distance calculation)
             if batch_idx + 1 == len(train_dataloader):
                 continue
 
-            # switch to train mode
-            for param in model.parameters():
-                param.requires_grad = True
-            model.train()
-
+            # time waiting for the dataloader
+            timer.record("data", time.perf_counter() - data_start_time)
             batch_start_time = time.time()
 
             # Forward pass - compute embeddings
@@ -207,83 +594,181 @@ if __name__ == "__main__":
 
             pos_cls = batch_sample['pos_cls']
             neg_cls = batch_sample['neg_cls']
+            anc_index = batch_sample['other']['anchor_index']
+            neg_index = batch_sample['other']['neg_index']
 
             # move to gpu if use cuda
-            anc_imgs = anc_imgs.to(device)
-            pos_imgs = pos_imgs.to(device)
-            neg_imgs = neg_imgs.to(device)
-            pos_cls = pos_cls.to(device)
-            neg_cls = neg_cls.to(device)
-
-            # forward
-            output = model.forward_triplet(anc_imgs, pos_imgs, neg_imgs)
-            
-            # get output 
-            anc_emb = output['anchor_map']
-            pos_emb = output['pos_map']
-            neg_emb = output['neg_map']
-
-            pos_dists = torch.mean(output['dist_pos'])
-            neg_dists = torch.mean(output['dist_neg'])
-
-            # loss compute
-            loss_value = loss(anc_emb, pos_emb, neg_emb)
-
-            # Backward pass
-            optimizer_model.zero_grad()
-            loss_value.backward()
-            optimizer_model.step()
+            with timer.phase("data"):
+                memory_format = torch.channels_last if channels_last else torch.preserve_format
+                anc_imgs = anc_imgs.to(device, memory_format=memory_format)
+                pos_imgs = pos_imgs.to(device, memory_format=memory_format)
+                neg_imgs = neg_imgs.to(device, memory_format=memory_format)
+                pos_cls = pos_cls.to(device)
+                neg_cls = neg_cls.to(device)
+                anc_index = anc_index.to(device)
+                neg_index = neg_index.to(device)
+
+            # classes & indexes of the triplets, only the triplet_xbm loss use them
+            loss_inputs = None
+            if isinstance(loss, XBMTripletLoss):
+                loss_inputs = {"anchor_cls": pos_cls, "neg_cls": neg_cls, "anchor_index": anc_index, "neg_index": neg_index}
+
+            # one [C, D] centroid update per micro-batch, from the anchor and negative embeddings
+            output_hook = make_centroid_hook(centroid_cache, pos_cls, neg_cls) if centroid_cache is not None else None
+
+            # update the parameter every accumulation_steps batch (and on the last batch of the epoch)
+            is_step_batch = (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 2 == len(train_dataloader)
+
+            # with mean reduction, the loss of each batch is averaged over the batches of its accumulation group,
+            # the last group of the epoch may be smaller (the last batch of the dataloader is skipped)
+            group_start = batch_idx - batch_idx % accumulation_steps
+            group_size = min(accumulation_steps, len(train_dataloader) - 1 - group_start)
+            accumulation_loss_scale = 1.0 / group_size if loss.reduction == "mean" else 1.0
+
+            # forward & backward by micro-batch, the gradient is accumulated in the parameter
+            loss_value, pos_dists, neg_dists = forward_backward_triplet(model, loss, anc_imgs, pos_imgs, neg_imgs,
+                                                                        autocast, scaler, micro_batch_size,
+                                                                        loss_scale=accumulation_loss_scale,
+                                                                        sync_gradient=is_step_batch,
+                                                                        timer=timer,
+                                                                        output_hook=output_hook,
+                                                                        loss_inputs=loss_inputs)
+
+            # Optimizer step, the loss is scaled only for float16
+            if is_step_batch:
+                with timer.phase("optimizer"):
+                    scaler.step(optimizer_model)
+                    scaler.update()
+                    optimizer_model.zero_grad()
+                current_step += 1
+                # triplet_xbm counts the warmup by optimizer step
+                if isinstance(loss, XBMTripletLoss):
+                    loss.step()
 
             current_batch +=1
             batch_time = time.time() - batch_start_time
 
+            # no device sync here, the detached tensors are accumulated by the meter
             avg.update(time=batch_time, triplet_loss=loss_value, pos_dists=pos_dists, neg_dists=neg_dists)
-            writer.add_scalar("Train_Batch/Loss/train_loss", loss_value, global_step=current_batch)
-            writer.add_scalar("Train_Batch/Distance/pos_dists", pos_dists, global_step=current_batch)
-            writer.add_scalar("Train_Batch/Distance/neg_dists", neg_dists, global_step=current_batch)
-            writer.add_scalar("Train_Batch_Global_AVG/loss", avg.triplet_loss.avg, global_step=current_batch)
-            writer.add_scalar("Train_Batch_Global_AVG/pos_dists", avg.pos_dists.avg, global_step=current_batch)
-            writer.add_scalar("Train_Batch_Global_AVG/neg_dists", avg.neg_dists.avg, global_step=current_batch)
-
-            # log to logger
+
+            # log to logger & board, the value is read from device only here
             if current_batch % log_interval == 0:
-                print_speed(current_batch, batch_time, total_batch, "global")
-                logger.info("\n current batch information:\n epoch: {0} | batch_time {1:5f} | triplet_loss: {2:.5f} | pos_dists: {3:.5f} | neg_dists: {4:.5f} \n".format(epoch + 1, avg.time.val, avg.triplet_loss.val, avg.pos_dists.val, avg.neg_dists.val))
-                logger.info("\n current global average information:\n epoch: {0} | batch_time {1:5f} | triplet_loss: {2:.5f} | pos_dists: {3:.5f} | neg_dists: {4:.5f} \n".format(epoch + 1, avg.time.avg, avg.triplet_loss.avg, avg.pos_dists.avg, avg.neg_dists.avg))
+                with timer.phase("logging"):
+                    # board is counted by optimizer step, the value is averaged over the last log_interval batches
+                    writer.add_scalar("Train_Batch/Loss/train_loss", avg.triplet_loss.window_avg, global_step=current_step)
+                    writer.add_scalar("Train_Batch/Distance/pos_dists", avg.pos_dists.window_avg, global_step=current_step)
+                    writer.add_scalar("Train_Batch/Distance/neg_dists", avg.neg_dists.window_avg, global_step=current_step)
+                    writer.add_scalar("Train_Batch_EMA/loss", avg.triplet_loss.ema, global_step=current_step)
+                    writer.add_scalar("Train_Batch_Global_AVG/loss", avg.triplet_loss.avg, global_step=current_step)
+                    writer.add_scalar("Train_Batch_Global_AVG/pos_dists", avg.pos_dists.avg, global_step=current_step)
+                    writer.add_scalar("Train_Batch_Global_AVG/neg_dists", avg.neg_dists.avg, global_step=current_step)
+
+                    print_speed(current_batch, batch_time, total_batch, "global")
+                    logger.info("\n current batch information:\n epoch: {0} | step: {7} | batch_time {1:5f} | triplet_loss: {2:.5f} | pos_dists: {3:.5f} | neg_dists: {4:.5f} | throughput: {5:.2f} triplets/s ({6}) \n".format(epoch + 1, avg.time.val, avg.triplet_loss.val, avg.pos_dists.val, avg.neg_dists.val, batch_size / avg.time.avg, "mixed precision" if mixed_precision else "fp32", current_step))
+                    logger.info("\n current global average information:\n epoch: {0} | batch_time {1:5f} | triplet_loss: {2:.5f} | pos_dists: {3:.5f} | neg_dists: {4:.5f} \n".format(epoch + 1, avg.time.avg, avg.triplet_loss.avg, avg.pos_dists.avg, avg.neg_dists.avg))
+
+            timer.step(batch_size)
+            if profiler is not None:
+                profiler.step()
+            data_start_time = time.perf_counter()
         else:
+            # waiting time of dataloader in this epoch (the stats is reset on every process)
+            if isinstance(train_dataloader, InstrumentedDataLoader):
+                train_dataloader.log_stats(writer, global_step=epoch)
+
+            # only the main process write board, validate and save the model.
+            if not is_main:
+                continue
+
             # add epoch avg
             writer.add_scalar("Train/Loss/train", avg.triplet_loss.avg, global_step=epoch)
             writer.add_scalar("Train/Other/train_pos_dists", avg.pos_dists.avg, global_step=epoch)
             writer.add_scalar("Train/Other/train_neg_dists", avg.neg_dists.avg, global_step=epoch)
 
-            # validate on each epoch
-            if validate_model and epoch % val_interval == 0 and test_dataloader is not None:
-                val_triplet_loss, val_pos_dists, val_neg_dists = validation(epoch, log_interval, test_dataloader, model, loss, writer, device)
+            # per-phase time of the epoch
+            if timer.enabled:
+                logger.info("\n epoch {} phase time:\n{}\n".format(epoch + 1, timer.summary_table()))
+                timer.write_board(writer, global_step=epoch)
+
+            checkpoint_path = os.path.join(experiment_snap_folder, '{}_epoch_{}{}'.format(experiment_name, epoch + 1, checkpoint_extension))
+
+            # validate on each epoch, the retrieval metric (or the validation loss) is used to keep the best checkpoint
+            val_triplet_loss = None
+            val_retrieval_metric = None
+            metric_pending = False
+            # results of the earlier epochs, polled before submitting this epoch
+            background_results = validator.poll() if validator is not None else []
+            if validator is not None and epoch % val_interval == 0:
+                # the metric of the checkpoint is set when the background result arrive, keep it until then
+                metric_pending = validator.submit(epoch, model_without_wrapper.state_dict(), checkpoint_path)
+
+            if validator is None and validate_model and epoch % val_interval == 0 and test_dataloader is not None:
+                val_triplet_loss, val_pos_dists, val_neg_dists = validation(epoch, log_interval, test_dataloader, model_without_wrapper, loss, writer, device)
 
                 writer.add_scalars("Contrast/Loss/train", {"Train":avg.triplet_loss.avg, "Validate": val_triplet_loss}, global_step=epoch)
                 writer.add_scalars("Contrast/Other/train_pos_dists", {"Train": avg.pos_dists.avg, "Validate": val_pos_dists}, global_step=epoch)
                 writer.add_scalars("Contrast/Other/train_neg_dists", {"Train": avg.neg_dists.avg, "Validate": val_neg_dists}, global_step=epoch)
 
+            if validator is None and retrieval_dataloader is not None and epoch % val_interval == 0:
+                train_epoch_time = time.time() - epoch_start_time
+                retrieval_start_time = time.time()
+                retrieval_result = retrieval_validation(epoch, log_interval, retrieval_dataloader, model_without_wrapper, writer, device,
+                                                        ks=retrieval_ks, block_size=retrieval_cfg.get("block_size", 1024))
+                val_retrieval_metric = retrieval_result[retrieval_select_metric]
+                logger.info("\nRetrieval validation time: {0:.2f}s ({1:.1f}% of the epoch time {2:.2f}s)\n".format(
+                    time.time() - retrieval_start_time, 100 * (time.time() - retrieval_start_time) / train_epoch_time, train_epoch_time))
+
+        # update the metric tracker before saving, so the checkpoint has the tracker state of this epoch
+        val_metric = val_retrieval_metric if retrieval_validate else val_triplet_loss
+        if validator is None:
+            new_best = [(epoch, checkpoint_path, val_metric)] if update_metric_tracker(tracker, epoch, val_metric, metric_name) else []
+        else:
+            new_best = [(val_epoch, val_checkpoint_path, val_epoch_metric)
+                        for val_epoch, val_checkpoint_path, val_epoch_metric in set_background_validation_metric(
+                            checkpoint_writer, background_results, retrieval_select_metric if retrieval_validate else None)
+                        if update_metric_tracker(tracker, val_epoch, val_epoch_metric, metric_name)]
+
         # Save model checkpoint
         state = {
             'epoch': epoch + 1,
             'embedding_dimension': embedding_dim,
             'batch_size_training': batch_size,
-            'model_state_dict': model.state_dict(),
+            'model_state_dict': model_without_wrapper.state_dict(),
             'model_architecture': backbone_name,
             'optimizer_model_state_dict': optimizer_model.state_dict()
         }
 
-        # For storing data parallel model's state dictionary without 'module' parameter
-        if flag_train_multi_gpu:
-            state['model_state_dict'] = model.module.state_dict()
+        if scaler.is_enabled():
+            state['scaler_state_dict'] = scaler.state_dict()
 
-        # Save model checkpoint
-        torch.save(state, os.path.join(experiment_snap_folder, '{}_epoch_{}.pt').format(experiment_name, epoch + 1))
+        state['metric_tracker_state_dict'] = tracker.state_dict()
+        state['loss_state_dict'] = loss.state_dict()
+
+        # Save model checkpoint, copy to cpu here and write in background
+        checkpoint_writer.save(state, checkpoint_path, metric=val_metric, metric_pending=metric_pending)
+
+        # link the last new best (written by now, or by an earlier epoch)
+        if save_best and new_best:
+            link_best_checkpoint(checkpoint_writer, *new_best[-1], metric_name)
 
     logger.info("\nFinish training from epoch {} to epoch {}! (Total {} epoch, {} batches.)\n".format(start_epoch, end_epoch, train_epochs, current_batch))
     logger.info("\nExperiment folder is {} \nSnap File is in {} \nrun 'tensorboard --logdir {}  --bind_all' to see training detail~\n".format(experiment_folder, experiment_snap_folder, experiment_board_folder))
 
+    if profiler is not None:
+        profiler.stop()
+    if miner is not None:
+        miner.close()
+    # wait for the last background validation
+    if validator is not None:
+        for val_epoch, val_checkpoint_path, val_metric in set_background_validation_metric(checkpoint_writer, validator.close(),
+                                                                                           retrieval_select_metric if retrieval_validate else None):
+            track_best_checkpoint(tracker, checkpoint_writer, val_epoch, val_checkpoint_path, val_metric, metric_name, save_best)
+
+    # wait for the checkpoint & write the buffered board value
+    checkpoint_writer.close()
+    writer.close()
+    cleanup_distributed()
+
 
     # TODO:
     # 1. 增加模型表现的tensorboard展示 ✅
@@ -0,0 +1,171 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.fx.experimental.optimization as fx_optimization
+
+from utils.log_helper import init_log
+from model.model.triplet_model import TripletNetModel
+
+logger = init_log("global")
+
+
+def set_thread_number(intra_op_threads=0, inter_op_threads=0):
+    """Set the intra-op and inter-op thread number of torch.
+
+    intra-op threads parallelize one operator (e.g. a convolution by oneDNN),
+    inter-op threads run independent operators at the same time (only used by
+    torch.jit). 0 keeps the default of torch.
+
+    The inter-op thread number can only be set once, before any inter-op
+    parallel work is started, otherwise the current value is kept.
+
+    Args:
+        intra_op_threads: (int) torch.set_num_threads, 0 for default.
+        inter_op_threads: (int) torch.set_num_interop_threads, 0 for default.
+
+    Return:
+        (intra_op_threads, inter_op_threads) currently used by torch.
+    """
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0 and inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            logger.warning("\nWARNING: inter-op threads can only be set before parallel work started, keep {}.\n".format(
+                torch.get_num_interop_threads()))
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def convert_channels_last(model):
+    """Convert the 4D parameters and buffers of the model to channels_last (NHWC) in place.
+
+    oneDNN (cpu) and cudnn (gpu with tensor core) run the convolution in NHWC
+    natively, with NCHW input the activation is reordered before and after
+    each convolution. The input images should also be converted by
+    imgs.contiguous(memory_format=torch.channels_last), the output of the
+    convolution keep the format of the input.
+
+    Args:
+        model: (nn.Module) input model.
+
+    Return:
+        the same model.
+    """
+    return model.to(memory_format=torch.channels_last)
+
+
+class FrozenBackbone(nn.Module):
+    """
+    Wrap a frozen ScriptModule as a backbone.
+
+    The frozen module has no 'training' attribute and always runs in eval mode,
+    so train()/eval() only set the flag of the wrapper and do not go into it.
+
+    Args:
+        script_module: frozen (and optimized) ScriptModule.
+    """
+    def __init__(self, script_module):
+        super(FrozenBackbone, self).__init__()
+        self.script_module = script_module
+
+    def train(self, mode=True):
+        """only set the flag of the wrapper"""
+        self.training = mode
+        return self
+
+    def forward(self, x):
+        return self.script_module(x)
+
+
+def fuse_model_inference(model, example_inputs=None, backend="jit", channels_last=False):
+    """Fuse the conv+bn(+relu) of a TripletNetModel for inference.
+
+    backend "jit" (default, for cpu): the backbone is traced by torch.jit,
+    frozen and optimized by torch.jit.optimize_for_inference, the conv+bn is
+    folded and the conv+relu/add are fused into oneDNN kernels. The traced
+    model only supports the inference, and needs 'example_inputs' (with the
+    image size used later). If the oneDNN graph can not run the example (e.g.
+    the adaptive pooling of Alexnet/VGG when the feature map is smaller than
+    the pooling output), the model is only frozen. On gpu the "fx" backend is
+    used instead.
+
+    backend "fx": the backbone is traced by torch.fx and each Conv2d followed
+    by a BatchNorm2d is folded into one Conv2d (the BatchNorm2d is removed).
+    Only conv+bn is folded, the relu is not fused. The result is still a
+    nn.Module, it works on cpu and gpu.
+
+    The folding uses the running statistics of the BatchNorm, so the result is
+    only valid in eval mode. The original model is not modified.
+
+    Args:
+        model: (nn.Module)
+            A TripletNetModel or a backbone model.
+        example_inputs: (Tensor)
+            [B, 3, H, W] example images for the jit tracing.
+        backend: (str)
+            "fx" or "jit".
+        channels_last: (bool)
+            convert the fused model to channels_last memory format.
+
+    Return:
+        A fused TripletNetModel in eval mode.
+    """
+    if isinstance(model, TripletNetModel):
+        backbone = model.backbone
+    else:
+        backbone = model
+
+    if backend not in ("fx", "jit"):
+        raise NotImplementedError("Please specific a valid fuse backend")
+
+    device = next(backbone.parameters()).device
+    if backend == "jit" and device.type != "cpu":
+        logger.warning("\nWARNING: jit fuse backend is optimized for cpu, use fx instead.\n")
+        backend = "fx"
+    assert backend == "fx" or example_inputs is not None, "example_inputs is needed by the jit fuse backend"
+
+    backbone = copy.deepcopy(backbone).eval()
+    fused_backbone = fx_optimization.fuse(backbone, inplace=True)
+    if channels_last:
+        fused_backbone = convert_channels_last(fused_backbone)
+
+    if backend == "jit":
+        example_inputs = example_inputs.to(device)
+        if channels_last:
+            example_inputs = example_inputs.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            traced_backbone = torch.jit.trace(fused_backbone, example_inputs)
+            try:
+                script_module = torch.jit.optimize_for_inference(torch.jit.freeze(traced_backbone))
+                script_module(example_inputs)
+            except RuntimeError as e:
+                # e.g. the oneDNN adaptive pooling need the input size divisible by the output size
+                logger.warning("\nWARNING: optimize_for_inference failed ({}), only freeze the model.\n".format(str(e).splitlines()[-1]))
+                script_module = torch.jit.freeze(traced_backbone)
+            fused_backbone = FrozenBackbone(script_module)
+
+    logger.info("\nFused conv+bn of the model for inference with {} backend{}.\n".format(
+        backend, ", channels_last" if channels_last else ""))
+
+    return TripletNetModel(fused_backbone).eval()
+
+
+if __name__ == "__main__":
+    """
+    Check the fused model has the same output as the eager model.
+    """
+    from experiment.triplet_utils.get_backbone import get_backbone
+
+    print("threads (intra, inter):", set_thread_number(2, 0))
+
+    imgs = torch.randn(4, 3, 64, 64)
+    for backbone_name in ["Alexnet", "VGG11", "Resnet18"]:
+        model = TripletNetModel(get_backbone({"backbone_name": backbone_name, "pretrained": False, "embedding_dim": 128})).eval()
+        with torch.no_grad():
+            expect = model(imgs)
+            for backend in ["fx", "jit"]:
+                fused_model = fuse_model_inference(model, imgs, backend=backend, channels_last=True)
+                output = fused_model(imgs.contiguous(memory_format=torch.channels_last))
+                assert torch.allclose(expect, output, atol=1e-4), "{} {} output is different".format(backbone_name, backend)
+    print("check passed.")
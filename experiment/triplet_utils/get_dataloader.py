@@ -1,25 +1,121 @@
 from torchvision import transforms
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from dataloader.mnist.dataloader_mnist import MNIST
 from dataloader.fashion_mnist.dataloader_fashion_mnist import Fashion_MNIST
 from dataloader.arch_dataset.dataloader_arch_dataset import ArchDatset
+from dataloader.synthetic.dataloader_synthetic import SyntheticDataset
 from dataloader.sampler.triplet_sampler import TripletSampler
 
 from utils.log_helper import init_log
+from utils.dataloader_helper import instrument_dataloader, seed_worker, share_dataset_memory
 
 logger = init_log("global")
 
-def get_train_dataloader(cfg: dict, use_cuda, pre_process_transform=[]):
+# dataset name: (dataset class, wether warp in TripletSampler)
+DATASET_DICT = {
+    "MNIST_triplet": (MNIST, True),
+    "MNIST": (MNIST, False),
+    "Fashion_MNIST_triplet": (Fashion_MNIST, True),
+    "Fashion_MNIST": (Fashion_MNIST, False),
+    "Arch_Dataset_triplet": (ArchDatset, True),
+    "Arch_Dataset": (ArchDatset, False),
+    "Synthetic_triplet": (SyntheticDataset, True),
+    "Synthetic": (SyntheticDataset, False),
+}
+
+
+def get_transform(dataset_name, image_size, pre_process_transform=[]):
+    """get the default transform of the dataset
+
+    Args:
+        dataset_name: (str) name of the dataset.
+        image_size: (int) output image size.
+        pre_process_transform: transforms before the default transforms.
+
+    Return:
+        transforms.Compose of the dataset.
+    """
+    if dataset_name.startswith("MNIST") or dataset_name.startswith("Fashion_MNIST"):
+        # gray image to 3 channel
+        default_transform = [
+                transforms.Grayscale(3),
+                transforms.Resize(image_size),
+                transforms.ToTensor(),
+                transforms.Normalize((0.1307,), (0.3081,)),
+        ]
+    else:
+        default_transform = [
+                transforms.Resize(image_size),
+                transforms.ToTensor(),
+                transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5)),
+        ]
+    return transforms.Compose(pre_process_transform + default_transform)
+
+
+def build_dataloader(dataset, cfg: dict, use_cuda, sampler=None):
+    """build a DataLoader with the config's loading setting
+
+    The workers are reseeded by worker_init_fn so that the 'random' module
+    give different sample on each worker. With persistent_workers the workers
+    are kept alive between epochs (and between validations).
+
+    Args:
+        dataset: dataset to load.
+        cfg: Dict class that contains following parameter:
+
+            batch_size    : (int) size of one batch that dataset generate
+            num_workers    : (int) multiprocess load dataset
+            persistent_workers : (bool, optional) keep the workers alive between epochs, default is True.
+            prefetch_factor : (int, optional) batches loaded in advance by each worker, default is 2.
+        use_cuda: wether use pin memory.
+        sampler: sampler of the dataloader, default is None.
+
+    Return:
+        A DataLoader.
+    """
+    num_workers = cfg["num_workers"]
+
+    kwargs = {}
+    if num_workers > 0:
+        kwargs["persistent_workers"] = cfg.get("persistent_workers", True)
+        kwargs["prefetch_factor"] = cfg.get("prefetch_factor", 2)
+
+    return DataLoader(dataset, batch_size=cfg["batch_size"], num_workers=num_workers, pin_memory=use_cuda,
+                      sampler=sampler, worker_init_fn=seed_worker, **kwargs)
+
+
+def get_train_dataloader(cfg: dict, use_cuda, pre_process_transform=[], distributed=False):
     """select the dataset, warp them in triplet dataset.
 
     select the dataset according to the config's, current support:
 
-    ["MNIST_triplet", "MNIST", "Fashion_MNIST_triplet", "Fashion_MNIST", "Arch_Dataset_triplet", "Arch_Dataset"]
+    ["MNIST_triplet", "MNIST", "Fashion_MNIST_triplet", "Fashion_MNIST", "Arch_Dataset_triplet", "Arch_Dataset",
+     "Synthetic_triplet", "Synthetic"]
+
+    The synthetic dataset is generated by the 'synthetic_dataset' config entry
+    (num_samples, num_classes, class_skew, seed, storage, see SyntheticDataset),
+    its image size is the 'image_size' of the config.
 
     If the dataset dont have test version, just return None for test_loader.
 
+    If distributed is True, the train dataloader use a DistributedSampler to 
+    split the dataset to each process, call train_loader.sampler.set_epoch(epoch)
+    at the start of each epoch to shuffle. The test dataloader is not splited.
+
+    The tensors of the dataset (the whole dataset is loaded in memory) are moved
+    to shared memory, so they are not copied when the workers are started.
+
+    If dataloader_telemetry is True in the config, the dataloaders are wrapped
+    by InstrumentedDataLoader, which record the waiting time of each batch, the
+    queue depth of workers, the speed of each worker and the transform time,
+    call dataloader.log_stats(writer, global_step) to report them.
+
     Args:
         cfg: Dict class that must contains required parameter.
+        use_cuda: wether use pin memory.
+        pre_process_transform: transforms before the default transforms.
+        distributed: wether use DistributedSampler for train dataloader.
 
     Return:
         A dataloader that defined by following config entry:
@@ -28,6 +124,13 @@ def get_train_dataloader(cfg: dict, use_cuda, pre_process_transform=[]):
             batch_size    : (int) size of one batch that dataset generate
             image_size   : (int) output image size
             num_workers    : (int) multiprocess load dataset
+            persistent_workers : (bool, optional) keep the workers alive between epochs, default is True.
+            prefetch_factor : (int, optional) batches loaded in advance by each worker, default is 2.
+            share_memory : (bool, optional) move the dataset tensors to shared memory, default is True.
+            triplet_schedule : (bool, optional) precompute the triplet index of each epoch, default is False.
+            dataloader_telemetry : (bool, optional) wether record the loading time, default is False.
+            stall_threshold : (float, optional) waiting time (second) that count as a stall, default is 0.05.
+            synthetic_dataset : (dict, optional) parameters of SyntheticDataset.
     """
 
     # check cfg
@@ -37,128 +140,48 @@ def get_train_dataloader(cfg: dict, use_cuda, pre_process_transform=[]):
 
     # get patten from config file
     dataset_name = cfg["dataset_name"]
-    batch_size = cfg["batch_size"]
-    num_workers = cfg["num_workers"]
     image_size = cfg["image_size"]
 
+    if dataset_name not in DATASET_DICT:
+        raise NotImplementedError("Please specific a valid dataset name")
 
-    if dataset_name == "MNIST_triplet":
-        transform=transforms.Compose(pre_process_transform + 
-        [
-                transforms.Grayscale(3),
-                transforms.Resize(image_size),
-                transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,)),
-        ])
-        train_dataset = MNIST(transform=transform)
-        test_dataset = MNIST(train=False, transform=transform)
-
-        train_triplet_dataset = TripletSampler(train_dataset)
-        test_triplet_dataset = TripletSampler(test_dataset)
-
-        if use_cuda:
-            train_loader = DataLoader(train_triplet_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-            test_loader = DataLoader(test_triplet_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-        else:
-            train_loader = DataLoader(train_triplet_dataset, batch_size=batch_size, num_workers=num_workers)
-            test_loader = DataLoader(test_triplet_dataset, batch_size=batch_size, num_workers=num_workers)
-
-    elif dataset_name == "MNIST":
-        transform=transforms.Compose(pre_process_transform + 
-        [
-                transforms.Grayscale(3),
-                transforms.Resize(image_size),
-                transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,)),
-        ])
-        train_dataset = MNIST(transform=transform)
-        test_dataset = MNIST(train=False, transform=transform)
-
-        if use_cuda:
-            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-            test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-        else:
-            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers)
-            test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers)
-
-    elif dataset_name == "Fashion_MNIST_triplet":
-        transform=transforms.Compose(pre_process_transform + 
-        [
-                transforms.Grayscale(3),
-                transforms.Resize(image_size),
-                transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,)),
-        ])
-        train_dataset = Fashion_MNIST(transform=transform)
-        test_dataset = Fashion_MNIST(train=False, transform=transform)
-
-        train_triplet_dataset = TripletSampler(train_dataset)
-        test_triplet_dataset = TripletSampler(test_dataset)
-
-        if use_cuda:
-            train_loader = DataLoader(train_triplet_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-            test_loader = DataLoader(test_triplet_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-        else:
-            train_loader = DataLoader(train_triplet_dataset, batch_size=batch_size, num_workers=num_workers)
-            test_loader = DataLoader(test_triplet_dataset, batch_size=batch_size, num_workers=num_workers)
-
-    elif dataset_name == "Fashion_MNIST":
-        transform=transforms.Compose(pre_process_transform + 
-        [
-                transforms.Grayscale(3),
-                transforms.Resize(image_size),
-                transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,)),
-        ])
-        train_dataset = Fashion_MNIST(transform=transform)
-        test_dataset = Fashion_MNIST(train=False, transform=transform)
-
-        if use_cuda:
-            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-            test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-        else:
-            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers)
-            test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers)
-
-    elif dataset_name == "Arch_Dataset_triplet":
-        transform=transforms.Compose(pre_process_transform + 
-        [
-                transforms.Resize(image_size),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5)),
-        ])
-        train_dataset = ArchDatset(transform=transform)
-        test_dataset = ArchDatset(train=False, transform=transform)
-
-        train_triplet_dataset = TripletSampler(train_dataset)
-        test_triplet_dataset = TripletSampler(test_dataset)
-
-        if use_cuda:
-            train_loader = DataLoader(train_triplet_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-            test_loader = DataLoader(test_triplet_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-        else:
-            train_loader = DataLoader(train_triplet_dataset, batch_size=batch_size, num_workers=num_workers)
-            test_loader = DataLoader(test_triplet_dataset, batch_size=batch_size, num_workers=num_workers)
-
-    elif dataset_name == "Arch_Dataset":
-        transform=transforms.Compose(pre_process_transform + 
-        [
-                transforms.Resize(image_size),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5)),
-        ])
-        train_dataset = ArchDatset(transform=transform)
-        test_dataset = ArchDatset(train=False, transform=transform)
+    dataset_class, use_triplet = DATASET_DICT[dataset_name]
+    transform = get_transform(dataset_name, image_size, pre_process_transform)
 
-        if use_cuda:
-            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-            test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
-        else:
-            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers)
-            test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers)
+    # the synthetic dataset is generated by the config
+    dataset_kwargs = {}
+    if issubclass(dataset_class, SyntheticDataset):
+        dataset_kwargs = dict(cfg.get("synthetic_dataset", {}))
+        dataset_kwargs.setdefault("image_size", image_size)
 
-    else:
-        raise NotImplementedError("Please specific a valid dataset name")
+    train_dataset = dataset_class(transform=transform, **dataset_kwargs)
+    test_dataset = dataset_class(train=False, transform=transform, **dataset_kwargs)
+
+    # the workers get the tensors by shared memory instead of copying them
+    if cfg.get("share_memory", True):
+        share_dataset_memory(train_dataset)
+        share_dataset_memory(test_dataset)
+
+    # the triplet index of an epoch can be drawn at once, see TripletSampler
+    if use_triplet:
+        # hard negative mining and centroid negative class need the schedule
+        triplet_schedule = cfg.get("triplet_schedule", False) \
+                           or cfg.get("hard_negative_mining", {}).get("enable", False) \
+                           or cfg.get("centroid_negative", {}).get("enable", False)
+        schedule_seed = cfg.get("experiment_seed", 0)
+        train_dataset = TripletSampler(train_dataset, precompute=triplet_schedule, seed=schedule_seed)
+        test_dataset = TripletSampler(test_dataset, precompute=triplet_schedule, seed=schedule_seed)
+
+    # each process only load its own part of the train dataset.
+    train_sampler = DistributedSampler(train_dataset, shuffle=True) if distributed else None
+
+    train_loader = build_dataloader(train_dataset, cfg, use_cuda, sampler=train_sampler)
+    test_loader = build_dataloader(test_dataset, cfg, use_cuda)
+
+    # record the loading time of each batch
+    if cfg.get("dataloader_telemetry", False):
+        train_loader = instrument_dataloader(train_loader, cfg.get("stall_threshold", 0.05))
+        test_loader = instrument_dataloader(test_loader, cfg.get("stall_threshold", 0.05))
 
     logger.info("\nUsing {} dataset.\n".format(dataset_name))
 
@@ -167,6 +190,30 @@ def get_train_dataloader(cfg: dict, use_cuda, pre_process_transform=[]):
 
 if __name__ == "__main__":
     """
-    Test is workable
+    Search the best num_workers, prefetch_factor and persistent_workers for the train dataset:
+        python experiment/triplet_utils/get_dataloader.py --config_name Arch_Dataset/Arch_Dataset_Resnet18_triplet_train.yml
     """
-    pass
\ No newline at end of file
+    import os
+    import argparse
+    from utils.loadConfig import load_cfg
+    from utils.dataloader_helper import autotune_dataloader
+
+    parser = argparse.ArgumentParser(description='Autotune the dataloader setting')
+    parser.add_argument('--config_name', default='Arch_Dataset/Arch_Dataset_Resnet18_triplet_train.yml', type=str,
+                        help='name of config file')
+    parser.add_argument('--num_workers', default=[0, 1, 2, 4, 8], type=int, nargs='+',
+                        help='num_workers to search')
+    parser.add_argument('--prefetch_factor', default=[2, 4], type=int, nargs='+',
+                        help='prefetch_factor to search')
+    parser.add_argument('--num_batches', default=20, type=int,
+                        help='how many batch to load for each setting')
+    args = parser.parse_args()
+
+    experiment_config_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config")
+    cfg = load_cfg(experiment_config_folder, args.config_name)
+
+    train_loader, _ = get_train_dataloader(cfg, use_cuda=False)
+    autotune_dataloader(train_loader.dataset, cfg["batch_size"],
+                        num_workers_list=args.num_workers,
+                        prefetch_factor_list=args.prefetch_factor,
+                        num_batches=args.num_batches)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from utils.log_helper import init_log
 from model.loss.triplet_loss import TripletLoss
+from model.loss.xbm_loss import XBMTripletLoss
 
 logger = init_log("global")
 
@@ -8,7 +9,15 @@ def get_loss(cfg: dict):
 
     select the loss according to the config's, current support:
 
-    ["triplet", ]
+    ["triplet", "triplet_xbm"]
+
+    "triplet_xbm" is the triplet loss with a cross-batch memory, the anchors
+    also mine the hardest negative in the embeddings of recent batches, the
+    loss need anchor_cls and neg_cls in forward (see model/loss/xbm_loss.py).
+    Its optimizer step count (for the warmup, advanced by 'step()' after each
+    optimizer step, independent of accumulation_steps and micro_batch_size) is
+    in the loss's state_dict and saved in the checkpoint, the memory is not
+    saved and is empty after resume.
 
     Args:
         cfg: Dict class that must contains required parameter.
@@ -17,6 +26,9 @@ def get_loss(cfg: dict):
         A loss function that defined by following config entry:
 
             loss_name: specific loss
+            triplet_xbm.memory_size : (int, optional) number of embeddings in memory, default is 4096.
+            triplet_xbm.warmup_iters : (int, optional) optimizer steps before using the memory (independent of accumulation_steps and micro_batch_size), default is 1000.
+            triplet_xbm.weight : (float, optional) weight of the memory loss, default is 1.0.
     """
     # get patten from config file
     loss_name = cfg["loss_name"]
@@ -24,6 +36,7 @@ def get_loss(cfg: dict):
     # check cfg
     must_include = {
                     "triplet": ["margin", "norm_digree", "reduction"],
+                    "triplet_xbm": ["margin", "norm_digree", "reduction"],
                     }
     for i in must_include.keys():
         if i == loss_name:
@@ -36,6 +49,14 @@ def get_loss(cfg: dict):
         loss_model = TripletLoss(margin=cfg[loss_name]["margin"], 
                                  p=cfg[loss_name]["norm_digree"], 
                                  reduction=cfg[loss_name]["reduction"])
+
+    elif loss_name == "triplet_xbm":
+        loss_model = XBMTripletLoss(margin=cfg[loss_name]["margin"],
+                                    p=cfg[loss_name]["norm_digree"],
+                                    reduction=cfg[loss_name]["reduction"],
+                                    memory_size=cfg[loss_name].get("memory_size", 4096),
+                                    warmup_iters=cfg[loss_name].get("warmup_iters", 1000),
+                                    weight=cfg[loss_name].get("weight", 1.0))
         
     else:
         raise NotImplementedError("Please specific a valid loss name")
@@ -0,0 +1,121 @@
+import torch
+from utils.log_helper import init_log
+
+logger = init_log("global")
+
+
+def get_mixed_precision(cfg: dict, device):
+    """Select the mixed precision mode
+
+    select the autocast dtype according to the config's, current support:
+
+    ["bfloat16", "float16"]
+
+    bfloat16 has the same exponent range as float32, so no gradient scaling is
+    needed, it is fast on cpu with AVX512-BF16/AMX and recent gpu. float16 is
+    only supported on cuda, and the loss is scaled by a GradScaler to avoid
+    gradient underflow.
+
+    Args:
+        cfg: Dict class that may contains following parameter (both optional):
+
+            mixed_precision: (bool) wether use mixed precision, default is False.
+            mixed_precision_dtype: (str) "bfloat16" or "float16", default is "bfloat16".
+        device: torch.device that model compute on.
+
+    Return:
+        autocast: a function that return the autocast context, usage:
+            with autocast():
+                output = model(...)
+        scaler: a GradScaler, it is disabled (do nothing) if not needed, usage:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+    """
+    enable = cfg.get("mixed_precision", False)
+    dtype_name = cfg.get("mixed_precision_dtype", "bfloat16")
+
+    if dtype_name == "bfloat16":
+        dtype = torch.bfloat16
+    elif dtype_name == "float16":
+        dtype = torch.float16
+    else:
+        raise NotImplementedError("Please specific a valid mixed precision dtype")
+
+    if enable and dtype == torch.float16 and device.type != "cuda":
+        logger.warning("\nWARNING: float16 autocast is only supported on cuda, use bfloat16 instead.\n")
+        dtype = torch.bfloat16
+
+    scaler = torch.amp.GradScaler("cuda", enabled=enable and dtype == torch.float16)
+
+    def autocast():
+        return torch.autocast(device_type=device.type, dtype=dtype, enabled=enable)
+
+    if enable:
+        logger.info("\nUsing {} mixed precision training.\n".format(dtype))
+
+    return autocast, scaler
+
+
+if __name__ == "__main__":
+    """
+    Compare the throughput and final loss of fp32 and bf16 autocast on a short run.
+
+    Usage: python experiment/triplet_utils/get_mixed_precision.py --backbone_name Resnet18
+    The exit code is 1 if the final loss of bf16 differs from fp32 by more than loss_tolerance.
+    """
+    import sys
+    import time
+    import argparse
+    from model.loss.triplet_loss import TripletLoss
+    from model.model.triplet_model import TripletNetModel
+    from experiment.triplet_utils.get_backbone import get_backbone
+
+    parser = argparse.ArgumentParser(description='Mixed precision parity check')
+    parser.add_argument('--backbone_name', default='Resnet18', type=str)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--image_size', default=112, type=int)
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--loss_tolerance', default=0.05, type=float,
+                        help='max difference of the final loss between fp32 and bf16')
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+
+    # same data for both run
+    torch.manual_seed(1)
+    data = [torch.randn(3, args.batch_size, 3, args.image_size, args.image_size) for _ in range(4)]
+
+    def short_run(mixed_precision):
+        torch.manual_seed(1)
+        cfg = {"backbone_name": args.backbone_name, "pretrained": False, "embedding_dim": 128,
+               "mixed_precision": mixed_precision, "mixed_precision_dtype": "bfloat16"}
+        model = TripletNetModel(get_backbone(cfg)).to(device)
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        loss = TripletLoss(margin=0.5)
+        autocast, scaler = get_mixed_precision(cfg, device)
+
+        start_time = time.time()
+        for step in range(args.steps):
+            anc_imgs, pos_imgs, neg_imgs = data[step % len(data)]
+            with autocast():
+                output = model.forward_triplet(anc_imgs, pos_imgs, neg_imgs)
+                loss_value = loss(output["anchor_map"], output["pos_map"], output["neg_map"])
+            optimizer.zero_grad()
+            scaler.scale(loss_value).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        total_time = time.time() - start_time
+
+        return loss_value.item(), args.steps * args.batch_size / total_time
+
+    fp32_loss, fp32_speed = short_run(False)
+    bf16_loss, bf16_speed = short_run(True)
+
+    logger.info("\nfp32: final loss {0:.5f} | {1:.2f} triplets/s\nbf16: final loss {2:.5f} | {3:.2f} triplets/s\nspeedup: {4:.2f}x | loss difference: {5:.5f}\n".format(
+        fp32_loss, fp32_speed, bf16_loss, bf16_speed, bf16_speed / fp32_speed, abs(bf16_loss - fp32_loss)))
+    if abs(bf16_loss - fp32_loss) > args.loss_tolerance:
+        logger.error("\nERROR: bf16 final loss differs from fp32 by more than {}.\n".format(args.loss_tolerance))
+        sys.exit(1)
+    logger.info("\nMixed precision parity check passed.\n")
@@ -0,0 +1,146 @@
+import json
+import torch
+import torch.nn as nn
+
+"""
+Loader of the exported inference artifacts.
+
+This file only depends on torch, so a serving process can load the exported
+model without importing the training stack (backbone, optimizer, dataloader ...).
+The onnxruntime is optional, it is only imported when loading an ONNX model.
+"""
+
+# name of the metadata file that stored inside the exported artifact
+EXPORT_META_NAME = "meta.json"
+
+# input & output name of the exported ONNX graph
+ONNX_INPUT_NAME = "images"
+ONNX_OUTPUT_NAME = "embedding"
+
+
+class OnnxRuntimeModel(nn.Module):
+    """
+    ONNX Runtime inference backend.
+
+    Wrap an ONNX Runtime session as a nn.Module, so it can be used as the
+    model in 'test_model' and other embedding extraction code, the input is a
+    Tensor [B, 3, H, W] and the output is the embedding Tensor [B, D] on the
+    same device of input.
+
+    Args:
+        onnx_path: path of the exported '.onnx' file.
+        intra_op_threads: thread number used inside one operator, 0 for default.
+        providers: execution providers of onnxruntime, default is cpu.
+    """
+    def __init__(self, onnx_path, intra_op_threads=0, providers=("CPUExecutionProvider",)):
+        super(OnnxRuntimeModel, self).__init__()
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("onnxruntime is required for the ONNX backend, please 'pip install onnxruntime'.")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=list(providers))
+
+    def forward(self, x):
+        """
+        Run the ONNX graph on input images.
+
+        Args:
+            x: input images (Tensor), [B, 3, H, W].
+        """
+        inputs = {ONNX_INPUT_NAME: x.detach().to("cpu", torch.float32).contiguous().numpy()}
+        embedding = self.session.run([ONNX_OUTPUT_NAME], inputs)[0]
+        return torch.from_numpy(embedding).to(x.device)
+
+
+def load_onnx_model(path, intra_op_threads=0):
+    """Load an ONNX model that exported by 'experiment/export.py' with onnxruntime.
+
+    Args:
+        path: (str) path of the exported '.onnx' file.
+        intra_op_threads: (int) thread number used inside one operator, 0 for default.
+
+    Return:
+        model: (OnnxRuntimeModel) the onnxruntime backend model.
+        meta: (dict) metadata of the model, same as 'load_torchscript_model'.
+    """
+    model = OnnxRuntimeModel(path, intra_op_threads=intra_op_threads)
+
+    meta = {}
+    meta_props = model.session.get_modelmeta().custom_metadata_map
+    if EXPORT_META_NAME in meta_props:
+        meta = json.loads(meta_props[EXPORT_META_NAME])
+
+    return model, meta
+
+
+def load_torchscript_model(path, device="cpu"):
+    """Load a frozen TorchScript model that exported by 'experiment/export.py'.
+
+    The final l2-normalization of the backbone is already baked into the graph,
+    so the output of the model can be directly used as the retrieval feature.
+
+    usage:
+        model, meta = load_torchscript_model("xxx_epoch_10_traced.pt")
+        with torch.no_grad():
+            feature = model(imgs)
+
+    Args:
+        path: (str) path of the exported '.pt' file.
+        device: (str or torch.device) device to load the model.
+
+    Return:
+        model: (torch.jit.ScriptModule) the loaded model in eval mode.
+        meta: (dict) metadata of the model, contains:
+            {
+                "backbone_name": backbone name,
+                "embedding_dim": output feature dimention,
+                "image_size": input image size,
+                "epoch": epoch of the snap,
+            }
+    """
+    extra_files = {EXPORT_META_NAME: ""}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    model.eval()
+
+    meta = {}
+    if extra_files[EXPORT_META_NAME]:
+        meta = json.loads(extra_files[EXPORT_META_NAME])
+
+    return model, meta
+
+
+if __name__ == "__main__":
+    """
+    Usage: python experiment/triplet_utils/load_export.py --path xxx_traced.pt (or xxx.onnx)
+    """
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load exported triplet network')
+    parser.add_argument('--path', type=str, required=True,
+                        help='path of the exported model')
+    parser.add_argument('--batch_size', default=32, type=int,
+                        help='batch size for speed testing')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.path.endswith(".onnx"):
+        model, meta = load_onnx_model(args.path)
+    else:
+        model, meta = load_torchscript_model(args.path)
+    print("load time: {:.3f}s, meta: {}".format(time.time() - start_time, meta))
+
+    imgs = torch.randn(args.batch_size, 3, meta["image_size"], meta["image_size"])
+    with torch.no_grad():
+        # warm up, the first run of a frozen model is used for optimization.
+        model(imgs)
+        start_time = time.time()
+        feature = model(imgs)
+    print("forward time: {:.3f}s, feature shape: {}".format(time.time() - start_time, tuple(feature.shape)))
@@ -2,7 +2,9 @@ import os
 import re
 import torch
 import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
 from utils.log_helper import init_log
+from utils.checkpoint_helper import load_checkpoint, is_best_checkpoint
 from torch.utils.tensorboard import SummaryWriter
 from model.model.triplet_model import TripletNetModel
 from experiment.triplet_utils.get_backbone import get_backbone
@@ -59,12 +61,13 @@ def set_model_gpu_mode_multi(model, cuda):
 
 def get_pt_file(path):
     """
-    get all .pt file name in the folder
+    get all .pt file name (and .ckpt split checkpoint folder name) in the folder,
+    except the best.pt (best.ckpt) linked by train.py.
 
     Args:
         path: folder to get all .pt name
     Return:
-        A list of all .pt file
+        A list of all .pt file and .ckpt folder
     """
 
     file_list = []
@@ -73,7 +76,8 @@ def get_pt_file(path):
     # print f_list
     for i in f_list:
         # os.path.splitext():分离文件名与扩展名
-        if os.path.splitext(i)[1] == '.pt':
+        # best.pt is a link of another checkpoint, skip it in the sweep
+        if os.path.splitext(i)[1] in ('.pt', '.ckpt') and not is_best_checkpoint(i):
             file_list.append(i)
     return file_list
 
@@ -112,7 +116,7 @@ def load_all_train(cfg, cuda):
                 Optimizer name, current support:
                     ["sgd", "adagrad", "rmsprop", "adam"]
             resume_name: 
-                resume snap '.pt' file name.
+                resume snap '.pt' file name (or '.ckpt' split checkpoint folder name).
         cuda: 
             use cuda or not.
 
@@ -154,7 +158,7 @@ def load_all_train(cfg, cuda):
         if os.path.isfile(resume_path):
             logger.info("\nLoading checkpoint {} in {} ...\n".format(resume_name, experiment_snap_folder))
 
-        checkpoint = torch.load(resume_path)
+        checkpoint = load_checkpoint(resume_path)
         start_epoch = checkpoint['epoch']
 
         optimizer_model.load_state_dict(checkpoint['optimizer_model_state_dict'])
@@ -198,7 +202,7 @@ def load_model_test(cfg, cuda):
             embedding_dim: 
                 The output feature's dimention.
             resume_name: 
-                resume snap '.pt' file name.
+                resume snap '.pt' file name (or '.ckpt' split checkpoint folder name).
         cuda: 
             use cuda or not.
     Return:
@@ -245,7 +249,8 @@ def load_model_test(cfg, cuda):
             if os.path.isfile(resume_path):
                 logger.info("\nLoading checkpoint {} in {} ...\n".format(model_snap_name, experiment_snap_folder))
 
-            checkpoint = torch.load(resume_path)
+            # only the model weights is needed for testing
+            checkpoint = load_checkpoint(resume_path, weights_only=True)
             start_epoch = checkpoint['epoch']
 
             # In order to load state dict for optimizers correctly, model has to be loaded to gpu first
@@ -262,7 +267,7 @@ def load_model_test(cfg, cuda):
     return models, start_epochs
 
 
-def load_model_test_yeild(cfg, cuda):
+def load_model_test_yeild(cfg, cuda, reuse_model=False, prefetch=False):
     """Initialize and load model snap for testing.
 
     This function is aimed to get the model part for testing on single GPU;
@@ -275,6 +280,13 @@ def load_model_test_yeild(cfg, cuda):
     This function is mainly for testing, so multi GPU model is not in our 
     consideration.
 
+    If 'reuse_model' is True, the model is built only once without loading the
+    pretrained weight, and the weights of each checkpoint are copied into it in
+    place, so the same model instance is yielded every time (do not keep the
+    yielded model between iterations). If 'prefetch' is also True, the next
+    checkpoint is read from disk in a background thread while the current model
+    is being evaluated.
+
     Args:
         cfg: config file that used following part:
             backbone: 
@@ -287,9 +299,13 @@ def load_model_test_yeild(cfg, cuda):
             embedding_dim: 
                 The output feature's dimention.
             resume_name: 
-                resume snap '.pt' file name.
+                resume snap '.pt' file name (or '.ckpt' split checkpoint folder name).
         cuda: 
             use cuda or not.
+        reuse_model:
+            build the model once and swap the weights for each checkpoint.
+        prefetch:
+            read the next checkpoint in background, only used when reuse_model is True.
     Return:
         models: (list of model)
             models that resumed by snap file and loaded into GPU if use cuda.
@@ -315,6 +331,10 @@ def load_model_test_yeild(cfg, cuda):
             raise FileNotFoundError("Cannot find any file in the snap file.")
     else:
         model_resume_path.append(resume_name)
+
+    if reuse_model:
+        yield from _load_model_test_reuse(cfg, cuda, experiment_snap_folder, model_resume_path, prefetch)
+        return
     
     for model_snap_name in model_resume_path:
         # Instantiate model
@@ -332,7 +352,8 @@ def load_model_test_yeild(cfg, cuda):
             if os.path.isfile(resume_path):
                 logger.info("\nLoading checkpoint {} in {} ...\n".format(model_snap_name, experiment_snap_folder))
 
-            checkpoint = torch.load(resume_path)
+            # only the model weights is needed for testing
+            checkpoint = load_checkpoint(resume_path, weights_only=True)
             start_epoch = checkpoint['epoch']
 
             # In order to load state dict for optimizers correctly, model has to be loaded to gpu first
@@ -342,4 +363,65 @@ def load_model_test_yeild(cfg, cuda):
 
             yield model, start_epoch
         else:
-            logger.warning("\nWARNING: No checkpoint found at {}!\nInitialize from scratch.\n".format(resume_path))
\ No newline at end of file
+            logger.warning("\nWARNING: No checkpoint found at {}!\nInitialize from scratch.\n".format(resume_path))
+
+
+def _load_model_test_reuse(cfg, cuda, experiment_snap_folder, model_resume_path, prefetch):
+    """Yield one model instance with the weights of each checkpoint.
+
+    The architecture is built once (the pretrained weight is not loaded since it
+    will be overwritten), then the weights of each checkpoint are copied into
+    the model in place by load_state_dict.
+
+    Args:
+        cfg: config file, same as load_model_test_yeild.
+        cuda: use cuda or not.
+        experiment_snap_folder: folder of the checkpoints.
+        model_resume_path: sorted list of checkpoint name in the folder.
+        prefetch: read the next checkpoint in a background thread.
+
+    Return:
+        (generator) model, start_epoch
+    """
+    # Instantiate model once, no need to load the pretrained weight.
+    model_cfg = dict(cfg)
+    model_cfg["pretrained"] = False
+    model = TripletNetModel(get_backbone(cfg=model_cfg))
+
+    # Load model to GPU if available
+    model = set_model_gpu_mode_single(model, cuda)
+
+    def read_checkpoint(model_snap_name):
+        # only the model weights is needed for testing, keep it on cpu until it is copied into the model.
+        # when prefetching, read the weights in the background thread instead of mapping them
+        # (the mmap tensors would only be read by load_state_dict in the main thread).
+        return load_checkpoint(os.path.join(experiment_snap_folder, model_snap_name), map_location="cpu",
+                               weights_only=True, mmap=not prefetch)
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        next_checkpoint = executor.submit(read_checkpoint, model_resume_path[0]) if prefetch else None
+
+        for idx, model_snap_name in enumerate(model_resume_path):
+            logger.info("\nLoading checkpoint {} in {} ...\n".format(model_snap_name, experiment_snap_folder))
+
+            if prefetch:
+                checkpoint = next_checkpoint.result()
+                # read the next one while the current model is evaluated
+                if idx + 1 < len(model_resume_path):
+                    next_checkpoint = executor.submit(read_checkpoint, model_resume_path[idx + 1])
+            else:
+                checkpoint = read_checkpoint(model_snap_name)
+
+            start_epoch = checkpoint['epoch']
+
+            # swap the weights in place
+            model.load_state_dict(checkpoint['model_state_dict'])
+            del checkpoint
+
+            logger.info("\nCheckpoint loaded: From checkpoint epoch = {}\n".format(start_epoch))
+
+            yield model, start_epoch
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
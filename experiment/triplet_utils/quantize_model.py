@@ -0,0 +1,87 @@
+import io
+import copy
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from utils.log_helper import init_log
+from model.model.triplet_model import TripletNetModel
+
+logger = init_log("global")
+
+
+def get_model_size(model):
+    """Get the serialized size of the model's state dict.
+
+    Args:
+        model: (nn.Module) input model.
+
+    Return:
+        size of the model in bytes.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def quantize_model_ptq(model, calib_dataloader, calib_number=256, backend="x86"):
+    """Post-training static quantization of a TripletNetModel with FX graph mode.
+
+    The backbone is copied to cpu, traced by torch.fx, then the observers are
+    inserted and calibrated by 'calib_number' images from the dataloader,
+    finally converted to an int8 model. The original model is not modified.
+
+    Conv/Linear/ReLU/Pooling are quantized, the operations that do not have int8
+    kernel (e.g. the final l2-normalization) keep running in float.
+
+    Args:
+        model: (nn.Module)
+            A TripletNetModel or a backbone model.
+        calib_dataloader: (torch.Dataloader)
+            A non-triplet dataloader to calibrate, the sample protocal is:
+                {
+                    "img": target image,
+                    "cls": target class,
+                    "other": other information,
+                }
+        calib_number: (int)
+            how many images are used for calibration.
+        backend: (str)
+            quantized engine, "x86", "fbgemm" for x86 cpu or "qnnpack" for arm cpu.
+
+    Return:
+        A quantized TripletNetModel on cpu.
+    """
+    if isinstance(model, TripletNetModel):
+        backbone = model.backbone
+    else:
+        backbone = model
+
+    # the engine may not be supported by the current torch version
+    if backend not in torch.backends.quantized.supported_engines:
+        logger.warning("\nWARNING: quantized engine {} is not supported, use fbgemm instead.\n".format(backend))
+        backend = "fbgemm"
+    torch.backends.quantized.engine = backend
+
+    backbone = copy.deepcopy(backbone).to("cpu")
+    backbone.eval()
+
+    # get an example input for tracing
+    example_inputs = (next(iter(calib_dataloader))["img"],)
+
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    prepared_backbone = prepare_fx(backbone, qconfig_mapping, example_inputs)
+
+    # calibration
+    calib_count = 0
+    with torch.no_grad():
+        for batch_sample in calib_dataloader:
+            prepared_backbone(batch_sample["img"])
+            calib_count += batch_sample["img"].size(0)
+            if calib_count >= calib_number:
+                break
+
+    quantized_backbone = convert_fx(prepared_backbone)
+    logger.info("\nQuantized model with {} engine, calibrated on {} images.\n".format(backend, calib_count))
+
+    return TripletNetModel(quantized_backbone)
@@ -1,14 +1,19 @@
 import os
+import copy
+import queue
 import time
 import torch
 import logging
-from torch.utils.tensorboard import SummaryWriter
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
 
 # utility
 from omegaconf import OmegaConf
 from utils.loadConfig import load_cfg
-from utils.average_meter_helper import AverageMeter
+from utils.average_meter_helper import TensorAverageMeter
 from utils.log_helper import init_log, add_file_handler, print_speed
+from utils.board_helper import BufferedSummaryWriter
+from utils.checkpoint_helper import snapshot_to_cpu
 
 # get method
 from experiment.triplet_utils.get_loss import get_loss
@@ -19,6 +24,10 @@ from experiment.triplet_utils.get_dataloader import get_train_dataloader
 # load model (more eazy way to get model.)
 from experiment.triplet_utils.load_model import load_model_test
 
+# metric
+from experiment.test_utils.metric import retrieval_metrics
+from experiment.test_utils.extract import extract_embeddings
+
 # init logger
 logger = init_log("global")
 
@@ -40,7 +49,7 @@ def validation(epoch, log_interval, test_dataloader, model, loss, writer, device
         loss: 
             Loss metric.
         writer:
-            Tensorboard writer
+            Tensorboard writer (SummaryWriter or BufferedSummaryWriter)
         device: 
             Device that model compute on
 
@@ -50,8 +59,8 @@ def validation(epoch, log_interval, test_dataloader, model, loss, writer, device
     
     """
     logger.info("\n------------------------- Start validation -------------------------\n")
-    # epoch average meter
-    avg_test = AverageMeter()
+    # epoch average meter, the loss is accumulated on device and only read on log_interval
+    avg_test = TensorAverageMeter(window=log_interval)
 
     # get test batch count
     current_test_batch = 0
@@ -60,71 +69,316 @@ def validation(epoch, log_interval, test_dataloader, model, loss, writer, device
     # check dataloader is not None
     assert test_dataloader is not None, "test_dataloader should not be None."
 
-    for batch_idx, batch_sample in enumerate(test_dataloader):
-        # Skip last iteration to avoid the problem of having different number of tensors while calculating
-        # averages (sizes of tensors must be the same for pairwise distance calculation)
-        if batch_idx + 1 == len(test_dataloader):
-            continue
+    # switch to evaluation mode once, no autograd graph is recorded in validation.
+    was_training = model.training
+    model.eval()
+
+    with torch.inference_mode():
+        for batch_idx, batch_sample in enumerate(test_dataloader):
+            # Skip last iteration to avoid the problem of having different number of tensors while calculating
+            # averages (sizes of tensors must be the same for pairwise distance calculation)
+            if batch_idx + 1 == len(test_dataloader):
+                continue
+
+            # start time counting
+            batch_start_time_test = time.time()
+
+            # Forward pass - compute embeddings
+            anc_imgs = batch_sample['anchor_img']
+            pos_imgs = batch_sample['pos_img']
+            neg_imgs = batch_sample['neg_img']
+
+            pos_cls = batch_sample['pos_cls']
+            neg_cls = batch_sample['neg_cls']
+
+            # move to device
+            anc_imgs = anc_imgs.to(device)
+            pos_imgs = pos_imgs.to(device)
+            neg_imgs = neg_imgs.to(device)
+            pos_cls = pos_cls.to(device)
+            neg_cls = neg_cls.to(device)
+
+            # forward
+            output = model.forward_triplet(anc_imgs, pos_imgs, neg_imgs)
+
+            # get output 
+            anc_emb = output['anchor_map']
+            pos_emb = output['pos_map']
+            neg_emb = output['neg_map']
+
+            pos_dists = torch.mean(output['dist_pos'])
+            neg_dists = torch.mean(output['dist_neg'])
+
+            # loss compute
+            loss_value = loss(anc_emb, pos_emb, neg_emb)
+
+            # batch time & batch count
+            current_test_batch += 1
+            batch_time = time.time() - batch_start_time_test
+
+            # update avg
+            avg_test.update(time=batch_time, triplet_loss=loss_value, pos_dists=pos_dists, neg_dists=neg_dists)
+            if current_test_batch % log_interval == 0:            
+                print_speed(current_test_batch, batch_time, total_test_batch, "global")
+                logger.info("\n current global average information:\n batch_time {0:.5f} | triplet_loss: {1:.5f} | pos_dists: {2:.5f} | neg_dists: {3:.5f} \n".format(avg_test.time.avg, avg_test.triplet_loss.avg, avg_test.pos_dists.avg, avg_test.neg_dists.avg))
+        else:
+            writer.add_scalar("Validate/Loss/train", avg_test.triplet_loss.avg, global_step=epoch)
+            writer.add_scalar("Validate/Other/pos_dists", avg_test.pos_dists.avg, global_step=epoch)
+            writer.add_scalar("Validate/Other/neg_dists", avg_test.neg_dists.avg, global_step=epoch)
+
+    model.train(was_training)
 
-        # switch to evaluation mode.
-        for param in model.parameters():
-            param.requires_grad = False
-        model.eval()
+    return avg_test.triplet_loss.avg, avg_test.pos_dists.avg, avg_test.neg_dists.avg
 
 
-        # start time counting
-        batch_start_time_test = time.time()
+def retrieval_validation(epoch, log_interval, retrieval_dataloader, model, writer, device, ks=(10, 100), block_size=1024):
+    """Validate the retrieval performance on test dataset.
 
-        # Forward pass - compute embeddings
-        anc_imgs = batch_sample['anchor_img']
-        pos_imgs = batch_sample['pos_img']
-        neg_imgs = batch_sample['neg_img']
+    The test dataset is embedded once by 'extract_embeddings', then the mAP@K
+    and recall@K of all samples are computed from the cached embedding by the
+    blocked vectorized ranking ('retrieval_metrics'), so it is much faster than
+    test.py.
 
-        pos_cls = batch_sample['pos_cls']
-        neg_cls = batch_sample['neg_cls']
+    Args:
+        log_interval:
+            How many time will the logger log once.
+        retrieval_dataloader:
+            A non-triplet dataloader of the test dataset.
+        model:
+            The TripletNetModel that used to test on dataset.
+        writer:
+            Tensorboard writer (SummaryWriter or BufferedSummaryWriter)
+        device:
+            Device that model compute on
+        ks:
+            The K of mAP@K and recall@K.
+        block_size:
+            Number of queries ranked at once.
 
-        # move to device
-        anc_imgs = anc_imgs.to(device)
-        pos_imgs = pos_imgs.to(device)
-        neg_imgs = neg_imgs.to(device)
-        pos_cls = pos_cls.to(device)
-        neg_cls = neg_cls.to(device)
+    Return:
+        dict of {"mAP@K": value, "recall@K": value} for each K.
+    """
+    logger.info("\n------------------------- Start retrieval validation -------------------------\n")
+    start_time = time.time()
 
-        # forward
-        output = model.forward_triplet(anc_imgs, pos_imgs, neg_imgs)
+    features, classes, _ = extract_embeddings(model, retrieval_dataloader, device, log_interval=log_interval)
+    extract_time = time.time() - start_time
 
-        # get output 
-        anc_emb = output['anchor_map']
-        pos_emb = output['pos_map']
-        neg_emb = output['neg_map']
+    metrics = retrieval_metrics(features.to(device), classes.to(device), ks=ks, block_size=block_size)
+    total_time = time.time() - start_time
 
-        pos_dists = torch.mean(output['dist_pos'])
-        neg_dists = torch.mean(output['dist_neg'])
+    for name, value in metrics.items():
+        writer.add_scalar("Validate/Retrieval/{}".format(name), value, global_step=epoch)
+    writer.add_scalar("Validate/Retrieval/time", total_time, global_step=epoch)
 
-        # loss compute
-        loss_value = loss(anc_emb, pos_emb, neg_emb)
+    logger.info("\n retrieval validation ({0} samples, extract {1:.2f}s, rank {2:.2f}s):\n {3}\n".format(
+        features.size(0), extract_time, total_time - extract_time,
+        " | ".join("{}: {:.5f}".format(name, value) for name, value in metrics.items())))
 
-        # batch time & batch count
-        current_test_batch += 1
-        batch_time = time.time() - batch_start_time_test
+    return metrics
 
-        # update avg
-        avg_test.update(time=batch_time, triplet_loss=loss_value, pos_dists=pos_dists, neg_dists=neg_dists)
-        if current_test_batch % log_interval == 0:            
-            print_speed(current_test_batch, batch_time, total_test_batch, "global")
-            logger.info("\n current global average information:\n batch_time {0:.5f} | triplet_loss: {1:.5f} | pos_dists: {2:.5f} | neg_dists: {3:.5f} \n".format(avg_test.time.avg, avg_test.triplet_loss.avg, avg_test.pos_dists.avg, avg_test.neg_dists.avg))
-    else:
-        writer.add_scalar("Validate/Loss/train", avg_test.triplet_loss.avg, global_step=epoch)
-        writer.add_scalar("Validate/Other/pos_dists", avg_test.pos_dists.avg, global_step=epoch)
-        writer.add_scalar("Validate/Other/neg_dists", avg_test.neg_dists.avg, global_step=epoch)
 
-    return avg_test.triplet_loss.avg, avg_test.pos_dists.avg, avg_test.neg_dists.avg
+def _validation_worker(cfg, model, test_dataset, retrieval_dataset, board_folder, num_threads, job_queue, result_queue):
+    """Background process: validate each snapshot of the job queue until receive None."""
+    torch.set_num_threads(num_threads)
+    device = torch.device("cpu")
+    log_interval = cfg["log_interval"]
+    retrieval_cfg = cfg.get("retrieval_validation", {})
+
+    # the process is daemonic, so the dataloaders can not have workers
+    loss = get_loss(cfg)
+    test_dataloader = DataLoader(test_dataset, batch_size=cfg["batch_size"], num_workers=0) if test_dataset is not None else None
+    retrieval_dataloader = DataLoader(retrieval_dataset, batch_size=cfg["batch_size"], num_workers=0) if retrieval_dataset is not None else None
+    writer = BufferedSummaryWriter(board_folder)
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        epoch, state_dict, checkpoint_path = job
+        model.load_state_dict(state_dict)
+
+        val_triplet_loss = None
+        retrieval_result = None
+        if test_dataloader is not None:
+            val_triplet_loss, _, _ = validation(epoch, log_interval, test_dataloader, model, loss, writer, device)
+        if retrieval_dataloader is not None:
+            retrieval_result = retrieval_validation(epoch, log_interval, retrieval_dataloader, model, writer, device,
+                                                    ks=list(retrieval_cfg.get("ks", [10, 100])),
+                                                    block_size=retrieval_cfg.get("block_size", 1024))
+        writer.flush()
+        result_queue.put((epoch, checkpoint_path, val_triplet_loss, retrieval_result))
+
+    writer.close()
+
+
+class BackgroundValidator(object):
+    """Run the validation in a background process.
+
+    'submit' copy the model weights to cpu and put them into a bounded queue,
+    the training continue immediately. The background process (cpu) run
+    'validation' and/or 'retrieval_validation' on each snapshot, and write
+    to its own board folder, so the tags do not mix with the training board.
+    If the queue is full (the process is still busy), the snapshot is skipped,
+    so the validations never pile up.
+
+    Usage:
+        validator = BackgroundValidator(cfg, model, test_dataset, retrieval_dataset, board_folder)
+        validator.submit(epoch, model.state_dict(), checkpoint_path)
+        for epoch, checkpoint_path, val_loss, retrieval_result in validator.poll():
+            ...
+        results = validator.close()
+
+    Args:
+        cfg: config dict (plain dict, it is sent to the process).
+        model: the (unwrapped) TripletNetModel, a cpu copy is sent to the process.
+        test_dataset: triplet test dataset for 'validation', None to skip.
+        retrieval_dataset: non-triplet test dataset for 'retrieval_validation', None to skip.
+        board_folder: board folder of the background validation.
+        queue_size: max number of snapshots waiting for validation.
+        num_threads: torch threads of the background process.
+    """
+    def __init__(self, cfg, model, test_dataset, retrieval_dataset, board_folder, queue_size=1, num_threads=2):
+        self._context = mp.get_context("spawn")
+        self._job_queue = self._context.Queue(maxsize=max(1, queue_size))
+        self._result_queue = self._context.Queue()
+
+        model_copy = copy.deepcopy(model).to("cpu").eval()
+        self._process = self._context.Process(target=_validation_worker,
+                                              args=(cfg, model_copy, test_dataset, retrieval_dataset, board_folder,
+                                                    num_threads, self._job_queue, self._result_queue),
+                                              daemon=True)
+        self._process.start()
+        logger.info("\nStart background validation process (pid {}).\n".format(self._process.pid))
+
+    def submit(self, epoch, state_dict, checkpoint_path=None):
+        """Put a snapshot of the weights into the queue.
+
+        Args:
+            epoch: epoch of the snapshot (board global step).
+            state_dict: model state dict, copied to cpu.
+            checkpoint_path: path of the checkpoint of the snapshot, returned with the result.
+
+        Return:
+            False if the queue is full and the snapshot is skipped.
+        """
+        if not self._process.is_alive():
+            logger.warning("\nWARNING: background validation process exit with code {}.\n".format(self._process.exitcode))
+            return False
+        try:
+            self._job_queue.put_nowait((epoch, snapshot_to_cpu(state_dict), checkpoint_path))
+        except queue.Full:
+            logger.warning("\nWARNING: background validation is busy, skip validation of epoch {}.\n".format(epoch + 1))
+            return False
+        return True
+
+    def poll(self):
+        """Return the list of finished (epoch, checkpoint_path, val_triplet_loss, retrieval_result)."""
+        results = []
+        while True:
+            try:
+                results.append(self._result_queue.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        """Wait for the queued validations, stop the process and return the rest results."""
+        results = []
+        if self._process.is_alive():
+            self._job_queue.put(None)
+            # get the results before join, the process can not exit with data in the queue
+            while self._process.is_alive() or not self._result_queue.empty():
+                try:
+                    results.append(self._result_queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+            self._process.join()
+        return results + self.poll()
+
+
+def check_background_validation_train(timeout=900):
+    """Run a short train.py with background validation on, check the results arrive.
+
+    The config is the Synthetic train config with a tiny dataset (no data file
+    is needed), 2 epochs, background_validation enabled and the retrieval
+    validation on. train.py is run in a subprocess, then the background board
+    folder and best.json (the best checkpoint is selected by the background
+    results) are checked. The experiment folder is removed after.
+
+    Args:
+        timeout: (int) seconds to wait for train.py.
+
+    Return:
+        True if the check passed.
+    """
+    import sys
+    import json
+    import shutil
+    import tempfile
+    import subprocess
+    import yaml
+
+    current_file_path = os.path.dirname(os.path.abspath(__file__))
+    repo_folder = os.path.dirname(current_file_path)
+    cfg = load_cfg(os.path.join(current_file_path, "config"), "Synthetic/Synthetic_Resnet18_triplet_train.yml")
+
+    experiment_name = "background_validation_check_{}".format(os.getpid())
+    cfg.update({
+        "experiment_name": experiment_name,
+        "train_epochs": 2,
+        "dont_use_cuda": True,
+        "batch_size": 8,
+        "image_size": 32,
+        "num_workers": 0,
+        "persistent_workers": False,
+        "log_interval": 10,
+        "checkpoint_async": True,
+    })
+    cfg["synthetic_dataset"].update({"num_samples": 80, "num_test_samples": 40, "num_classes": 8})
+    cfg["background_validation"].update({"enable": True, "num_threads": 1})
+    cfg["retrieval_validation"].update({"enable": True, "ks": [1, 5]})
+    cfg["retrieval_validation"]["select_metric"] = "mAP@1"
+    cfg["early_stopping"].update({"enable": False, "save_best": True})
+
+    experiment_folder = os.path.join(current_file_path, "all_experiment", experiment_name)
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        # load_cfg joins the config folder and the name, an absolute name is used as it is
+        config_path = os.path.join(tmp_folder, "background_validation_check.yml")
+        with open(config_path, "w", encoding="UTF-8") as f:
+            yaml.safe_dump(cfg, f)
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_folder, os.environ.get("PYTHONPATH")])))
+        try:
+            process = subprocess.run([sys.executable, os.path.join(current_file_path, "train.py"), "--config_name", config_path],
+                                     cwd=repo_folder, env=env, timeout=timeout)
+            passed = process.returncode == 0
+            if not passed:
+                logger.error("\nERROR: train.py exit with code {}.\n".format(process.returncode))
+
+            board_folder = os.path.join(experiment_folder, "board_validate_background")
+            if passed and not (os.path.isdir(board_folder) and os.listdir(board_folder)):
+                logger.error("\nERROR: no board file in {}.\n".format(board_folder))
+                passed = False
+
+            best_meta_path = os.path.join(experiment_folder, "snap", "best.json")
+            if passed and not os.path.isfile(best_meta_path):
+                logger.error("\nERROR: {} is not written, no background result is received.\n".format(best_meta_path))
+                passed = False
+            if passed:
+                with open(best_meta_path, "r") as f:
+                    logger.info("\nBest checkpoint from the background validation: {}\n".format(json.load(f)))
+        finally:
+            shutil.rmtree(experiment_folder, ignore_errors=True)
+    return passed
 
 
 if __name__ == "__main__":
     """
     单独Validate模型使用, 可以直接进行validate
+    检查后台validation (用 Synthetic 数据集训练2个epoch, 失败时退出码为1):
+        python experiment/validate.py --background_check
     """
+    import sys
     import argparse
 
     parser = argparse.ArgumentParser(description='Validate triplet network')
@@ -132,9 +386,18 @@ if __name__ == "__main__":
     # config file name
     parser.add_argument('--config_name', default='MNIST_Alexnet_triplet_train.yml', type=str,
                         help='name of config file')
+    parser.add_argument('--background_check', action='store_true',
+                        help='only run a short train with background validation and check the results')
 
     args = parser.parse_args()
 
+    if args.background_check:
+        if not check_background_validation_train():
+            print("background validation check failed.")
+            sys.exit(1)
+        print("background validation check passed.")
+        sys.exit(0)
+
     # get config file name.
     config_name = args.config_name
 
@@ -177,7 +440,7 @@ if __name__ == "__main__":
     os.makedirs(experiment_board_folder, exist_ok=True)
 
     # init board writer
-    writer = SummaryWriter(experiment_board_folder)
+    writer = BufferedSummaryWriter(experiment_board_folder)
 
     # get log
     add_file_handler("global", os.path.join(experiment_folder, 'validate.log'), level=logging.INFO)
@@ -197,5 +460,5 @@ if __name__ == "__main__":
     # start validte model
     validation(start_epoch, log_interval, test_dataloader, model, loss, writer, device)
 
-
-    
\ No newline at end of file
+    # write the buffered board value
+    writer.close()
@@ -0,0 +1,209 @@
+import torch
+import torch.nn as nn
+
+from model.loss.triplet_loss import TripletLoss
+
+
+class CrossBatchMemory(object):
+    """
+    Cross-batch memory (XBM): 保存最近若干个batch的特征的先进先出环形缓冲区
+
+    特征, 类别和数据集下标保存在预先分配好的tensor中(第一次入队时按特征维度和设备分配),
+    入队时只做切片拷贝, 不会重新分配内存. 特征是detach过的, 不会传递梯度.
+
+    使用方法:
+        memory = CrossBatchMemory(size=4096)
+        memory.enqueue(embeddings, labels, indexes)
+        feats, labels, indexes = memory.get()
+
+    超参数:
+        size: 缓冲区能保存的特征个数
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.feats = None
+        self.labels = None
+        self.indexes = None
+        self.ptr = 0
+        self.num_filled = 0
+
+    def enqueue(self, embeddings, labels, indexes=None):
+        """
+        入队一个batch的特征, 超出容量时覆盖最旧的特征
+
+        Args:
+            embeddings: [B, D] 特征
+            labels: [B] 类别
+            indexes: [B] 数据集下标, 没有时记为 -1
+        """
+        embeddings = embeddings.detach().float()
+        device = embeddings.device
+        if self.feats is None:
+            self.feats = torch.zeros(self.size, embeddings.size(1), device=device)
+            self.labels = torch.full((self.size,), -1, dtype=torch.long, device=device)
+            self.indexes = torch.full((self.size,), -1, dtype=torch.long, device=device)
+
+        labels = labels.to(device).long()
+        indexes = torch.full_like(labels, -1) if indexes is None else indexes.to(device).long()
+
+        # batch比缓冲区大时只保留最后 size 个
+        batch_size = embeddings.size(0)
+        if batch_size > self.size:
+            embeddings, labels, indexes = embeddings[-self.size:], labels[-self.size:], indexes[-self.size:]
+            batch_size = self.size
+
+        # 环形写入, 可能分成尾部和头部两段
+        first = min(batch_size, self.size - self.ptr)
+        self.feats[self.ptr:self.ptr + first] = embeddings[:first]
+        self.labels[self.ptr:self.ptr + first] = labels[:first]
+        self.indexes[self.ptr:self.ptr + first] = indexes[:first]
+        rest = batch_size - first
+        if rest > 0:
+            self.feats[:rest] = embeddings[first:]
+            self.labels[:rest] = labels[first:]
+            self.indexes[:rest] = indexes[first:]
+
+        self.ptr = (self.ptr + batch_size) % self.size
+        self.num_filled = min(self.num_filled + batch_size, self.size)
+
+    def get(self):
+        """
+        返回缓冲区中有效的 (feats [K, D], labels [K], indexes [K]), 空的时候返回 None
+        """
+        if self.num_filled == 0:
+            return None
+        return self.feats[:self.num_filled], self.labels[:self.num_filled], self.indexes[:self.num_filled]
+
+    def __len__(self):
+        return self.num_filled
+
+
+class XBMTripletLoss(TripletLoss):
+    """
+    带 cross-batch memory 的 Triplet loss
+
+    除了当前batch的triplet loss以外, 每个anchor还会在memory里(最近的 memory_size 个
+    anchor和negative特征)找到最近的其他类特征作为hard negative, 计算额外的triplet loss:
+
+        loss = triplet(anchor, positive, negative) + weight * triplet(anchor, positive, memory hardest negative)
+
+    前 warmup_iters 个optimizer step(模型的特征还不稳定)只入队不使用memory.
+    step 的次数 iters 由 step() 增加(每次optimizer step之后调用一次, 和梯度累积/micro-batch
+    的前向次数无关), 是 buffer, 会保存在 state_dict 里; memory 不保存, resume 之后
+    memory 是空的, 重新入队 memory_size / (2 * B) 次之后才会填满.
+    需要在forward里传入 anchor_cls 和 neg_cls, 否则(例如validation)只计算普通的triplet loss,
+    也不会入队.
+
+    使用方法:
+        loss = XBMTripletLoss(memory_size=4096, warmup_iters=1000)
+        loss(anchor, positive, negative, anchor_cls=..., neg_cls=...)
+        optimizer.step()
+        loss.step()
+
+    超参数:
+        margin: Triplet loss margin, 默认是 1.0
+        p: The norm degree for pairwise distance, 默认是 2
+        reduction: loss 求出来后的降维方式, two options: "mean" & "sum"
+        memory_size: memory 能保存的特征个数, 默认是 4096
+        warmup_iters: 多少个optimizer step之后开始使用memory, 默认是 1000
+        weight: memory loss 的权重, 默认是 1.0
+    """
+    def __init__(self, margin=1.0, p=2, reduction="mean", memory_size=4096, warmup_iters=1000, weight=1.0):
+        super(XBMTripletLoss, self).__init__(margin=margin, p=p, reduction=reduction)
+        self.memory = CrossBatchMemory(memory_size)
+        self.warmup_iters = warmup_iters
+        self.weight = weight
+        self.register_buffer("iters", torch.zeros((), dtype=torch.long))
+
+    def memory_loss(self, anchor, positive, anchor_cls):
+        """
+        用memory里最近的其他类特征作为negative计算triplet loss
+
+        Args:
+            anchor, positive: [B, D] 特征
+            anchor_cls: [B] anchor的类别
+        """
+        feats, labels, _ = self.memory.get()
+        # forward 之后会原地入队, 复制一份给 backward 使用
+        feats = feats.clone()
+        anchor = anchor.float()
+
+        # [B, K] 距离, 同类的位置设为 inf
+        dist = torch.cdist(anchor, feats, p=self.p)
+        dist = dist.masked_fill(anchor_cls.unsqueeze(1).long() == labels.unsqueeze(0), float("inf"))
+        hardest_dist, _ = dist.min(dim=1)
+
+        pos_dist = nn.functional.pairwise_distance(anchor, positive.float(), p=self.p)
+        loss = torch.relu(pos_dist - hardest_dist + self.margin)
+        # memory里没有其他类的特征时 hardest_dist 是 inf, loss 是 0
+
+        if self.reduction == "mean":
+            return loss.mean()
+        return loss.sum()
+
+    def step(self):
+        """
+        optimizer step 之后调用, 增加 step 的次数 iters (用于 warmup_iters)
+        """
+        self.iters += 1
+
+    def forward(self, anchor, positive, negative, anchor_cls=None, neg_cls=None, anchor_index=None, neg_index=None):
+        """
+        XBM Triplet loss 的前向传播.
+
+        输入的向量维度为: [B, D], 类别和下标的维度为: [B]
+
+        Args:
+            anchor: 基本点的特征
+            positive: 正样本点的特征(要拉近)
+            negative: 副样本点的特征(要拉远)
+            anchor_cls, neg_cls: anchor和negative的类别
+            anchor_index, neg_index: anchor和negative在数据集中的下标(可选, 保存在memory中)
+        """
+        loss = self.loss(anchor, positive, negative)
+        if anchor_cls is None or neg_cls is None or not self.training:
+            return loss
+
+        if int(self.iters) >= self.warmup_iters and len(self.memory) > 0:
+            loss = loss + self.weight * self.memory_loss(anchor, positive, anchor_cls.to(anchor.device))
+        # 当前batch的特征在计算完之后入队
+        indexes = None
+        if anchor_index is not None and neg_index is not None:
+            indexes = torch.cat([anchor_index, neg_index])
+        self.memory.enqueue(torch.cat([anchor, negative]), torch.cat([anchor_cls, neg_cls]), indexes)
+        return loss
+
+
+if __name__ == "__main__":
+    """
+    测试, 环形缓冲区的覆盖顺序, 以及memory中的hard negative会增大loss
+    """
+    memory = CrossBatchMemory(size=5)
+    memory.enqueue(torch.arange(4).float().unsqueeze(1), torch.arange(4), torch.arange(4))
+    memory.enqueue(torch.arange(4, 7).float().unsqueeze(1), torch.arange(4, 7), torch.arange(4, 7))
+    feats, labels, indexes = memory.get()
+    print(feats.squeeze(1).tolist(), labels.tolist())
+    assert sorted(labels.tolist()) == [2, 3, 4, 5, 6], "the oldest embeddings should be overwritten"
+
+    loss = XBMTripletLoss(margin=1.0, memory_size=64, warmup_iters=0)
+    anchor = torch.randn(8, 16, requires_grad=True)
+    positive = anchor.detach() + 0.1
+    negative = anchor.detach() + 10
+    cls = torch.zeros(8, dtype=torch.long)
+    neg_cls = torch.ones(8, dtype=torch.long)
+
+    first = loss(anchor, positive, negative, anchor_cls=cls, neg_cls=neg_cls)
+    loss.step()
+    # an easy batch, but the memory now contains anchors of class 0 and negatives of class 1
+    # put a class-2 copy of the anchors in memory as hard negatives
+    loss.memory.enqueue(anchor.detach(), torch.full((8,), 2))
+    second = loss(anchor, positive, negative, anchor_cls=cls, neg_cls=neg_cls)
+    print(first.item(), second.item())
+    assert second > first, "hard negative in memory should increase the loss"
+    second.backward()
+    loss.step()
+
+    # the iteration count is restored by the state_dict, the memory is not
+    resumed = XBMTripletLoss(margin=1.0, memory_size=64, warmup_iters=0)
+    resumed.load_state_dict(loss.state_dict())
+    assert int(resumed.iters) == 2 and len(resumed.memory) == 0
@@ -18,16 +18,23 @@ class TripletNetModel(nn.Module):
         super(TripletNetModel, self).__init__()
         self.backbone = backbone
 
-    def forward(self, x):
+    def forward(self, x, positive=None, negative=None):
         """
         Default inference of backbone
 
         The default behavior is go through the backbone, input one sample and 
-        output.
+        output. If positive and negative sample are also given, the output is 
+        the same as 'forward_triplet'. (the wrapper like DataParallel and
+        DistributedDataParallel only wraps the 'forward' method, so use
+        model(anchor, positive, negative) to train a wrapped model.)
 
         Args:
             x: input sample, it will go through the backbone.
+            positive: positive sample(Tensor), optional.
+            negative: negative sample(Tensor), optional.
         """
+        if positive is not None and negative is not None:
+            return self.forward_triplet(x, positive, negative)
         return self.backbone(x)
 
     def forward_triplet(self, anchor, positive, negative):
@@ -3,6 +3,7 @@
 # 用来计算和保存平均值
 # --------------------------------------------------------
 import numpy as np
+import torch
 
 class Meter(object):
     """
@@ -14,12 +15,16 @@ class Meter(object):
         name: 这个类表示的变量的名字
         val: 当前的值
         avg: 当前的平均值(和过去所有的在一起平均)
+        window_avg: 最近 window 个值的平均值 (只有TensorAverageMeter有)
+        ema: 指数滑动平均值 (只有TensorAverageMeter有)
     """
-    def __init__(self, name, val, avg):
+    def __init__(self, name, val, avg, window_avg=None, ema=None):
         """初始化"""
         self.name = name
         self.val = val
         self.avg = avg
+        self.window_avg = val if window_avg is None else window_avg
+        self.ema = val if ema is None else ema
 
     def __repr__(self):
         """给程序员的显示接口, 可以直接打Meter的变量来显示"""
@@ -107,6 +112,108 @@ class AverageMeter(object):
 
 
 
+class TensorAverageMeter(object):
+    """
+    计算和保存当前值和平均值, 支持直接输入Tensor (例如loss).
+
+    和AverageMeter的用法一样, 但是输入的Tensor会先detach (不会保留计算图),
+    然后在Tensor所在的device上累加, 不会在每个batch都同步device. 只有在读
+    取值的时候(例如每 log_interval 个batch)才会转换为python的float.
+
+    除了全局平均值外, 每个key还保存了最近 window 个值的平均(window_avg)和
+    指数滑动平均(ema), 所有的buffer都是预先分配的, 内存不会随着batch增长.
+
+    用法:
+        avg = TensorAverageMeter(window=20)
+        avg.update(loss=loss_value)      # 不会同步
+        print(avg.loss.window_avg)       # 读取时才同步
+
+    Args:
+        window: 滑动窗口的大小.
+        ema_momentum: 指数滑动平均的动量, ema = ema * momentum + val * (1 - momentum).
+
+    Attribute:
+        val: (dict)key:value保存当前的值(Tensor).
+        sum: (dict)key:value保存累加的总值(Tensor).
+        count: (dict)key:value保存总的batch数量.
+        updates: (dict)key:value保存update的次数.
+        window: (dict)key:value保存最近window个值的buffer(Tensor).
+        ema: (dict)key:value保存指数滑动平均值(Tensor).
+    """
+    def __init__(self, window=20, ema_momentum=0.9):
+        """初始化"""
+        self.window_size = window
+        self.ema_momentum = ema_momentum
+        self.reset()
+
+    def reset(self):
+        """刷新cache"""
+        self.val = {}
+        self.sum = {}
+        self.count = {}
+        self.updates = {}
+        self.window = {}
+        self.ema = {}
+
+    @staticmethod
+    def _to_tensor(value):
+        """将输入转换成不带计算图的float Tensor"""
+        if isinstance(value, torch.Tensor):
+            return value.detach().float()
+        return torch.tensor(float(value))
+
+    def update(self, batch=1, **kwargs):
+        """
+        更新class中的其中一条或者多条数据, 计算都在Tensor的device上进行, 不会同步.
+
+        Args:
+            batch: 一个batch的大小, 用来计算平均值, 默认为1.
+        """
+        for k in kwargs:
+            value = self._to_tensor(kwargs[k])
+            # for new key & value
+            if k not in self.sum:
+                self.sum[k] = torch.zeros((), device=value.device)
+                self.count[k] = 0
+                self.updates[k] = 0
+                self.window[k] = torch.zeros(self.window_size, device=value.device)
+                self.ema[k] = value.clone()
+
+            self.val[k] = value / float(batch)
+            self.sum[k].add_(value * float(batch))
+            self.window[k][self.updates[k] % self.window_size] = value
+            self.ema[k].mul_(self.ema_momentum).add_(value * (1 - self.ema_momentum))
+            self.count[k] += batch
+            self.updates[k] += 1
+
+    def avg(self, attr):
+        """计算avg"""
+        return self.sum[attr].item() / self.count[attr]
+
+    def window_avg(self, attr):
+        """计算最近window个值的avg"""
+        window_count = min(self.updates[attr], self.window_size)
+        return self.window[attr][:window_count].mean().item()
+
+    def __repr__(self):
+        """给程序员的显示接口, 可以直接打TensorAverageMeter的变量来显示"""
+        s = ''
+        for k in self.sum:
+            s += "{name}: {val:.6f} ({avg:.6f}) ".format(name=k, val=self.val[k].item(), avg=self.avg(k))
+        return s
+
+    def __getattr__(self, attr):
+        """利用这一特性直接返回字典中已保存的值, 在这里才转换为float"""
+        # 防止在初始化之前访问
+        if attr in ("sum", "val", "count", "updates", "window", "ema"):
+            raise AttributeError(attr)
+        # 如果没有进行注册的话, 返回0,0(不报错)
+        if attr not in self.sum:
+            return Meter(attr, 0, 0)
+        return Meter(attr, self.val[attr].item(), self.avg(attr),
+                     window_avg=self.window_avg(attr), ema=self.ema[attr].item())
+
+
 if __name__ == "__main__":
     """测试平均类的使用(用法例子)"""
     avg = AverageMeter()                    # 初始化
@@ -118,4 +225,15 @@ if __name__ == "__main__":
     print(avg.time)      # 打印特定的值(str)
     print(avg.time.avg)  # 打印特定的平均(float)
     print(avg.time.val)  # 打印特定的值(float)
-    print(avg.Sample)        # 如果出现了没有的默认为0
\ No newline at end of file
+    print(avg.Sample)        # 如果出现了没有的默认为0
+
+    """测试TensorAverageMeter的使用"""
+    tensor_avg = TensorAverageMeter(window=2)
+    for i in range(4):
+        loss = torch.tensor(float(i), requires_grad=True) * 2
+        tensor_avg.update(loss=loss)     # 不保留计算图
+
+    print(tensor_avg)
+    print(tensor_avg.loss.avg)          # 3.0
+    print(tensor_avg.loss.window_avg)   # 5.0
+    print(tensor_avg.loss.ema)
@@ -0,0 +1,154 @@
+# --------------------------------------------------------
+# By Jameslimer & Aruix
+# tensorboard 写入相关的函数, 把 scalar 先缓存起来, 由后台线程
+# 定期(每 K 个 step 或者每 T 秒)聚合后写入 event 文件.
+# --------------------------------------------------------
+import time
+import threading
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+
+class BufferedSummaryWriter(object):
+    """
+    带缓存的 SummaryWriter, 接口和 SummaryWriter 相同, 可以直接替换.
+
+    add_scalar 只是把值放入缓存(Tensor 只做 detach, 不转换为 float), 后台线程
+    在缓存了 flush_steps 个点或者距离上次写入超过 flush_secs 秒之后, 才把值
+    转换为 float 并写入 event 文件, 训练的主循环不会被写文件阻塞.
+
+    如果 aggregate 为True, 同一个 tag 在一次 flush 中缓存的多个点会被平均成
+    一个点, 写在这些点中最后的 global_step 上.
+
+    其他的接口(add_scalars, add_image, add_embedding...)直接转发给 SummaryWriter.
+
+    用法:
+        writer = BufferedSummaryWriter(log_dir, flush_steps=50, flush_secs=10)
+        writer.add_scalar("Train/Loss", loss_value, global_step=step)
+        writer.close()       # 结束时写入剩下的值
+
+    Args:
+        log_dir: event 文件保存的路径.
+        flush_steps: 缓存多少个 scalar 之后写入一次.
+        flush_secs: 最多多少秒写入一次.
+        aggregate: 是否把一次 flush 中同一个 tag 的值平均成一个点.
+        enabled: 为False时所有的接口都不做任何事(例如分布式训练中的非主进程).
+    """
+    def __init__(self, log_dir, flush_steps=50, flush_secs=10, aggregate=False, enabled=True):
+        """初始化"""
+        self.enabled = enabled
+        self.flush_steps = max(1, flush_steps)
+        self.flush_secs = flush_secs
+        self.aggregate = aggregate
+
+        # tag: (list of step, list of value)
+        self._buffer = {}
+        self._buffer_count = 0
+        self._buffer_lock = threading.Lock()
+        self._writer_lock = threading.Lock()
+
+        self.writer = None
+        if not enabled:
+            return
+
+        self.writer = SummaryWriter(log_dir)
+
+        # background flush thread
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        """把一个 scalar 放进缓存, 缓存满了之后通知后台线程写入"""
+        if not self.enabled:
+            return
+        if isinstance(scalar_value, torch.Tensor):
+            scalar_value = scalar_value.detach()
+
+        with self._buffer_lock:
+            steps, values = self._buffer.setdefault(tag, ([], []))
+            steps.append(global_step)
+            values.append(scalar_value)
+            self._buffer_count += 1
+            need_flush = self._buffer_count >= self.flush_steps
+
+        if need_flush:
+            self._flush_event.set()
+
+    def flush(self):
+        """把缓存中的值全部写入 event 文件"""
+        if not self.enabled:
+            return
+
+        # swap the buffer, so add_scalar is not blocked by writing.
+        with self._buffer_lock:
+            buffer, self._buffer = self._buffer, {}
+            self._buffer_count = 0
+
+        with self._writer_lock:
+            for tag, (steps, values) in buffer.items():
+                values = np.array([float(value) for value in values], dtype=np.float64)
+                if self.aggregate:
+                    self.writer.add_scalar(tag, values.mean(), global_step=steps[-1])
+                else:
+                    for step, value in zip(steps, values):
+                        self.writer.add_scalar(tag, value, global_step=step)
+            self.writer.flush()
+
+    def _flush_loop(self):
+        """后台线程, 每 flush_secs 秒或者收到通知时写入一次"""
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_secs)
+            self._flush_event.clear()
+            self.flush()
+
+    def close(self):
+        """停止后台线程, 写入剩下的值并关闭 SummaryWriter"""
+        if not self.enabled or self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._flush_event.set()
+        self._thread.join()
+        self.flush()
+        self.writer.close()
+
+    def __getattr__(self, attr):
+        """其他的接口直接转发给 SummaryWriter (加锁, 避免和后台线程同时写)"""
+        # 防止在初始化之前访问
+        if attr.startswith("_") or attr in ("enabled", "writer"):
+            raise AttributeError(attr)
+        if not self.enabled:
+            return lambda *args, **kwargs: None
+
+        method = getattr(self.writer, attr)
+
+        def locked_method(*args, **kwargs):
+            with self._writer_lock:
+                return method(*args, **kwargs)
+        return locked_method
+
+
+if __name__ == "__main__":
+    """测试带缓存的 writer 的写入速度(用法例子)"""
+    import tempfile
+
+    log_dir = tempfile.mkdtemp()
+    steps = 2000
+
+    writer = SummaryWriter(log_dir + "/direct")
+    start_time = time.time()
+    for step in range(steps):
+        writer.add_scalar("Test/loss", torch.tensor(1.0 / (step + 1)), global_step=step)
+    writer.close()
+    direct_time = time.time() - start_time
+
+    writer = BufferedSummaryWriter(log_dir + "/buffered", flush_steps=100, flush_secs=5)
+    start_time = time.time()
+    for step in range(steps):
+        writer.add_scalar("Test/loss", torch.tensor(1.0 / (step + 1)), global_step=step)
+    loop_time = time.time() - start_time
+    writer.close()
+
+    print("SummaryWriter: {:.4f}s | BufferedSummaryWriter loop: {:.4f}s | log dir: {}".format(direct_time, loop_time, log_dir))
@@ -0,0 +1,474 @@
+# --------------------------------------------------------
+# By Jameslimer & Aruix
+# 模型checkpoint保存的相关函数, checkpoint先复制到cpu, 由后台线程
+# 写入临时文件, 写完之后再原子地重命名, 不会留下写了一半的文件.
+# 支持两种格式:
+#   "pt": 一个 .pt 文件保存所有的东西(原来的格式).
+#   "split": 一个 .ckpt 文件夹, 模型参数, optimizer 和 meta 信息分开保存,
+#            测试的时候只需要读取模型参数(可以mmap), 不读取optimizer.
+# --------------------------------------------------------
+import os
+import json
+import queue
+import shutil
+import threading
+import torch
+from utils.log_helper import init_log
+
+logger = init_log("global")
+
+# split checkpoint 文件夹中的文件名
+SPLIT_WEIGHTS_NAME = "weights.pt"
+SPLIT_OPTIMIZER_NAME = "optimizer.pt"
+SPLIT_META_NAME = "meta.json"
+# 保存在 weights.pt 和 optimizer.pt 中的key, 其他的(int, str...)保存在 meta.json
+SPLIT_WEIGHTS_KEYS = ("model_state_dict",)
+SPLIT_OPTIMIZER_KEYS = ("optimizer_model_state_dict", "scaler_state_dict", "loss_state_dict")
+# 最好的checkpoint的文件名 (best.pt / best.ckpt), 以及它的 meta 信息
+BEST_CHECKPOINT_NAME = "best"
+BEST_META_NAME = "best.json"
+
+
+def snapshot_to_cpu(state):
+    """
+    把 state (dict/list/tuple 中的 Tensor) 复制一份到cpu.
+
+    复制之后训练可以继续修改模型参数, 不会影响正在写入的checkpoint.
+
+    Args:
+        state: 需要复制的对象, 例如 model.state_dict().
+
+    Return:
+        结构相同的对象, 其中的 Tensor 都是cpu上的拷贝.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot_to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(v) for v in state)
+    return state
+
+
+def atomic_save(state, path):
+    """
+    先写入临时文件, 再重命名为目标文件. 重命名是原子操作, 所以目标文件要么是完整的旧文件, 要么是完整的新文件.
+
+    Args:
+        state: 需要保存的对象.
+        path: 保存的路径.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_split_checkpoint(state, path):
+    """
+    把checkpoint保存成 split 格式的文件夹:
+        path/
+            weights.pt      模型参数 (state_dict, 可以用 mmap 读取)
+            optimizer.pt    optimizer 和 scaler 的参数 (只有恢复训练时才需要)
+            meta.json       epoch, backbone, embedding_dim 等信息
+
+    同样先写入临时文件夹再重命名.
+
+    Args:
+        state: train.py 中保存的 state dict.
+        path: 保存的文件夹路径, 一般以 .ckpt 结尾.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    weights = {k: state[k] for k in SPLIT_WEIGHTS_KEYS if k in state}
+    optimizer = {k: state[k] for k in SPLIT_OPTIMIZER_KEYS if k in state}
+    meta = {k: v for k, v in state.items() if k not in SPLIT_WEIGHTS_KEYS + SPLIT_OPTIMIZER_KEYS}
+
+    for name, obj in ((SPLIT_WEIGHTS_NAME, weights), (SPLIT_OPTIMIZER_NAME, optimizer)):
+        with open(os.path.join(tmp_path, name), "wb") as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+    with open(os.path.join(tmp_path, SPLIT_META_NAME), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    # a folder can not replace a non-empty folder, move the old one away first.
+    if os.path.exists(path):
+        old_path = path + ".old"
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+def is_split_checkpoint(path):
+    """判断路径是否是 split 格式的checkpoint"""
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, SPLIT_META_NAME))
+
+
+def _load_weights(path, map_location, mmap=True):
+    """
+    读取 torch.save 保存的模型参数 (weights_only=True).
+
+    mmap=True 时只映射文件, 参数在使用时(例如 load_state_dict 复制参数时)才从文件读取,
+    mmap=False 时在这里读取所有参数. 老版本的torch不支持 mmap/weights_only 时直接读取(会警告).
+    """
+    try:
+        return torch.load(path, map_location=map_location, mmap=mmap, weights_only=True)
+    except TypeError:
+        logger.warning("\nWARNING: torch {} does not support torch.load(mmap=..., weights_only=True), "
+                       "load {} without them (pickle objects are allowed).\n".format(torch.__version__, path))
+        return torch.load(path, map_location=map_location)
+
+
+def read_checkpoint_meta(path):
+    """
+    只读取checkpoint的 meta 信息 (epoch, backbone 等).
+
+    split 格式只读取 meta.json, .pt 格式需要读取整个文件.
+
+    Args:
+        path: checkpoint 的路径.
+
+    Return:
+        meta 信息的 dict.
+    """
+    if is_split_checkpoint(path):
+        with open(os.path.join(path, SPLIT_META_NAME), "r") as f:
+            return json.load(f)
+    checkpoint = torch.load(path, map_location="cpu")
+    return {k: v for k, v in checkpoint.items() if k not in SPLIT_WEIGHTS_KEYS + SPLIT_OPTIMIZER_KEYS}
+
+
+def load_checkpoint(path, map_location="cpu", weights_only=False, mmap=True):
+    """
+    读取两种格式的checkpoint, 返回和 .pt 格式相同的 dict.
+
+    Args:
+        path: .pt 文件或者 .ckpt 文件夹的路径.
+        map_location: 和 torch.load 相同.
+        weights_only: 为True时 split 格式不读取 optimizer.pt (测试时使用).
+        mmap: split 格式的模型参数是否用 mmap 读取. mmap 只映射文件, 参数在 load_state_dict
+            时才真正读取; 需要在后台线程中读完参数时(例如预读下一个checkpoint)用 False.
+
+    Return:
+        包括 'epoch', 'model_state_dict' (以及 'optimizer_model_state_dict' 等)的 dict.
+    """
+    if not is_split_checkpoint(path):
+        return torch.load(path, map_location=map_location)
+
+    checkpoint = read_checkpoint_meta(path)
+    checkpoint.update(_load_weights(os.path.join(path, SPLIT_WEIGHTS_NAME), map_location, mmap=mmap))
+    if not weights_only:
+        checkpoint.update(torch.load(os.path.join(path, SPLIT_OPTIMIZER_NAME), map_location=map_location))
+    return checkpoint
+
+
+def _link_or_copy(src, dst):
+    """硬链接文件, 不支持时(例如跨文件系统)复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def update_best_checkpoint(checkpoint_path, meta):
+    """
+    把checkpoint链接为同一个文件夹中的 best.pt (或 best.ckpt), 并把 meta 写入 best.json.
+
+    使用硬链接(不支持时复制)而不是软链接, 所以原来的checkpoint被保留策略删除之后
+    best.pt 仍然有效, 也不占用额外的空间. 同样先写入临时路径再重命名.
+
+    Args:
+        checkpoint_path: 最好的checkpoint的路径 (.pt 文件或者 .ckpt 文件夹), 需要已经写完.
+        meta: (dict) 写入 best.json 的信息, 例如 epoch, metric.
+
+    Return:
+        best checkpoint 的路径.
+    """
+    folder = os.path.dirname(checkpoint_path)
+    best_path = os.path.join(folder, BEST_CHECKPOINT_NAME + os.path.splitext(checkpoint_path)[1])
+    tmp_path = best_path + ".tmp"
+
+    if os.path.isdir(checkpoint_path):
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        shutil.copytree(checkpoint_path, tmp_path, copy_function=_link_or_copy)
+        if os.path.exists(best_path):
+            old_path = best_path + ".old"
+            os.replace(best_path, old_path)
+            os.replace(tmp_path, best_path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(tmp_path, best_path)
+    else:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _link_or_copy(checkpoint_path, tmp_path)
+        os.replace(tmp_path, best_path)
+
+    meta = dict(meta, checkpoint=os.path.basename(checkpoint_path))
+    meta_path = os.path.join(folder, BEST_META_NAME)
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+    return best_path
+
+
+def is_best_checkpoint(path):
+    """判断是否是 update_best_checkpoint 生成的 best.pt / best.ckpt"""
+    return os.path.splitext(os.path.basename(path))[0] == BEST_CHECKPOINT_NAME
+
+
+class AsyncCheckpointWriter(object):
+    """
+    在后台线程中保存checkpoint.
+
+    save() 只把 state 复制到cpu然后放入队列, 写文件在后台线程中进行, 训练不会
+    因为写文件而停下来. 队列最多有 max_pending 个等待写入的checkpoint, 满了之后
+    save() 会等待, 内存中最多有 max_pending + 1 份checkpoint.
+
+    保留策略:
+        keep_last <= 0 时保留所有的checkpoint.
+        keep_last > 0 时只保留最近的 keep_last 个, 以及 metric 最好的 keep_best 个,
+        其他由这个writer保存的checkpoint会被删除.
+        用 metric_pending=True 保存的checkpoint (metric 之后由 set_metric 设置, 例如
+        后台validation) 在 set_metric 之前不会被删除.
+
+    用法:
+        checkpoint_writer = AsyncCheckpointWriter(keep_last=3, keep_best=1)
+        checkpoint_writer.save(state, path, metric=val_loss)
+        checkpoint_writer.save(state, path, metric_pending=True)
+        checkpoint_writer.set_metric(path, val_loss)    # metric 在保存之后才得到时(例如后台validation)
+        checkpoint_writer.link_best(path, {"epoch": 1})  # 写完之后链接为 best.pt, 不等待
+        checkpoint_writer.close()     # 等待所有的checkpoint写完
+
+    Args:
+        keep_last: 保留最近的多少个checkpoint.
+        keep_best: 保留 metric 最好的多少个checkpoint.
+        mode: "min" 表示 metric 越小越好, "max" 表示越大越好.
+        max_pending: 最多有多少个checkpoint等待写入.
+        async_write: 为False时在当前线程中直接写入.
+        checkpoint_format: "pt" 保存成一个文件, "split" 保存成 .ckpt 文件夹.
+    """
+    def __init__(self, keep_last=0, keep_best=0, mode="min", max_pending=1, async_write=True, checkpoint_format="pt"):
+        """初始化"""
+        assert mode in ("min", "max"), "mode should be 'min' or 'max'."
+        if checkpoint_format not in ("pt", "split"):
+            raise NotImplementedError("Please specific a valid checkpoint format")
+        self.checkpoint_format = checkpoint_format
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.async_write = async_write
+
+        # list of (path, metric), in saving order
+        self.saved = []
+        # path of the checkpoints waiting for set_metric
+        self.pending = set()
+        self._error = None
+
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._thread = None
+        if async_write:
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+
+    def save(self, state, path, metric=None, metric_pending=False):
+        """
+        保存一个checkpoint.
+
+        Args:
+            state: 需要保存的对象, 会先复制到cpu.
+            path: 保存的路径.
+            metric: (float or None) 用来选择最好的checkpoint, 为None时不参与选择.
+            metric_pending: (bool) metric 之后会由 set_metric 设置, 在这之前不删除这个checkpoint.
+        """
+        self._raise_error()
+        state = snapshot_to_cpu(state)
+        if self.async_write:
+            self._queue.put((self._write, (state, path, metric, metric_pending)))
+        else:
+            self._write(state, path, metric, metric_pending)
+
+    def set_metric(self, path, metric):
+        """
+        设置已经保存(或等待保存)的checkpoint的 metric, 并重新按照保留策略删除.
+
+        和写入在同一个队列中按顺序处理, checkpoint已经被删除时忽略.
+        metric_pending 的checkpoint在这之后才可以被删除.
+
+        Args:
+            path: checkpoint的路径.
+            metric: (float or None) 用来选择最好的checkpoint, 为None时不参与选择(例如validation失败).
+        """
+        self._raise_error()
+        if self.async_write:
+            self._queue.put((self._update_metric, (path, metric)))
+        else:
+            self._update_metric(path, metric)
+
+    def link_best(self, path, meta):
+        """
+        把checkpoint链接为 best.pt (或 best.ckpt), 并写入 best.json (见 update_best_checkpoint).
+
+        和写入在同一个队列中按顺序处理, 所以在这个checkpoint写完之后才链接, 调用者不需要等待.
+        checkpoint已经被删除时跳过.
+
+        Args:
+            path: checkpoint的路径 (已经保存或等待保存).
+            meta: (dict) 写入 best.json 的信息, 例如 epoch, metric.
+        """
+        self._raise_error()
+        if self.async_write:
+            self._queue.put((self._link_best, (path, meta)))
+        else:
+            self._link_best(path, meta)
+
+    def wait(self):
+        """等待队列中所有的checkpoint写完"""
+        if self.async_write:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """等待所有的checkpoint写完, 并停止后台线程"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        """后台线程写入失败时, 在主线程中抛出异常"""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Failed to save checkpoint.") from error
+
+    def _write_loop(self):
+        """后台线程, 从队列中取出checkpoint写入"""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                job, args = item
+                job(*args)
+            except Exception as e:
+                logger.error("\nERROR: Failed to save checkpoint: {}\n".format(e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, path, metric, metric_pending=False):
+        """写入一个checkpoint, 然后按照保留策略删除旧的checkpoint"""
+        if self.checkpoint_format == "split":
+            save_split_checkpoint(state, path)
+        else:
+            atomic_save(state, path)
+        self.saved = [(p, m) for p, m in self.saved if p != path]
+        self.saved.append((path, metric))
+        if metric_pending:
+            self.pending.add(path)
+        self._apply_retention()
+
+    def _update_metric(self, path, metric):
+        """更新一个checkpoint的 metric"""
+        self.saved = [(p, metric if p == path else m) for p, m in self.saved]
+        self.pending.discard(path)
+        self._apply_retention()
+
+    def _link_best(self, path, meta):
+        """链接最好的checkpoint"""
+        if not os.path.exists(path):
+            logger.warning("\nWARNING: best checkpoint {} is already removed, skip linking best.\n".format(path))
+            return
+        best_path = update_best_checkpoint(path, meta)
+        logger.info("\nLinked best checkpoint {} to {}\n".format(path, best_path))
+
+    def _apply_retention(self):
+        """按照保留策略删除旧的checkpoint"""
+        if self.keep_last <= 0:
+            return
+
+        keep = set(p for p, _ in self.saved[-self.keep_last:]) | self.pending
+        if self.keep_best > 0:
+            with_metric = [(p, m) for p, m in self.saved if m is not None]
+            with_metric.sort(key=lambda x: x[1], reverse=self.mode == "max")
+            keep.update(p for p, _ in with_metric[:self.keep_best])
+
+        for p, _ in self.saved:
+            if p not in keep and os.path.isdir(p):
+                shutil.rmtree(p)
+                logger.info("\nRemove old checkpoint {}\n".format(p))
+            elif p not in keep and os.path.exists(p):
+                os.remove(p)
+                logger.info("\nRemove old checkpoint {}\n".format(p))
+        self.saved = [(p, m) for p, m in self.saved if p in keep]
+
+
+if __name__ == "__main__":
+    """测试checkpoint的保存和保留策略(用法例子)"""
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    checkpoint_writer = AsyncCheckpointWriter(keep_last=2, keep_best=1)
+    model = torch.nn.Linear(4, 2)
+    val_loss = [0.5, 0.1, 0.4, 0.3, 0.2]
+
+    for epoch in range(len(val_loss)):
+        state = {"epoch": epoch + 1, "model_state_dict": model.state_dict()}
+        checkpoint_writer.save(state, os.path.join(folder, "test_epoch_{}.pt".format(epoch + 1)), metric=val_loss[epoch])
+    checkpoint_writer.close()
+
+    # should keep epoch 2 (best), epoch 4 and epoch 5 (last)
+    print(sorted(os.listdir(folder)))
+
+    """测试 metric_pending 的checkpoint在 set_metric 之前不会被删除"""
+    pending_folder = tempfile.mkdtemp()
+    checkpoint_writer = AsyncCheckpointWriter(keep_last=1, keep_best=1)
+    pending_path = os.path.join(pending_folder, "test_epoch_1.pt")
+    checkpoint_writer.save({"epoch": 1}, pending_path, metric_pending=True)
+    checkpoint_writer.save({"epoch": 2}, os.path.join(pending_folder, "test_epoch_2.pt"), metric=0.5)
+    checkpoint_writer.wait()
+    assert os.path.exists(pending_path), "pending checkpoint should be kept"
+    checkpoint_writer.set_metric(pending_path, 0.1)
+    checkpoint_writer.close()
+    assert os.path.exists(pending_path), "best checkpoint should be kept"
+    print(sorted(os.listdir(pending_folder)))
+
+    """测试 link_best 在checkpoint写完之后按顺序链接, 不需要等待"""
+    best_folder = tempfile.mkdtemp()
+    checkpoint_writer = AsyncCheckpointWriter()
+    best_source = os.path.join(best_folder, "test_epoch_1.pt")
+    checkpoint_writer.save({"epoch": 1, "model_state_dict": model.state_dict()}, best_source, metric=0.1)
+    checkpoint_writer.link_best(best_source, {"epoch": 1, "metric": 0.1})
+    checkpoint_writer.close()
+    assert os.path.samefile(best_source, os.path.join(best_folder, "best.pt")), "best.pt should link the checkpoint"
+    with open(os.path.join(best_folder, BEST_META_NAME), "r") as f:
+        assert json.load(f)["checkpoint"] == "test_epoch_1.pt"
+    print(sorted(os.listdir(best_folder)))
+
+    """测试 split 格式的保存和读取"""
+    import time
+    model = torch.nn.Sequential(*[torch.nn.Linear(1024, 1024) for _ in range(8)])
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.randn(2, 1024)).sum().backward()
+    optimizer.step()
+    state = {"epoch": 1, "model_architecture": "test", "model_state_dict": model.state_dict(),
+             "optimizer_model_state_dict": optimizer.state_dict()}
+
+    for checkpoint_format, name in (("pt", "test.pt"), ("split", "test.ckpt")):
+        checkpoint_writer = AsyncCheckpointWriter(checkpoint_format=checkpoint_format)
+        checkpoint_writer.save(state, os.path.join(folder, name))
+        checkpoint_writer.close()
+
+        start_time = time.time()
+        checkpoint = load_checkpoint(os.path.join(folder, name), weights_only=True)
+        model.load_state_dict(checkpoint["model_state_dict"])
+        print("{}: load weights in {:.4f}s, epoch {}".format(checkpoint_format, time.time() - start_time, checkpoint["epoch"]))
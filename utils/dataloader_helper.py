@@ -0,0 +1,373 @@
+# --------------------------------------------------------
+# By Jameslimer & Aruix
+# DataLoader 的性能统计相关函数: 每个batch等待数据的时间, worker
+# 的队列深度, 每个worker的速度, 读取样本和transform的时间, 以及
+# 自动搜索 num_workers / prefetch_factor / persistent_workers.
+# --------------------------------------------------------
+import time
+import random
+import itertools
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, get_worker_info
+from utils.log_helper import init_log
+
+logger = init_log("global")
+
+# TimedDataset 在每个样本中加入的key
+LOAD_STATS_KEY = "load_stats"
+
+
+def seed_worker(worker_id):
+    """
+    DataLoader 的 worker_init_fn, 用 torch 给每个 worker 的种子重新设置 random 和 numpy 的种子.
+
+    否则 fork 出来的 worker 的 random 状态相同, 每个 worker 会采样出相同的样本.
+
+    Args:
+        worker_id: worker 编号.
+    """
+    seed = torch.initial_seed() % 2 ** 32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def share_dataset_memory(dataset):
+    """
+    把 dataset 中的 Tensor 属性(例如整个读入内存的 data, targets)移动到共享内存.
+
+    worker 启动时只传递共享内存的句柄, 不需要复制整个数据集.
+
+    Args:
+        dataset: 需要共享的 dataset (TripletSampler 会处理 inner_dataset).
+
+    Return:
+        移动到共享内存的属性名 list.
+    """
+    dataset = getattr(dataset, "inner_dataset", dataset)
+    shared = []
+    for name, value in vars(dataset).items():
+        if isinstance(value, torch.Tensor) and not value.is_shared():
+            value.share_memory_()
+            shared.append(name)
+    return shared
+
+
+class TimedTransform(object):
+    """
+    包装 transform, 累计 transform 花费的时间 (每个 worker 进程有自己的计数).
+
+    Args:
+        transform: 原来的 transform.
+    """
+    def __init__(self, transform):
+        """初始化"""
+        self.transform = transform
+        self.total_time = 0.0
+
+    def __call__(self, img):
+        start = time.perf_counter()
+        img = self.transform(img)
+        self.total_time += time.perf_counter() - start
+        return img
+
+    def __repr__(self):
+        return "TimedTransform({})".format(self.transform)
+
+
+class TimedDataset(Dataset):
+    """
+    包装 dataset, 在每个样本中加入读取的时间信息:
+        sample[LOAD_STATS_KEY] = {
+            "worker_id": worker 编号 (主进程为 -1),
+            "getitem_time": __getitem__ 花费的时间(包括 get_instance 和 transform),
+            "transform_time": transform 花费的时间,
+        }
+
+    如果 dataset (或者 TripletSampler 的 inner_dataset) 有 transform, 会被替换为 TimedTransform.
+    其他的属性(class_to_idx, get_instance...)直接转发给原来的 dataset.
+
+    Args:
+        dataset: 原来的 dataset, __getitem__ 需要返回 dict.
+    """
+    def __init__(self, dataset):
+        """初始化"""
+        self.dataset = dataset
+
+        # the transform is in the inner dataset for TripletSampler
+        transform_owner = getattr(dataset, "inner_dataset", dataset)
+        self.timed_transform = None
+        transform = getattr(transform_owner, "transform", None)
+        if isinstance(transform, TimedTransform):
+            self.timed_transform = transform
+        elif transform is not None:
+            self.timed_transform = TimedTransform(transform)
+            transform_owner.transform = self.timed_transform
+
+    def __getitem__(self, index):
+        transform_start = self.timed_transform.total_time if self.timed_transform is not None else 0.0
+        start = time.perf_counter()
+        sample = self.dataset[index]
+        getitem_time = time.perf_counter() - start
+        transform_time = self.timed_transform.total_time - transform_start if self.timed_transform is not None else 0.0
+
+        worker_info = get_worker_info()
+        sample[LOAD_STATS_KEY] = {
+            "worker_id": worker_info.id if worker_info is not None else -1,
+            "getitem_time": getitem_time,
+            "transform_time": transform_time,
+        }
+        return sample
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, attr):
+        """其他的属性转发给原来的 dataset"""
+        # 防止在初始化之前(例如 pickle 的时候)访问
+        if attr.startswith("__") or attr == "dataset":
+            raise AttributeError(attr)
+        return getattr(self.dataset, attr)
+
+
+class InstrumentedDataLoader(object):
+    """
+    包装 DataLoader, 统计每个batch等待数据的时间和 worker 的队列深度, 用法和 DataLoader 相同.
+
+    如果 dataset 是 TimedDataset, 还会统计每个 worker 的速度, 读取样本和 transform 的时间.
+
+    等待时间超过 stall_threshold 秒的batch记为一次 stall, 说明 worker 跟不上模型的速度.
+
+    吞吐量 end_to_end_samples_per_sec 用的是两次 yield 之间的时间, 包括训练的时间, 是整个训练的速度.
+
+    队列深度只是参考(best-effort): 读取的是 DataLoader 迭代器的私有属性 _tasks_outstanding,
+    torch 版本不同时可能没有这个属性, 这时只在第一次警告一次, 队列深度不统计.
+
+    用法:
+        train_loader = InstrumentedDataLoader(DataLoader(TimedDataset(dataset), ...))
+        for batch in train_loader:
+            ...
+        train_loader.log_stats(writer, global_step=epoch)
+
+    Args:
+        dataloader: 原来的 DataLoader.
+        stall_threshold: 等待时间超过多少秒算作 stall.
+    """
+    def __init__(self, dataloader, stall_threshold=0.05):
+        """初始化"""
+        self.dataloader = dataloader
+        self.stall_threshold = stall_threshold
+        self._warned_queue_depth = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        """清空所有统计"""
+        self.wait_times = []
+        self.queue_depths = []
+        self.samples = 0
+        self.start_time = time.perf_counter()
+        # worker id: [samples, getitem time, transform time]
+        self.worker_stats = {}
+
+    def __iter__(self):
+        iterator = iter(self.dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wait_times.append(time.perf_counter() - start)
+
+            # number of batch that sent to the workers but not yet returned (only for multi-process loading),
+            # a private attribute of the iterator, best-effort
+            queue_depth = getattr(iterator, "_tasks_outstanding", None)
+            if queue_depth is not None:
+                self.queue_depths.append(queue_depth)
+            elif self.dataloader.num_workers > 0 and not self._warned_queue_depth:
+                self._warned_queue_depth = True
+                logger.warning("\nWARNING: the DataLoader iterator of torch {} has no '_tasks_outstanding', "
+                               "the queue depth is not recorded.\n".format(torch.__version__))
+
+            if isinstance(batch, dict) and LOAD_STATS_KEY in batch:
+                self._update_worker_stats(batch.pop(LOAD_STATS_KEY))
+
+            self.samples += self._batch_size(batch)
+            yield batch
+
+    @staticmethod
+    def _batch_size(batch):
+        """得到一个batch的样本数量"""
+        if isinstance(batch, dict):
+            batch = next(iter(batch.values()))
+        if isinstance(batch, (list, tuple)):
+            batch = batch[0]
+        return len(batch)
+
+    def _update_worker_stats(self, load_stats):
+        """统计每个 worker 的样本数量和时间"""
+        worker_ids = torch.as_tensor(load_stats["worker_id"]).tolist()
+        getitem_times = torch.as_tensor(load_stats["getitem_time"]).tolist()
+        transform_times = torch.as_tensor(load_stats["transform_time"]).tolist()
+        for worker_id, getitem_time, transform_time in zip(worker_ids, getitem_times, transform_times):
+            stats = self.worker_stats.setdefault(worker_id, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += getitem_time
+            stats[2] += transform_time
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, attr):
+        """其他的属性(dataset, sampler, batch_size...)转发给原来的 DataLoader"""
+        if attr.startswith("__") or attr == "dataloader":
+            raise AttributeError(attr)
+        return getattr(self.dataloader, attr)
+
+    def stats(self):
+        """
+        计算统计值.
+
+        Return:
+            dict:
+                wait_mean, wait_p95: 每个batch等待数据的时间(秒).
+                stall_ratio: stall 的batch的比例.
+                queue_depth_mean: 平均的 worker 队列深度 (没有多进程或者无法读取时为0).
+                end_to_end_samples_per_sec: 端到端的吞吐量, 用两次 reset 之间的时间计算,
+                    包括训练的时间 (不是 DataLoader 本身的速度, DataLoader 的速度看 wait 和 workers).
+                workers: {worker id: {"samples_per_sec", "getitem_ms", "transform_ms"}}
+        """
+        wall_time = time.perf_counter() - self.start_time
+        wait_times = np.asarray(self.wait_times) if self.wait_times else np.zeros(1)
+
+        workers = {}
+        for worker_id, (samples, getitem_time, transform_time) in sorted(self.worker_stats.items()):
+            workers[worker_id] = {
+                "samples_per_sec": samples / getitem_time if getitem_time > 0 else 0.0,
+                "getitem_ms": getitem_time / samples * 1000,
+                "transform_ms": transform_time / samples * 1000,
+            }
+
+        return {
+            "wait_mean": float(wait_times.mean()),
+            "wait_p95": float(np.percentile(wait_times, 95)),
+            "stall_ratio": float((wait_times > self.stall_threshold).mean()),
+            "queue_depth_mean": float(np.mean(self.queue_depths)) if self.queue_depths else 0.0,
+            "end_to_end_samples_per_sec": self.samples / wall_time if wall_time > 0 else 0.0,
+            "workers": workers,
+        }
+
+    def log_stats(self, writer=None, global_step=None, prefix="Dataloader"):
+        """把统计值输出到 logger 和 tensorboard, 然后清空统计"""
+        stats = self.stats()
+
+        lines = [" wait: mean {0:.2f} ms | p95 {1:.2f} ms | stall {2:.1f}% (> {3:.0f} ms) | queue depth {4:.2f} | end-to-end {5:.2f} samples/s".format(
+            stats["wait_mean"] * 1000, stats["wait_p95"] * 1000, stats["stall_ratio"] * 100,
+            self.stall_threshold * 1000, stats["queue_depth_mean"], stats["end_to_end_samples_per_sec"])]
+        for worker_id, worker in stats["workers"].items():
+            lines.append(" worker {0}: {1:.2f} samples/s | getitem {2:.2f} ms | transform {3:.2f} ms".format(
+                worker_id, worker["samples_per_sec"], worker["getitem_ms"], worker["transform_ms"]))
+        logger.info("\n dataloader information:\n{}\n".format("\n".join(lines)))
+
+        if stats["stall_ratio"] > 0.1:
+            logger.warning("\nWARNING: {:.1f}% batches are waiting for data, consider increasing num_workers.\n".format(stats["stall_ratio"] * 100))
+
+        if writer is not None:
+            writer.add_scalar("{}/wait_mean_ms".format(prefix), stats["wait_mean"] * 1000, global_step=global_step)
+            writer.add_scalar("{}/wait_p95_ms".format(prefix), stats["wait_p95"] * 1000, global_step=global_step)
+            writer.add_scalar("{}/stall_ratio".format(prefix), stats["stall_ratio"], global_step=global_step)
+            writer.add_scalar("{}/queue_depth".format(prefix), stats["queue_depth_mean"], global_step=global_step)
+            writer.add_scalar("{}/end_to_end_samples_per_sec".format(prefix), stats["end_to_end_samples_per_sec"], global_step=global_step)
+            for worker_id, worker in stats["workers"].items():
+                writer.add_scalar("{}/worker_{}/samples_per_sec".format(prefix, worker_id), worker["samples_per_sec"], global_step=global_step)
+                writer.add_scalar("{}/worker_{}/transform_ms".format(prefix, worker_id), worker["transform_ms"], global_step=global_step)
+
+        self.reset_stats()
+        return stats
+
+
+def instrument_dataloader(dataloader, stall_threshold=0.05):
+    """
+    用同样的参数重新创建 DataLoader, dataset 包装为 TimedDataset, 再包装为 InstrumentedDataLoader.
+
+    Args:
+        dataloader: 原来的 DataLoader (可以为None).
+        stall_threshold: 等待时间超过多少秒算作 stall.
+
+    Return:
+        InstrumentedDataLoader (输入为None时返回None).
+    """
+    if dataloader is None:
+        return None
+
+    kwargs = {}
+    if dataloader.num_workers > 0:
+        kwargs["prefetch_factor"] = dataloader.prefetch_factor
+        kwargs["persistent_workers"] = dataloader.persistent_workers
+
+    timed_dataloader = DataLoader(TimedDataset(dataloader.dataset),
+                                  batch_size=dataloader.batch_size,
+                                  sampler=dataloader.sampler,
+                                  num_workers=dataloader.num_workers,
+                                  collate_fn=dataloader.collate_fn,
+                                  pin_memory=dataloader.pin_memory,
+                                  drop_last=dataloader.drop_last,
+                                  worker_init_fn=dataloader.worker_init_fn,
+                                  **kwargs)
+    return InstrumentedDataLoader(timed_dataloader, stall_threshold=stall_threshold)
+
+
+def autotune_dataloader(dataset, batch_size, num_workers_list=(0, 1, 2, 4, 8), prefetch_factor_list=(2, 4),
+                        persistent_workers_list=(False, True), num_batches=20, epochs=2, pin_memory=False):
+    """
+    搜索使吞吐量最大的 num_workers, prefetch_factor 和 persistent_workers.
+
+    每个组合读取 epochs 次, 每次 num_batches 个batch (包括启动 worker 的时间,
+    所以 persistent_workers 的效果可以体现出来).
+
+    Args:
+        dataset: 需要读取的 dataset.
+        batch_size: batch 大小.
+        num_workers_list: 搜索的 num_workers.
+        prefetch_factor_list: 搜索的 prefetch_factor (num_workers > 0 时有效).
+        persistent_workers_list: 搜索的 persistent_workers (num_workers > 0 时有效).
+        num_batches: 每个epoch读取多少个batch.
+        epochs: 读取多少次.
+        pin_memory: 是否使用 pin_memory.
+
+    Return:
+        best: 吞吐量最大的参数 dict.
+        results: 所有组合的结果 list of dict, 包括 "samples_per_sec".
+    """
+    results = []
+    for num_workers in num_workers_list:
+        if num_workers == 0:
+            settings = [(None, False)]
+        else:
+            settings = list(itertools.product(prefetch_factor_list, persistent_workers_list))
+
+        for prefetch_factor, persistent_workers in settings:
+            kwargs = {}
+            if num_workers > 0:
+                kwargs = {"prefetch_factor": prefetch_factor, "persistent_workers": persistent_workers}
+            loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                pin_memory=pin_memory, **kwargs)
+
+            samples = 0
+            start = time.perf_counter()
+            for _ in range(epochs):
+                for batch_idx, batch in enumerate(loader):
+                    samples += InstrumentedDataLoader._batch_size(batch)
+                    if batch_idx + 1 >= num_batches:
+                        break
+            total_time = time.perf_counter() - start
+            del loader
+
+            result = {"num_workers": num_workers, "prefetch_factor": prefetch_factor,
+                      "persistent_workers": persistent_workers, "samples_per_sec": samples / total_time}
+            results.append(result)
+            logger.info("\n num_workers: {num_workers} | prefetch_factor: {prefetch_factor} | persistent_workers: {persistent_workers} | {samples_per_sec:.2f} samples/s\n".format(**result))
+
+    best = max(results, key=lambda x: x["samples_per_sec"])
+    logger.info("\nBest dataloader setting: num_workers: {num_workers} | prefetch_factor: {prefetch_factor} | persistent_workers: {persistent_workers} | {samples_per_sec:.2f} samples/s\n".format(**best))
+    return best, results
@@ -0,0 +1,183 @@
+# --------------------------------------------------------
+# By Jameslimer & Aruix
+# 多进程分布式训练(torch.distributed)的相关函数.
+# 进程由 torchrun 启动, 进程信息从环境变量中读取.
+# --------------------------------------------------------
+import os
+import datetime
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend="gloo", timeout_minutes=30):
+    """
+    初始化分布式训练的进程组.
+
+    进程需要由 torchrun 启动, 它会设置以下环境变量:
+        RANK, WORLD_SIZE, LOCAL_RANK, LOCAL_WORLD_SIZE, MASTER_ADDR, MASTER_PORT
+    单机多进程:
+        torchrun --standalone --nproc_per_node=4 experiment/train.py --config_name ...
+    多机(TCP):
+        torchrun --nnodes=2 --node_rank=0 --nproc_per_node=4 --master_addr=10.0.0.1 --master_port=29500 experiment/train.py ...
+
+    Args:
+        backend: 通信后端, cpu 使用 "gloo", gpu 可以使用 "nccl".
+        timeout_minutes: 通信的超时时间, rank 0 在做validation和保存模型时其他进程会等待.
+
+    Return:
+        rank: 全局的进程编号
+        world_size: 总的进程数量
+        local_rank: 本机的进程编号
+    """
+    if "RANK" not in os.environ or "WORLD_SIZE" not in os.environ:
+        raise RuntimeError("Distributed training should be launched by torchrun (RANK and WORLD_SIZE is not set).")
+
+    rank = int(os.environ["RANK"])
+    world_size = int(os.environ["WORLD_SIZE"])
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+    dist.init_process_group(backend=backend, init_method="env://",
+                            timeout=datetime.timedelta(minutes=timeout_minutes))
+
+    return rank, world_size, local_rank
+
+
+def is_distributed():
+    """是否在分布式训练中"""
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    """是否是 rank 0 进程, 非分布式训练时总是返回True. 只有主进程写 log, tensorboard 和模型文件."""
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def get_world_size():
+    """获取总的进程数量, 非分布式训练时返回1"""
+    if not is_distributed():
+        return 1
+    return dist.get_world_size()
+
+
+def barrier():
+    """等待所有进程到达这里"""
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_flag(flag, device=None):
+    """
+    把 rank 0 进程的 bool 值广播给所有进程, 例如提前停止的决定. 非分布式训练时直接返回.
+
+    Args:
+        flag: (bool) rank 0 进程的值, 其他进程的值被忽略.
+        device: 通信用的 tensor 所在的设备 (nccl 需要 cuda), 默认是cpu.
+
+    Return:
+        rank 0 进程的值.
+    """
+    if not is_distributed():
+        return flag
+    tensor = torch.tensor([1 if flag else 0], device=device)
+    dist.broadcast(tensor, src=0)
+    return bool(tensor.item())
+
+
+def broadcast_object(obj):
+    """
+    把 rank 0 进程的(可以pickle的)对象广播给所有进程, 例如挖掘的 hard triplet 表. 非分布式训练时直接返回.
+
+    Args:
+        obj: rank 0 进程的对象, 其他进程的值被忽略.
+
+    Return:
+        rank 0 进程的对象.
+    """
+    if not is_distributed():
+        return obj
+    object_list = [obj]
+    dist.broadcast_object_list(object_list, src=0)
+    return object_list[0]
+
+
+def cleanup_distributed():
+    """销毁进程组"""
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def set_cpu_threads():
+    """
+    将本机的cpu核心平均分给本机的每个进程, 避免多个进程的线程互相抢占.
+
+    Return:
+        每个进程的线程数量
+    """
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    num_threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def _test_worker(rank, world_size, port):
+    """测试用的进程, 检查 DDP 训练一步后所有进程的参数一致, 以及 rank 0 的广播."""
+    import torch.nn as nn
+    from torch.nn.parallel import DistributedDataParallel
+
+    os.environ["RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["LOCAL_WORLD_SIZE"] = str(world_size)
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+
+    init_distributed("gloo")
+    set_cpu_threads()
+
+    # different init & data on each rank
+    torch.manual_seed(rank)
+    model = DistributedDataParallel(nn.Linear(8, 4))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+
+    loss = model(torch.randn(16, 8)).pow(2).mean()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+    # all rank should have the same weight
+    weight = model.module.weight.detach().clone()
+    weight_list = [torch.zeros_like(weight) for _ in range(world_size)]
+    dist.all_gather(weight_list, weight)
+    for other_weight in weight_list:
+        if not torch.allclose(weight, other_weight):
+            raise RuntimeError("DDP parameters are not synchronized!")
+
+    # the value of rank 0 is received by all rank
+    if broadcast_flag(rank == 0) is not True or broadcast_object({"rank": rank})["rank"] != 0:
+        raise RuntimeError("Broadcast from rank 0 failed!")
+
+    if is_main_process():
+        print("DDP test passed with {} processes.".format(world_size))
+    cleanup_distributed()
+
+
+if __name__ == "__main__":
+    """
+    使用本地多进程测试 gloo 后端的分布式训练:
+        python utils/distributed_helper.py --nproc 2
+    任何一个进程失败时退出码为1.
+    """
+    import sys
+    import argparse
+    import torch.multiprocessing as mp
+
+    parser = argparse.ArgumentParser(description='Test distributed training with local processes')
+    parser.add_argument('--nproc', default=2, type=int, help='number of local processes')
+    parser.add_argument('--port', default=29511, type=int, help='master port')
+    args = parser.parse_args()
+
+    try:
+        mp.spawn(_test_worker, args=(args.nproc, args.port), nprocs=args.nproc, join=True)
+    except Exception as e:
+        print("DDP test failed: {}".format(e))
+        sys.exit(1)
@@ -0,0 +1,93 @@
+# --------------------------------------------------------
+# By Jameslimer & Aruix
+# 记录validation指标的最好值, 用于保存最好的checkpoint和提前停止训练.
+# --------------------------------------------------------
+
+
+class MetricTracker(object):
+    """
+    记录一个指标(validation loss 或 mAP)的最好值, 连续 patience 次没有变好时提前停止.
+
+    只有比最好值好 min_delta 以上才算变好:
+        mode="min": metric < best - min_delta
+        mode="max": metric > best + min_delta
+
+    用法:
+        tracker = MetricTracker(mode="max", patience=10, min_delta=1e-3)
+        if tracker.update(mAP, epoch):
+            ...  # 保存最好的checkpoint
+        if tracker.should_stop:
+            break
+
+    Args:
+        mode: "min" 表示 metric 越小越好, "max" 表示越大越好.
+        patience: 连续多少次没有变好之后停止, <= 0 时不提前停止.
+        min_delta: 变好的最小幅度.
+    """
+    def __init__(self, mode="min", patience=0, min_delta=0.0):
+        """初始化"""
+        assert mode in ("min", "max"), "mode should be 'min' or 'max'."
+        self.mode = mode
+        self.patience = patience
+        self.min_delta = abs(min_delta)
+
+        self.best = None
+        self.best_epoch = None
+        self.num_bad_updates = 0
+
+    def is_better(self, metric):
+        """metric 是否比最好值好 min_delta 以上"""
+        if self.best is None:
+            return True
+        if self.mode == "min":
+            return metric < self.best - self.min_delta
+        return metric > self.best + self.min_delta
+
+    def update(self, metric, epoch):
+        """
+        更新指标.
+
+        Args:
+            metric: (float) 这次的指标, None 时忽略.
+            epoch: 指标对应的epoch.
+
+        Return:
+            是否是新的最好值.
+        """
+        if metric is None:
+            return False
+        if self.is_better(metric):
+            self.best = metric
+            self.best_epoch = epoch
+            self.num_bad_updates = 0
+            return True
+        self.num_bad_updates += 1
+        return False
+
+    @property
+    def should_stop(self):
+        """是否应该提前停止"""
+        return self.patience > 0 and self.num_bad_updates >= self.patience
+
+    def state_dict(self):
+        """保存到checkpoint中, 恢复训练时继续计数"""
+        return {"best": self.best, "best_epoch": self.best_epoch, "num_bad_updates": self.num_bad_updates}
+
+    def load_state_dict(self, state):
+        """从checkpoint中恢复"""
+        self.best = state["best"]
+        self.best_epoch = state["best_epoch"]
+        self.num_bad_updates = state["num_bad_updates"]
+
+
+if __name__ == "__main__":
+    """测试提前停止(用法例子)"""
+    tracker = MetricTracker(mode="min", patience=2, min_delta=0.01)
+    val_loss = [0.5, 0.3, 0.295, 0.31, 0.2]
+
+    for epoch in range(len(val_loss)):
+        improved = tracker.update(val_loss[epoch], epoch)
+        print(epoch, val_loss[epoch], improved, tracker.should_stop)
+        if tracker.should_stop:
+            break
+    assert tracker.best_epoch == 1 and epoch == 3
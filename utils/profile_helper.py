@@ -0,0 +1,192 @@
+# --------------------------------------------------------
+# By Jameslimer & Aruix
+# 训练过程的性能分析相关函数: 分阶段(data, forward, backward,
+# optimizer, logging)计时, 以及 torch.profiler 的初始化.
+# --------------------------------------------------------
+import os
+import time
+import contextlib
+import numpy as np
+import torch
+from utils.log_helper import init_log
+
+logger = init_log("global")
+
+
+class PhaseTimer(object):
+    """
+    分阶段计时, 统计每个 iteration 中每个阶段花费的时间.
+
+    一个 iteration 中同一个阶段可以出现多次(例如 micro-batch 的 forward), 时间会
+    累加, 调用 step() 时把这个 iteration 的时间保存下来.
+
+    用法:
+        timer = PhaseTimer()
+        for batch in dataloader:
+            with timer.phase("forward"):
+                ...
+            with timer.phase("backward"):
+                ...
+            timer.step(batch_size)
+        logger.info(timer.summary_table())
+
+    Args:
+        enabled: 为False时不计时.
+        sync_cuda: 每个阶段结束时是否同步cuda, 不同步时cuda的时间会被算到之后同步的阶段中.
+        record_function: 是否同时用 torch.profiler.record_function 标记阶段 (在 profiler 的 trace 中显示).
+    """
+    def __init__(self, enabled=True, sync_cuda=False, record_function=False):
+        """初始化"""
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.record_function = record_function
+        self.reset()
+
+    def reset(self):
+        """清空所有记录"""
+        # phase name: list of time per iteration
+        self.times = {}
+        self.current = {}
+        self.samples = 0
+        self.iterations = 0
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """记录一个阶段的时间"""
+        if not self.enabled:
+            yield
+            return
+
+        record = torch.profiler.record_function(name) if self.record_function else contextlib.nullcontext()
+        with record:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.sync_cuda:
+                    torch.cuda.synchronize()
+                self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        """直接记录一个阶段的时间(例如等待数据的时间)"""
+        if not self.enabled:
+            return
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def step(self, samples=0):
+        """结束一个 iteration, 保存这个 iteration 中每个阶段的时间"""
+        if not self.enabled:
+            return
+        for name, seconds in self.current.items():
+            self.times.setdefault(name, []).append(seconds)
+        self.current = {}
+        self.samples += samples
+        self.iterations += 1
+
+    def summary(self):
+        """
+        计算每个阶段的统计值.
+
+        Return:
+            dict, phase name: {"mean", "p95", "total", "percent"} (单位为秒),
+            以及 "samples_per_sec", 是整个过程(从 reset 开始)的吞吐量.
+        """
+        wall_time = time.perf_counter() - self.start_time
+        result = {}
+        for name, seconds in self.times.items():
+            seconds = np.asarray(seconds)
+            result[name] = {
+                "mean": float(seconds.mean()),
+                "p95": float(np.percentile(seconds, 95)),
+                "total": float(seconds.sum()),
+                "percent": float(seconds.sum() / wall_time * 100) if wall_time > 0 else 0.0,
+            }
+        result["samples_per_sec"] = self.samples / wall_time if wall_time > 0 else 0.0
+        return result
+
+    def summary_table(self):
+        """把统计值格式化为表格, 用于 logger 输出"""
+        summary = self.summary()
+        lines = ["{:<12}{:>12}{:>12}{:>12}{:>10}".format("phase", "mean(ms)", "p95(ms)", "total(s)", "%")]
+        for name, value in summary.items():
+            if name == "samples_per_sec":
+                continue
+            lines.append("{:<12}{:>12.3f}{:>12.3f}{:>12.3f}{:>10.1f}".format(
+                name, value["mean"] * 1000, value["p95"] * 1000, value["total"], value["percent"]))
+        lines.append("iterations: {} | samples/sec: {:.2f}".format(self.iterations, summary["samples_per_sec"]))
+        return "\n".join(lines)
+
+    def write_board(self, writer, global_step, prefix="Profile"):
+        """把每个阶段的平均时间和吞吐量写入 tensorboard"""
+        if not self.enabled:
+            return
+        summary = self.summary()
+        for name, value in summary.items():
+            if name == "samples_per_sec":
+                writer.add_scalar("{}/samples_per_sec".format(prefix), value, global_step=global_step)
+            else:
+                writer.add_scalar("{}/{}_mean_ms".format(prefix, name), value["mean"] * 1000, global_step=global_step)
+                writer.add_scalar("{}/{}_p95_ms".format(prefix, name), value["p95"] * 1000, global_step=global_step)
+
+
+def get_profiler(profile_cfg, trace_folder):
+    """
+    根据config初始化 torch.profiler, trace 导出为 chrome trace (可以在 chrome://tracing 或 perfetto 中打开).
+
+    Args:
+        profile_cfg: config 中的 profile 部分 (dict), 使用的key (都是可选的):
+            profiler: (bool) 是否使用 torch.profiler, 默认False.
+            wait: (int) 开始记录之前跳过的 iteration 数量.
+            warmup: (int) 预热的 iteration 数量.
+            active: (int) 记录的 iteration 数量.
+            repeat: (int) 重复记录多少次.
+            record_shapes: (bool) 是否记录输入的shape.
+            profile_memory: (bool) 是否记录内存.
+            with_stack: (bool) 是否记录调用栈.
+        trace_folder: trace 保存的文件夹.
+
+    Return:
+        torch.profiler.profile (需要调用 start(), step() 和 stop()), 没有开启时返回None.
+    """
+    if not profile_cfg.get("profiler", False):
+        return None
+
+    os.makedirs(trace_folder, exist_ok=True)
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def export_chrome_trace(prof):
+        trace_path = os.path.join(trace_folder, "trace_step_{}.json".format(prof.step_num))
+        prof.export_chrome_trace(trace_path)
+        logger.info("\nExport profiler trace to {}\n".format(trace_path))
+        logger.info("\n{}\n".format(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=15)))
+
+    profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=profile_cfg.get("wait", 5),
+                                         warmup=profile_cfg.get("warmup", 2),
+                                         active=profile_cfg.get("active", 5),
+                                         repeat=profile_cfg.get("repeat", 1)),
+        on_trace_ready=export_chrome_trace,
+        record_shapes=profile_cfg.get("record_shapes", False),
+        profile_memory=profile_cfg.get("profile_memory", False),
+        with_stack=profile_cfg.get("with_stack", False),
+    )
+    return profiler
+
+
+if __name__ == "__main__":
+    """测试分阶段计时(用法例子)"""
+    timer = PhaseTimer()
+    for i in range(20):
+        timer.record("data", 0.001)
+        with timer.phase("forward"):
+            time.sleep(0.002)
+        with timer.phase("backward"):
+            time.sleep(0.004)
+        timer.step(samples=32)
+
+    print(timer.summary_table())